@@ -15,23 +15,54 @@
 
 # Copyright (C) 2021 Wendell.Yang
 
+import time
+
 import bpy
 from bpy.app.handlers import persistent
 
-from .spark_operators_export import OBJECT_OT_SparkOperator_ExportForSparkAR
+from .spark_mesh_stats import (
+    stats_depsgraph_handler,
+    stats_load_handler,
+)
+from .spark_profiling import (
+    disable as disable_profiling,
+    profiled,
+    profiling_depsgraph_handler,
+)
+from .spark_operators_mixin import (
+    get_target_objects,
+    SparkARToolkitTargetSettings,
+)
+from .spark_operators_export import (
+    SparkARToolkitExportSettings,
+
+    OBJECT_OT_SparkOperator_ExportForSparkAR,
+)
 from .spark_operators_optimization import (
     SparkARToolkitOptimizationSettings,
     update_sparkar_optimization_settings,
 
     OBJECT_OT_SparkOperator_MeshCleanUp,
+    OBJECT_OT_SparkOperator_OptimizeVertexCache,
     OBJECT_OT_SparkOperator_Decimation,
+    OBJECT_OT_SparkOperator_DecimateInBackground,
+    OBJECT_OT_SparkOperator_DecimateToBudget,
+    OBJECT_OT_SparkOperator_TextureAtlas,
+    OBJECT_OT_SparkOperator_BakeNormalMap,
 )
 from .spark_operators_pivot import (
     OBJECT_OT_SparkOperator_PivotCenter,
     OBJECT_OT_SparkOperator_PivotBottom,
 )
+from .spark_operators_profiling import (
+    SparkARToolkitProfilingSettings,
+
+    OBJECT_OT_SparkOperator_DumpProfile,
+    OBJECT_OT_SparkOperator_ClearProfile,
+)
 from .spark_operators_scale import (
     SparkARToolkitScaleSettings,
+    cancel_pending_resize,
     update_sparkar_scale_settings,
 
     OBJECT_OT_SparkOperator_Resize,
@@ -52,42 +83,170 @@ bl_info = {
 }
 
 classes = (
+    SparkARToolkitTargetSettings,
     SparkARToolkitScaleSettings,
     SparkARToolkitOptimizationSettings,
+    SparkARToolkitExportSettings,
+    SparkARToolkitProfilingSettings,
 
     OBJECT_OT_SparkOperator_Decimation,
+    OBJECT_OT_SparkOperator_DecimateInBackground,
+    OBJECT_OT_SparkOperator_DecimateToBudget,
     OBJECT_OT_SparkOperator_MeshCleanUp,
+    OBJECT_OT_SparkOperator_OptimizeVertexCache,
+    OBJECT_OT_SparkOperator_TextureAtlas,
+    OBJECT_OT_SparkOperator_BakeNormalMap,
     OBJECT_OT_SparkOperator_Resize,
     OBJECT_OT_SparkOperator_PivotCenter,
     OBJECT_OT_SparkOperator_PivotBottom,
     OBJECT_OT_SparkOperator_ExportForSparkAR,
+    OBJECT_OT_SparkOperator_DumpProfile,
+    OBJECT_OT_SparkOperator_ClearProfile,
 
     PANEL0_PT_SparkAR_Panel,
 )
 
 
+HANDLER_DEBOUNCE_INTERVAL = 0.15  # unit: seconds
+
+handler_stats = {
+    'calls': 0,
+    'skipped': 0,
+    'runs': 0,
+    'total_time': 0.0,
+    'last_time': 0.0,
+    'max_time': 0.0,
+}
+
+_last_relevant_update = 0.0
+_last_targets = frozenset()
+_update_scheduled = False
+
+
+def _update_settings(context):
+    global _last_targets
+    _last_targets = frozenset(obj.name for obj in get_target_objects(context))
+    start = time.perf_counter()
+    update_sparkar_optimization_settings(context)
+    update_sparkar_scale_settings(context)
+    elapsed = time.perf_counter() - start
+
+    handler_stats['runs'] += 1
+    handler_stats['total_time'] += elapsed
+    handler_stats['last_time'] = elapsed
+    handler_stats['max_time'] = max(handler_stats['max_time'], elapsed)
+
+
+def _update_settings_in_all_windows():
+    for window in bpy.context.window_manager.windows:
+        with bpy.context.temp_override(window=window, screen=window.screen):
+            _update_settings(bpy.context)
+
+
+@profiled('handler')
+def _deferred_update():
+    global _update_scheduled
+    remaining = (_last_relevant_update + HANDLER_DEBOUNCE_INTERVAL
+                 - time.perf_counter())
+    if remaining > 0:
+        return remaining
+    _update_scheduled = False
+    _update_settings_in_all_windows()
+    return None
+
+
+def _is_animation_playing(context):
+    screen = context.screen
+    return screen is not None and screen.is_animation_playing
+
+
+def _is_relevant_update(context, depsgraph):
+    objects = get_target_objects(context)
+    if frozenset(obj.name for obj in objects) != _last_targets:
+        return True
+    meshes = set(obj.data for obj in objects)
+    for update in depsgraph.updates:
+        id_original = update.id.original
+        if id_original in objects:
+            if update.is_updated_geometry or update.is_updated_transform:
+                return True
+        elif id_original in meshes:
+            return True
+    return False
+
+
+@persistent
+@profiled('handler')
+def load_handler(*args):
+    cancel_pending_resize()
+    _update_settings(bpy.context)
+
+
 @persistent
-def load_handler(scene):
-    update_sparkar_optimization_settings(bpy.context)
-    update_sparkar_scale_settings(bpy.context)
+def depsgraph_update_handler(scene, depsgraph=None):
+    global _last_relevant_update, _update_scheduled
+    handler_stats['calls'] += 1
+    context = bpy.context
+    if depsgraph is None:
+        depsgraph = context.evaluated_depsgraph_get()
+    if (_is_animation_playing(context)
+            or not _is_relevant_update(context, depsgraph)):
+        handler_stats['skipped'] += 1
+        return
+
+    if not hasattr(context, 'temp_override'):
+        # Timers run without a window context before Blender 3.2, so the
+        # settings can only be refreshed synchronously there.
+        _update_settings(context)
+        return
+
+    _last_relevant_update = time.perf_counter()
+    if not _update_scheduled:
+        _update_scheduled = True
+        bpy.app.timers.register(_deferred_update,
+                                first_interval=HANDLER_DEBOUNCE_INTERVAL,
+                                persistent=True)
 
 
 def register():
     for cls in classes:
         bpy.utils.register_class(cls)
+    bpy.types.Screen.sparkar_target = bpy.props.PointerProperty(
+        type=SparkARToolkitTargetSettings)
     bpy.types.Screen.sparkar_scale = bpy.props.PointerProperty(
         type=SparkARToolkitScaleSettings)
     bpy.types.Object.sparkar_optimization = bpy.props.PointerProperty(
         type=SparkARToolkitOptimizationSettings)
-    bpy.app.handlers.depsgraph_update_post.append(load_handler)
+    bpy.types.Screen.sparkar_export = bpy.props.PointerProperty(
+        type=SparkARToolkitExportSettings)
+    bpy.types.Screen.sparkar_profiling = bpy.props.PointerProperty(
+        type=SparkARToolkitProfilingSettings)
+    bpy.app.handlers.depsgraph_update_post.append(
+        profiling_depsgraph_handler)
+    bpy.app.handlers.depsgraph_update_post.append(stats_depsgraph_handler)
+    bpy.app.handlers.depsgraph_update_post.append(depsgraph_update_handler)
+    bpy.app.handlers.load_post.append(stats_load_handler)
     bpy.app.handlers.load_post.append(load_handler)
 
 
 def unregister():
+    global _update_scheduled
+    if bpy.app.timers.is_registered(_deferred_update):
+        bpy.app.timers.unregister(_deferred_update)
+    _update_scheduled = False
+    cancel_pending_resize()
     bpy.app.handlers.load_post.remove(load_handler)
-    bpy.app.handlers.depsgraph_update_post.remove(load_handler)
+    bpy.app.handlers.load_post.remove(stats_load_handler)
+    bpy.app.handlers.depsgraph_update_post.remove(depsgraph_update_handler)
+    bpy.app.handlers.depsgraph_update_post.remove(stats_depsgraph_handler)
+    bpy.app.handlers.depsgraph_update_post.remove(
+        profiling_depsgraph_handler)
+    disable_profiling()
+    del bpy.types.Screen.sparkar_profiling
+    del bpy.types.Screen.sparkar_export
     del bpy.types.Object.sparkar_optimization
     del bpy.types.Screen.sparkar_scale
+    del bpy.types.Screen.sparkar_target
     for cls in reversed(classes):
         bpy.utils.unregister_class(cls)
 
@@ -0,0 +1,106 @@
+# Copyright (C) Facebook, Inc. and its affiliates
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import contextlib
+import json
+
+from .spark_export_cache import hash_object_content
+
+# Custom property holding the optimization record of an object, as a JSON
+# string so both exporters write it into the node extras unchanged.
+ASSET_STATE_KEY = 'sparkar_state'
+ASSET_STATE_VERSION = 1
+
+
+def content_hash(obj, image_digests=None):
+    return hash_object_content(obj, image_digests=image_digests).hexdigest()
+
+
+def read_state(obj):
+    """ The optimization record of obj: the latest run of every step, in
+    the order they ran, each with its parameters and the content hash of
+    obj before and after."""
+    try:
+        state = json.loads(obj.get(ASSET_STATE_KEY, ''))
+    except ValueError:
+        state = None
+    if not isinstance(state, dict) or \
+            state.get('version') != ASSET_STATE_VERSION:
+        state = {'version': ASSET_STATE_VERSION, 'steps': []}
+    return state
+
+
+def write_state(obj, state):
+    obj[ASSET_STATE_KEY] = json.dumps(state, sort_keys=True)
+
+
+def _normalize(params):
+    """ params as they compare after a round trip through JSON."""
+    return json.loads(json.dumps(params, sort_keys=True))
+
+
+def record_step(obj, step, params, input_hash, output_hash=None):
+    state = read_state(obj)
+    state['steps'] = [entry for entry in state['steps']
+                      if entry['step'] != step]
+    state['steps'].append({
+        'step': step,
+        'params': _normalize(params),
+        'input': input_hash,
+        'output': output_hash or content_hash(obj),
+    })
+    write_state(obj, state)
+
+
+def is_step_current(obj, step, params, current_hash=None):
+    """ Whether running step with params again would redo work already in
+    obj: its latest run used the same params and nothing changed obj
+    after the last recorded step."""
+    steps = read_state(obj)['steps']
+    if not steps:
+        return False
+    current_hash = current_hash or content_hash(obj)
+    if steps[-1]['output'] != current_hash:
+        return False
+    latest = next((entry for entry in reversed(steps)
+                   if entry['step'] == step), None)
+    return latest is not None and latest['params'] == _normalize(params)
+
+
+@contextlib.contextmanager
+def recording_step(objects, step, params, hashes=None, image_digests=None):
+    """ Record step for every object that is still alive when the block
+    finishes without an error.
+
+    Consecutive steps of one operator pass the same hashes dict, so each
+    step starts from the output hashes of the previous one instead of
+    hashing the objects again. A shared image_digests dict hashes every
+    image once; a block that changes image contents must clear it.
+    """
+    hashes = {} if hashes is None else hashes
+    digests = {} if image_digests is None else image_digests
+    inputs = [(obj, obj.name, hashes.get(obj.name)
+               or content_hash(obj, digests)) for obj in objects]
+    yield
+    digests = {} if image_digests is None else image_digests
+    for obj, name, input_hash in inputs:
+        try:
+            output_hash = content_hash(obj, digests)
+        except ReferenceError:
+            # Removed by the step, e.g. joined into another object.
+            hashes.pop(name, None)
+            continue
+        record_step(obj, step, params, input_hash, output_hash)
+        hashes[name] = output_hash
@@ -0,0 +1,422 @@
+# Copyright (C) Facebook, Inc. and its affiliates
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from concurrent.futures import ThreadPoolExecutor
+
+import bpy
+import numpy as np
+
+from .spark_textures import read_pixels, resample_pixels
+
+ATLAS_PADDING = 4  # unit: pixels on every side of a cell
+# Longest side of the region sampled from a source texture, relative to
+# its atlas cell, before the box filter brings it down to the cell size.
+MAX_SAMPLING_RATIO = 4
+MAX_CELL_ASPECT = 4
+
+FLAT_NORMAL = (0.5, 0.5, 1.0, 1.0)
+
+SEPARATE_CHANNELS = {
+    'R': 0, 'G': 1, 'B': 2,
+    'Red': 0, 'Green': 1, 'Blue': 2,
+}
+
+
+# MATERIAL INPUTS
+
+def _principled_node(material):
+    if material is None or not material.node_tree:
+        return None
+    for node in material.node_tree.nodes:
+        if node.type == 'BSDF_PRINCIPLED':
+            return node
+    return None
+
+
+def _linked_image(socket):
+    """ (image, channel) feeding socket directly or through a normal map or
+    separate color node. channel is None when all channels are used."""
+    if not socket.is_linked:
+        return None
+    link = socket.links[0]
+    node = link.from_node
+    if node.type == 'TEX_IMAGE' and node.image is not None:
+        return node.image, None
+    if node.type == 'NORMAL_MAP':
+        return _linked_image(node.inputs['Color'])
+    if node.type in {'SEPRGB', 'SEPARATE_COLOR'}:
+        source = _linked_image(node.inputs[0])
+        if source is not None:
+            return source[0], SEPARATE_CHANNELS.get(link.from_socket.name)
+    return None
+
+
+def _linear_to_srgb(values):
+    values = np.clip(values, 0, 1)
+    return np.where(values <= 0.0031308, values * 12.92,
+                    1.055 * np.power(values, 1 / 2.4) - 0.055)
+
+
+def material_sources(material):
+    """ Where each atlas layer of a material comes from: an (image,
+    channel) pair or a constant."""
+    principled = _principled_node(material)
+    if principled is None:
+        color = (material.diffuse_color if material is not None
+                 else (0.8, 0.8, 0.8, 1.0))
+        return {
+            'base_color': tuple(color),
+            'normal': None,
+            'roughness': 0.5,
+            'metallic': 0.0,
+        }
+    inputs = principled.inputs
+    return {
+        'base_color': (_linked_image(inputs['Base Color'])
+                       or tuple(inputs['Base Color'].default_value)),
+        'normal': _linked_image(inputs['Normal']),
+        'roughness': (_linked_image(inputs['Roughness'])
+                      or inputs['Roughness'].default_value),
+        'metallic': (_linked_image(inputs['Metallic'])
+                     or inputs['Metallic'].default_value),
+    }
+
+
+# PACKING
+
+def _shelf_pack(sizes, atlas_size, padding):
+    """ Place (width, height) cells on shelves, tallest first. Returns the
+    lower left corner of every cell, or None if they do not fit."""
+    order = sorted(range(len(sizes)), key=lambda i: -sizes[i][1])
+    positions = [None] * len(sizes)
+    x = y = shelf_height = 0
+    for index in order:
+        width, height = sizes[index]
+        if x + width + 2 * padding > atlas_size:
+            x = 0
+            y += shelf_height
+            shelf_height = 0
+        if (x + width + 2 * padding > atlas_size
+                or y + height + 2 * padding > atlas_size):
+            return None
+        positions[index] = (x + padding, y + padding)
+        x += width + 2 * padding
+        shelf_height = max(shelf_height, height + 2 * padding)
+    return positions
+
+
+def pack_cells(weights, aspects, atlas_size, padding=ATLAS_PADDING):
+    """ Rectangles with areas proportional to `weights`, as large as fit in
+    the atlas. Returns a list of (x, y, width, height) in pixels."""
+    weights = np.maximum(np.asarray(weights, dtype=np.float64), 1e-12)
+    weights /= weights.sum()
+    aspects = np.clip(aspects, 1 / MAX_CELL_ASPECT, MAX_CELL_ASPECT)
+    unit_sizes = np.stack((np.sqrt(weights * aspects),
+                           np.sqrt(weights / aspects)), axis=-1)
+
+    def sizes_at(scale):
+        return [tuple(int(side) for side in np.maximum(size * scale, 1))
+                for size in unit_sizes]
+
+    low, high = 0.0, float(atlas_size)
+    positions = _shelf_pack(sizes_at(low), atlas_size, padding)
+    if positions is None:
+        raise ValueError('Too many materials for a {0}x{0} atlas'.format(
+            atlas_size))
+    for _ in range(24):
+        middle = (low + high) / 2
+        if _shelf_pack(sizes_at(middle), atlas_size, padding) is None:
+            high = middle
+        else:
+            low = middle
+    sizes = sizes_at(low)
+    positions = _shelf_pack(sizes, atlas_size, padding)
+    return [position + size for position, size in zip(positions, sizes)]
+
+
+# PIXELS
+
+def _rgba_pixels(image):
+    width, height = image.size
+    pixels = read_pixels(image).reshape(height, width, image.channels)
+    if image.channels == 4:
+        return pixels
+    rgba = np.ones((height, width, 4), dtype=np.float32)
+    if image.channels == 1:
+        rgba[..., :3] = pixels
+    else:
+        rgba[..., :image.channels] = pixels[..., :3]
+    return rgba
+
+
+def sample_region(pixels, uv_min, uv_size, cell_width, cell_height):
+    """ Box-filtered copy of the texture over a UV rectangle, wrapping like
+    a repeating texture, at the given cell size in pixels."""
+    height, width = pixels.shape[:2]
+    region_width = int(np.clip(np.ceil(uv_size[0] * width), 1,
+                               cell_width * MAX_SAMPLING_RATIO))
+    region_height = int(np.clip(np.ceil(uv_size[1] * height), 1,
+                                cell_height * MAX_SAMPLING_RATIO))
+    us = uv_min[0] + (np.arange(region_width) + 0.5) / region_width \
+        * uv_size[0]
+    vs = uv_min[1] + (np.arange(region_height) + 0.5) / region_height \
+        * uv_size[1]
+    xs = np.minimum((np.mod(us, 1) * width).astype(np.int64), width - 1)
+    ys = np.minimum((np.mod(vs, 1) * height).astype(np.int64), height - 1)
+    region = pixels[ys][:, xs]
+    return resample_pixels(np.ascontiguousarray(region).ravel(),
+                           region_width, region_height, pixels.shape[2],
+                           cell_width, cell_height).reshape(
+        cell_height, cell_width, pixels.shape[2])
+
+
+def _render_cell(source, layer, pixels, uv_min, uv_size, width, height):
+    """ Pixels of one atlas cell, gutter included, for one layer."""
+    if pixels is None:
+        if layer == 'normal':
+            return np.broadcast_to(np.float32(FLAT_NORMAL),
+                                   (height, width, 4))
+        value = np.array(source, dtype=np.float32)
+        if layer == 'base_color':
+            value[:3] = _linear_to_srgb(value[:3])
+        return np.broadcast_to(value, (height, width, 4))
+    image, channel, is_float = pixels
+    cell = sample_region(image, uv_min, uv_size, width, height)
+    if layer == 'base_color' and is_float:
+        cell = cell.copy()
+        cell[..., :3] = _linear_to_srgb(cell[..., :3])
+    if channel is not None:
+        cell = np.repeat(cell[..., channel:channel + 1], 4, axis=2)
+    return cell
+
+
+def _render_orm_cell(roughness, metallic, uv_min, uv_size, width, height):
+    cell = np.ones((height, width, 4), dtype=np.float32)
+    for channel, (source, pixels) in ((1, roughness), (2, metallic)):
+        if pixels is None:
+            cell[..., channel] = source
+        else:
+            image, source_channel, _ = pixels
+            sampled = sample_region(image, uv_min, uv_size, width, height)
+            cell[..., channel] = sampled[..., source_channel or 0]
+    return cell
+
+
+# MESH DATA
+
+def _material_loops(obj, mesh):
+    """ Material of every loop, as an index into obj.material_slots."""
+    loop_totals = np.empty(len(mesh.polygons), dtype=np.int32)
+    mesh.polygons.foreach_get('loop_total', loop_totals)
+    material_indices = np.empty(len(mesh.polygons), dtype=np.int32)
+    mesh.polygons.foreach_get('material_index', material_indices)
+    areas = np.empty(len(mesh.polygons), dtype=np.float32)
+    mesh.polygons.foreach_get('area', areas)
+    return np.repeat(material_indices, loop_totals), material_indices, areas
+
+
+def _read_uvs(mesh):
+    uv_layer = mesh.uv_layers.active or mesh.uv_layers.new(name='UVMap')
+    uvs = np.empty(len(mesh.loops) * 2, dtype=np.float32)
+    uv_layer.data.foreach_get('uv', uvs)
+    return uv_layer, uvs.reshape(-1, 2)
+
+
+def _slot_material(obj, index):
+    if 0 <= index < len(obj.material_slots):
+        return obj.material_slots[index].material
+    return None
+
+
+def _create_atlas_image(name, pixels, non_color):
+    size = pixels.shape[0]
+    image = bpy.data.images.new(name, size, size, alpha=True)
+    if non_color:
+        image.colorspace_settings.name = 'Non-Color'
+    image.pixels.foreach_set(pixels.ravel())
+    image.file_format = 'PNG'
+    image.pack()
+    return image
+
+
+def _create_atlas_material(name, images):
+    material = bpy.data.materials.new(name)
+    material.use_nodes = True
+    nodes = material.node_tree.nodes
+    links = material.node_tree.links
+    principled = next(node for node in nodes
+                      if node.type == 'BSDF_PRINCIPLED')
+
+    base_color = nodes.new('ShaderNodeTexImage')
+    base_color.image = images['base_color']
+    links.new(base_color.outputs['Color'], principled.inputs['Base Color'])
+    links.new(base_color.outputs['Alpha'], principled.inputs['Alpha'])
+    if 'normal' in images:
+        normal = nodes.new('ShaderNodeTexImage')
+        normal.image = images['normal']
+        normal_map = nodes.new('ShaderNodeNormalMap')
+        links.new(normal.outputs['Color'], normal_map.inputs['Color'])
+        links.new(normal_map.outputs['Normal'], principled.inputs['Normal'])
+    if 'orm' in images:
+        orm = nodes.new('ShaderNodeTexImage')
+        orm.image = images['orm']
+        if bpy.app.version >= (3, 3, 0):
+            separate = nodes.new('ShaderNodeSeparateColor')
+        else:
+            separate = nodes.new('ShaderNodeSeparateRGB')
+        links.new(orm.outputs['Color'], separate.inputs[0])
+        links.new(separate.outputs[1], principled.inputs['Roughness'])
+        links.new(separate.outputs[2], principled.inputs['Metallic'])
+    return material
+
+
+def bake_texture_atlas(objects, atlas_size, name='Atlas', max_workers=None):
+    """ Merge every material of the objects into one atlas material.
+
+    Each material gets a cell in the atlas, sized by its share of the
+    surface area, holding its textures (or constant values) resampled
+    over the UV rectangle its faces use. The UVs are remapped into the
+    cells and every object is left with the single atlas material. All
+    of it runs on the CPU. Returns the atlas material.
+    """
+    meshes = {}
+    for obj in objects:
+        if obj.data not in meshes:
+            meshes[obj.data] = obj
+
+    # Gather the UV rectangle and surface area of every material.
+    materials = []
+    mesh_data = {}
+    bounds = {}
+    weights = {}
+    for mesh, obj in meshes.items():
+        loop_materials, polygon_materials, areas = _material_loops(obj, mesh)
+        uv_layer, uvs = _read_uvs(mesh)
+        slots = [_slot_material(obj, index)
+                 for index in range(max(len(obj.material_slots), 1))]
+        for slot_index, material in enumerate(slots):
+            mask = loop_materials == slot_index
+            if not mask.any():
+                continue
+            if material not in bounds:
+                materials.append(material)
+                bounds[material] = (uvs[mask].min(axis=0),
+                                    uvs[mask].max(axis=0))
+                weights[material] = 0.0
+            low, high = bounds[material]
+            bounds[material] = (np.minimum(low, uvs[mask].min(axis=0)),
+                                np.maximum(high, uvs[mask].max(axis=0)))
+            weights[material] += float(
+                areas[polygon_materials == slot_index].sum())
+        mesh_data[mesh] = (obj, uv_layer, uvs, loop_materials, slots)
+    if not materials:
+        return None
+
+    sources = {material: material_sources(material)
+               for material in materials}
+    image_cache = {}
+
+    def load(source):
+        if not isinstance(source, tuple) or not isinstance(
+                source[0], bpy.types.Image):
+            return None
+        image, channel = source
+        if image.name not in image_cache:
+            image_cache[image.name] = _rgba_pixels(image)
+        return image_cache[image.name], channel, image.is_float
+
+    # Size the cells by area and by the texel aspect of what they hold.
+    aspects = []
+    for material in materials:
+        low, high = bounds[material]
+        uv_size = np.maximum(high - low, 1e-6)
+        aspect = uv_size[0] / uv_size[1]
+        source = sources[material]['base_color']
+        if isinstance(source, tuple) and isinstance(source[0],
+                                                    bpy.types.Image):
+            aspect *= source[0].size[0] / max(source[0].size[1], 1)
+        aspects.append(aspect)
+    cells = pack_cells([weights[material] for material in materials],
+                       aspects, atlas_size)
+
+    layers = ['base_color']
+    if any(sources[material]['normal'] for material in materials):
+        layers.append('normal')
+    if any(isinstance(sources[material][key], tuple)
+           for material in materials for key in ('roughness', 'metallic')):
+        layers.append('orm')
+    atlases = {layer: np.zeros((atlas_size, atlas_size, 4),
+                               dtype=np.float32) for layer in layers}
+    if 'normal' in atlases:
+        atlases['normal'][...] = FLAT_NORMAL
+
+    jobs = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for material, (x, y, width, height) in zip(materials, cells):
+            low, high = bounds[material]
+            uv_size = np.maximum(high - low, 1e-6)
+            # Extend the sampled rectangle over the gutter around the cell.
+            padding = np.array((ATLAS_PADDING, ATLAS_PADDING))
+            texel = uv_size / np.array((width, height))
+            uv_min = low - padding * texel
+            uv_extent = uv_size + 2 * padding * texel
+            full = (width + 2 * ATLAS_PADDING, height + 2 * ATLAS_PADDING)
+            source = sources[material]
+            for layer in layers:
+                if layer == 'orm':
+                    future = executor.submit(
+                        _render_orm_cell,
+                        (source['roughness'], load(source['roughness'])),
+                        (source['metallic'], load(source['metallic'])),
+                        uv_min, uv_extent, *full)
+                else:
+                    future = executor.submit(
+                        _render_cell, source[layer], layer,
+                        load(source[layer]), uv_min, uv_extent, *full)
+                jobs.append((layer, x - ATLAS_PADDING, y - ATLAS_PADDING,
+                             future))
+        for layer, x, y, future in jobs:
+            cell = future.result()
+            atlases[layer][y:y + cell.shape[0], x:x + cell.shape[1]] = cell
+
+    images = {layer: _create_atlas_image('{}_{}'.format(name, layer),
+                                         pixels, layer != 'base_color')
+              for layer, pixels in atlases.items()}
+    atlas_material = _create_atlas_material(name, images)
+
+    # Remap the UVs into the cells and collapse the material slots.
+    cell_of = dict(zip(materials, cells))
+    for mesh, (obj, uv_layer, uvs, loop_materials, slots) in \
+            mesh_data.items():
+        remapped = uvs.copy()
+        for slot_index, material in enumerate(slots):
+            mask = loop_materials == slot_index
+            if not mask.any():
+                continue
+            x, y, width, height = cell_of[material]
+            low, high = bounds[material]
+            uv_size = np.maximum(high - low, 1e-6)
+            remapped[mask] = ((uvs[mask] - low) / uv_size
+                              * (width, height) + (x, y)) / atlas_size
+        uv_layer.data.foreach_set('uv', remapped.ravel())
+        mesh.materials.clear()
+        mesh.materials.append(atlas_material)
+        mesh.polygons.foreach_set(
+            'material_index', np.zeros(len(mesh.polygons), dtype=np.int32))
+        mesh.update()
+    for obj in objects:
+        for slot in obj.material_slots:
+            slot.link = 'DATA'
+    return atlas_material
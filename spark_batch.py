@@ -0,0 +1,262 @@
+# Copyright (C) Facebook, Inc. and its affiliates
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Copyright (C) 2021 Wendell.Yang
+
+""" Headless batch optimization of a folder of assets.
+
+    blender -b --factory-startup -P spark_batch.py -- \\
+        INPUT_DIR OUTPUT_DIR [--pipeline pipeline.json] [--jobs N] \\
+        [--timeout SECONDS] [--summary results.json]
+
+The driver can also be started with a plain Python interpreter, in which
+case --blender must point at the Blender executable. Every input file is
+processed by its own `blender -b` worker; at most --jobs workers run at
+the same time.
+"""
+
+import argparse
+import collections
+import importlib
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+ADDON_MODULE_NAME = 'kivicube_ar_toolkit'
+ADDON_DIR = os.path.dirname(os.path.abspath(__file__))
+SUPPORTED_EXTENSIONS = ('.blend', '.fbx', '.obj', '.glb', '.gltf')
+DEFAULT_TIMEOUT = 600  # unit: seconds
+
+DEFAULT_PIPELINE = {
+    'steps': [
+        {'step': 'cleanup'},
+        {'step': 'decimate', 'tri_budget': 30000},
+        {'step': 'resize', 'height': 20, 'unit': 'cm'},
+        {'step': 'pivot', 'mode': 'BOTTOM'},
+        {'step': 'export'},
+        {'step': 'analyze'},
+    ],
+}
+
+
+def _script_args(argv):
+    if '--' in argv:
+        return argv[argv.index('--') + 1:]
+    return argv[1:]
+
+
+def load_addon():
+    """ Import this folder as a package and register the add-on once."""
+    if ADDON_MODULE_NAME in sys.modules:
+        return sys.modules[ADDON_MODULE_NAME]
+    spec = importlib.util.spec_from_file_location(
+        ADDON_MODULE_NAME, os.path.join(ADDON_DIR, '__init__.py'),
+        submodule_search_locations=[ADDON_DIR])
+    addon = importlib.util.module_from_spec(spec)
+    sys.modules[ADDON_MODULE_NAME] = addon
+    spec.loader.exec_module(addon)
+    addon.register()
+    return addon
+
+
+# WORKER
+
+def run_worker(args):
+    result = {'input': args.input, 'status': 'failed'}
+    start = time.perf_counter()
+    try:
+        load_addon()
+        pipeline = importlib.import_module(
+            ADDON_MODULE_NAME + '.spark_pipeline')
+        with open(args.pipeline) as pipeline_file:
+            steps = json.load(pipeline_file)
+        result.update(pipeline.process_file(args.input, args.output, steps))
+        result['status'] = 'succeeded'
+    except Exception as error:
+        result['error'] = str(error)
+        result['traceback'] = traceback.format_exc()
+    result['elapsed'] = time.perf_counter() - start
+
+    with open(args.result, 'w') as result_file:
+        json.dump(result, result_file, indent=2)
+    return 0 if result['status'] == 'succeeded' else 1
+
+
+# DRIVER
+
+def find_blender(path=None):
+    if path:
+        return path
+    try:
+        import bpy
+        return bpy.app.binary_path
+    except ImportError:
+        return shutil.which('blender')
+
+
+def collect_inputs(input_dir):
+    inputs = []
+    for root, _, files in os.walk(input_dir):
+        for name in sorted(files):
+            if name.lower().endswith(SUPPORTED_EXTENSIONS):
+                inputs.append(os.path.join(root, name))
+    return sorted(inputs)
+
+
+def output_path_for(input_path, input_dir, output_dir, keep_extension=False):
+    relative = os.path.relpath(input_path, input_dir)
+    if not keep_extension:
+        relative = os.path.splitext(relative)[0]
+    return os.path.join(output_dir, relative + '.glb')
+
+
+def output_paths_for(inputs, input_dir, output_dir):
+    """ Output path of every input. Inputs sharing a name apart from the
+    extension, e.g. a.fbx and a.obj, keep it, as a.fbx.glb and a.obj.glb,
+    so parallel jobs never write the same file."""
+    stems = collections.Counter(os.path.splitext(path)[0].lower()
+                                for path in inputs)
+    return [output_path_for(path, input_dir, output_dir,
+                            stems[os.path.splitext(path)[0].lower()] > 1)
+            for path in inputs]
+
+
+def _run_job(blender, input_path, output_path, pipeline_path, timeout,
+             work_dir):
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    fd, result_path = tempfile.mkstemp(suffix='.json', dir=work_dir)
+    os.close(fd)
+    command = [
+        blender, '-b', '--factory-startup', '-noaudio',
+        '--python', os.path.abspath(__file__), '--',
+        'worker', input_path, output_path,
+        '--pipeline', pipeline_path, '--result', result_path,
+    ]
+    start = time.perf_counter()
+    try:
+        process = subprocess.run(command, stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT, timeout=timeout)
+        with open(result_path) as result_file:
+            content = result_file.read()
+        if content:
+            result = json.loads(content)
+        else:
+            result = {
+                'input': input_path,
+                'status': 'failed',
+                'error': 'Worker exited with code {}'.format(
+                    process.returncode),
+                'log': process.stdout.decode('utf-8', 'replace')[-4000:],
+            }
+    except subprocess.TimeoutExpired:
+        result = {
+            'input': input_path,
+            'status': 'timeout',
+            'error': 'Timed out after {}s'.format(timeout),
+        }
+    finally:
+        os.remove(result_path)
+    result['wall_time'] = time.perf_counter() - start
+    return result
+
+
+def run_driver(args):
+    blender = find_blender(args.blender)
+    if not blender:
+        print('Blender executable not found, pass --blender')
+        return 2
+
+    pipeline_path = args.pipeline
+    work_dir = tempfile.mkdtemp(prefix='spark_batch_')
+    if pipeline_path is None:
+        pipeline_path = os.path.join(work_dir, 'pipeline.json')
+        with open(pipeline_path, 'w') as pipeline_file:
+            json.dump(DEFAULT_PIPELINE, pipeline_file)
+
+    inputs = collect_inputs(args.input)
+    jobs = args.jobs or os.cpu_count() or 1
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(_run_job, blender, input_path, output_path,
+                            os.path.abspath(pipeline_path), args.timeout,
+                            work_dir)
+            for input_path, output_path in zip(
+                inputs, output_paths_for(inputs, args.input, args.output))]
+        results = []
+        for future in futures:
+            result = future.result()
+            results.append(result)
+            print('[{}] {}'.format(result['status'], result['input']))
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    summary = {
+        'input_dir': args.input,
+        'output_dir': args.output,
+        'jobs': jobs,
+        'elapsed': time.perf_counter() - start,
+        'succeeded': sum(r['status'] == 'succeeded' for r in results),
+        'failed': sum(r['status'] != 'succeeded' for r in results),
+        'results': results,
+    }
+    summary_path = args.summary or os.path.join(args.output, 'results.json')
+    os.makedirs(os.path.dirname(os.path.abspath(summary_path)),
+                exist_ok=True)
+    with open(summary_path, 'w') as summary_file:
+        json.dump(summary, summary_file, indent=2)
+    print('{succeeded} succeeded, {failed} failed'.format(**summary))
+    return 0 if summary['failed'] == 0 else 1
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='spark_batch')
+    subparsers = parser.add_subparsers(dest='command')
+
+    worker = subparsers.add_parser('worker')
+    worker.add_argument('input')
+    worker.add_argument('output')
+    worker.add_argument('--pipeline', required=True)
+    worker.add_argument('--result', required=True)
+
+    driver = subparsers.add_parser('run')
+    driver.add_argument('input')
+    driver.add_argument('output')
+    driver.add_argument('--pipeline')
+    driver.add_argument('--jobs', type=int)
+    driver.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT)
+    driver.add_argument('--summary')
+    driver.add_argument('--blender')
+
+    if argv and argv[0] not in ('worker', 'run', '-h', '--help'):
+        argv = ['run'] + argv
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(_script_args(argv))
+    if args.command == 'worker':
+        return run_worker(args)
+    return run_driver(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
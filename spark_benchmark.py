@@ -0,0 +1,579 @@
+# Copyright (C) Facebook, Inc. and its affiliates
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Copyright (C) 2021 Wendell.Yang
+
+""" Benchmarks of the Spark operators on procedural meshes.
+
+    blender -b --factory-startup -P spark_benchmark.py -- run \\
+        --output results.json [--sizes 10000,100000] [--cases cleanup] \\
+        [--meshes sphere] [--repeat 3] [--baseline old.json]
+
+    python spark_benchmark.py compare old.json new.json [--threshold 0.1]
+
+Every case runs on a freshly generated mesh of each size. The meshes are
+deterministic, so results of two commits can be compared; compare exits
+with 1 when a median time, peak memory, undo memory or decimation error
+grew by more than the threshold.
+
+Undo memory is only measured with a window, as background mode keeps no
+undo history: run the same command without -b to include it.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ADDON_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SIZES = (10000, 100000, 1000000, 5000000)  # unit: triangles
+DEFAULT_REPEAT = 3
+DEFAULT_THRESHOLD = 0.1
+TEXTURE_SIZE = 4096
+MATERIAL_COUNT = 16
+# Source vertices checked against the result of the decimation cases.
+QUALITY_SAMPLES = 2000
+
+
+def _script_args(argv):
+    if '--' in argv:
+        return argv[argv.index('--') + 1:]
+    return argv[1:]
+
+
+# MEMORY
+
+def _read_status_kib(field):
+    try:
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def current_memory():
+    """ Current RSS in bytes, where the OS reports it (Linux)."""
+    current = _read_status_kib('VmRSS')
+    return current * 1024 if current is not None else None
+
+
+def reset_peak_memory():
+    """ Reset the peak RSS of this process where the OS allows it (Linux),
+    and return the current RSS in bytes."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+    return current_memory()
+
+
+def push_undo(message):
+    """ Push an undo step the way the UI does after an operator. Returns
+    False where there is no undo history, as in background mode."""
+    import bpy
+
+    windows = bpy.context.window_manager.windows
+    if not windows:
+        return False
+    with bpy.context.temp_override(window=windows[0],
+                                   screen=windows[0].screen):
+        if not bpy.ops.ed.undo_push.poll():
+            return False
+        bpy.ops.ed.undo_push(message=message)
+    return True
+
+
+def peak_memory():
+    """ Peak RSS in bytes since reset_peak_memory(). Falls back to the
+    peak of the whole process where it cannot be reset."""
+    peak = _read_status_kib('VmHWM')
+    if peak is not None:
+        return peak * 1024
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+# MESHES
+
+def _grid_arrays(triangles, seed, noise):
+    import numpy as np
+
+    side = max(1, int(round((triangles / 2) ** 0.5)))
+    xs, ys = np.meshgrid(np.linspace(-1, 1, side + 1, dtype=np.float32),
+                         np.linspace(-1, 1, side + 1, dtype=np.float32))
+    zs = np.zeros_like(xs)
+    if noise:
+        zs += np.random.RandomState(seed).uniform(
+            -noise, noise, xs.shape).astype(np.float32)
+    co = np.stack((xs, ys, zs), axis=-1).reshape(-1, 3)
+
+    corner = (np.arange(side)[None, :]
+              + (side + 1) * np.arange(side)[:, None]).ravel()
+    quads = np.stack((corner, corner + 1, corner + side + 2,
+                      corner + side + 1), axis=-1).astype(np.int32)
+    uv = (co[quads.ravel(), :2] + 1) / 2
+    return co, quads, uv
+
+
+def _mesh_from_quads(name, co, quads, uv=None):
+    import bpy
+    import numpy as np
+
+    mesh = bpy.data.meshes.new(name)
+    mesh.vertices.add(len(co))
+    mesh.vertices.foreach_set('co', co.ravel())
+    mesh.loops.add(quads.size)
+    mesh.loops.foreach_set('vertex_index', quads.ravel())
+    mesh.polygons.add(len(quads))
+    mesh.polygons.foreach_set(
+        'loop_start', np.arange(0, quads.size, 4, dtype=np.int32))
+    loop_total = mesh.polygons.bl_rna.properties['loop_total']
+    if not loop_total.is_readonly:
+        mesh.polygons.foreach_set(
+            'loop_total', np.full(len(quads), 4, dtype=np.int32))
+    if uv is not None:
+        mesh.uv_layers.new(name='UVMap').data.foreach_set('uv', uv.ravel())
+    mesh.update(calc_edges=True)
+    mesh.validate()
+    return mesh
+
+
+def make_sphere(triangles, seed):
+    """ Icosphere with the subdivision level closest to `triangles`."""
+    import bmesh
+    import bpy
+
+    subdivisions = 1
+    while 20 * 4 ** (subdivisions + 1) <= triangles * 2:
+        subdivisions += 1
+    bm = bmesh.new()
+    if bpy.app.version >= (3, 0, 0):
+        bmesh.ops.create_icosphere(bm, subdivisions=subdivisions,
+                                   radius=1.0)
+    else:
+        bmesh.ops.create_icosphere(bm, subdivisions=subdivisions,
+                                   diameter=1.0)
+    mesh = bpy.data.meshes.new('bench_sphere')
+    bm.to_mesh(mesh)
+    bm.free()
+    return mesh
+
+
+def make_noisy_grid(triangles, seed):
+    co, quads, uv = _grid_arrays(triangles, seed, noise=0.05)
+    return _mesh_from_quads('bench_noisy_grid', co, quads, uv)
+
+
+def make_material_grid(triangles, seed):
+    import bpy
+    import numpy as np
+
+    co, quads, uv = _grid_arrays(triangles, seed, noise=0.0)
+    mesh = _mesh_from_quads('bench_material_grid', co, quads, uv)
+    for index in range(MATERIAL_COUNT):
+        material = bpy.data.materials.new('bench_material_{}'.format(index))
+        material.diffuse_color = (index / MATERIAL_COUNT, 0.5, 0.5, 1.0)
+        mesh.materials.append(material)
+    material_indices = np.random.RandomState(seed).randint(
+        0, MATERIAL_COUNT, len(mesh.polygons)).astype(np.int32)
+    mesh.polygons.foreach_set('material_index', material_indices)
+    return mesh
+
+
+def make_textured_grid(triangles, seed):
+    import bpy
+
+    co, quads, uv = _grid_arrays(triangles, seed, noise=0.01)
+    mesh = _mesh_from_quads('bench_textured_grid', co, quads, uv)
+    image = bpy.data.images.new('bench_texture', TEXTURE_SIZE, TEXTURE_SIZE,
+                                alpha=True)
+    image.generated_type = 'COLOR_GRID'
+    material = bpy.data.materials.new('bench_textured')
+    material.use_nodes = True
+    nodes = material.node_tree.nodes
+    texture = nodes.new('ShaderNodeTexImage')
+    texture.image = image
+    principled = next(node for node in nodes
+                      if node.type == 'BSDF_PRINCIPLED')
+    material.node_tree.links.new(texture.outputs['Color'],
+                                 principled.inputs['Base Color'])
+    mesh.materials.append(material)
+    return mesh
+
+
+MESHES = {
+    'sphere': make_sphere,
+    'noisy_grid': make_noisy_grid,
+    'material_grid': make_material_grid,
+    'textured_grid': make_textured_grid,
+}
+
+
+def reset_scene():
+    import bpy
+
+    bpy.ops.wm.read_homefile(use_empty=True)
+
+
+def create_object(mesh_name, triangles, seed=0):
+    import bpy
+
+    mesh = MESHES[mesh_name](triangles, seed)
+    obj = bpy.data.objects.new(mesh.name, mesh)
+    bpy.context.scene.collection.objects.link(obj)
+    obj.select_set(True)
+    bpy.context.view_layer.objects.active = obj
+    return obj
+
+
+# CASES
+
+class _NullLayout(object):
+    """ Stand-in for a UI layout; accepts and ignores every call."""
+
+    def __getattr__(self, name):
+        return self
+
+    def __setattr__(self, name, value):
+        pass
+
+    def __call__(self, *args, **kwargs):
+        return self
+
+
+def _panel_probe(addon):
+    """ Plain object carrying the panel's drawing methods, which can be
+    called without a region to draw in."""
+    panel = addon.sparkar_panel.PANEL0_PT_SparkAR_Panel
+    namespace = {}
+    for klass in reversed(panel.__mro__):
+        if klass.__module__.startswith(addon.__name__):
+            namespace.update(vars(klass))
+    namespace.pop('__dict__', None)
+    namespace.pop('__weakref__', None)
+    return type('PanelProbe', (object,), namespace)()
+
+
+def _screen_override():
+    import bpy
+
+    return bpy.context.temp_override(screen=bpy.data.screens[0])
+
+
+def case_cleanup(context, obj, addon):
+    import bpy
+
+    return lambda: bpy.ops.object.spark_mesh_cleanup()
+
+
+def case_decimation(context, obj, addon):
+    import bpy
+
+    obj.sparkar_optimization.InvertedReducePercentage = 50
+    return lambda: bpy.ops.object.spark_decimation()
+
+
+def case_decimation_quadric(context, obj, addon):
+    import bpy
+
+    obj.sparkar_optimization.DecimationEngine = 'QUADRIC'
+    obj.sparkar_optimization.InvertedReducePercentage = 50
+    return lambda: bpy.ops.object.spark_decimation()
+
+
+def case_resize(context, obj, addon):
+    import bpy
+
+    def run():
+        with _screen_override():
+            settings = bpy.context.screen.sparkar_scale
+            settings.resizeUnit = 'cm'
+            # Setting the height only previews the resize; the bake timer
+            # never fires inside a script, so bake it here.
+            settings.height = 20
+        addon.spark_operators_scale.bake_pending_resize(push_undo=False)
+    return run
+
+
+def case_pivot_bottom(context, obj, addon):
+    import bpy
+
+    return lambda: bpy.ops.object.spark_pivot_bottom()
+
+
+def case_tri_count_summary(context, obj, addon):
+    probe = _panel_probe(addon)
+    layout = _NullLayout()
+
+    def run():
+        addon.spark_mesh_stats.clear_all_caches()
+        probe._draw_tri_count_summary(context, layout)
+    return run
+
+
+def case_export(context, obj, addon):
+    import bpy
+
+    directory = tempfile.mkdtemp(prefix='spark_benchmark_')
+    filepath = os.path.join(directory, 'export.glb')
+    return lambda: bpy.ops.object.export_for_spark_ar(
+        filepath=filepath, use_export_cache=False)
+
+
+CASES = {
+    'cleanup': case_cleanup,
+    'decimation': case_decimation,
+    'decimation_quadric': case_decimation_quadric,
+    'resize': case_resize,
+    'pivot_bottom': case_pivot_bottom,
+    'tri_count_summary': case_tri_count_summary,
+    'export': case_export,
+}
+
+
+# Cases whose result is compared with the source surface.
+QUALITY_CASES = {'decimation', 'decimation_quadric'}
+
+
+def _quality_samples(obj):
+    import numpy as np
+
+    positions = np.empty(len(obj.data.vertices) * 3, dtype=np.float32)
+    obj.data.vertices.foreach_get('co', positions)
+    positions = positions.reshape(-1, 3)
+    step = max(1, len(positions) // QUALITY_SAMPLES)
+    diagonal = float(np.linalg.norm(positions.max(axis=0)
+                                    - positions.min(axis=0)))
+    return positions[::step].tolist(), diagonal
+
+
+def surface_error(obj, samples, diagonal):
+    """ Mean and largest distance from source vertices to the decimated
+    surface, relative to the bounding box diagonal."""
+    import bpy
+    from mathutils.bvhtree import BVHTree
+
+    tree = BVHTree.FromObject(obj, bpy.context.evaluated_depsgraph_get())
+    distances = [tree.find_nearest(point)[3] for point in samples]
+    distances = [distance / diagonal for distance in distances
+                 if distance is not None]
+    return statistics.mean(distances), max(distances)
+
+
+def run_case(addon, case_name, mesh_name, triangles, repeat):
+    import bpy
+
+    times = []
+    peaks = []
+    undo_sizes = []
+    errors = []
+    actual_triangles = None
+    result_triangles = None
+    for _ in range(repeat):
+        reset_scene()
+        obj = create_object(mesh_name, triangles)
+        context = bpy.context
+        actual_triangles = addon.spark_mesh_stats.count_mesh_triangles(
+            obj.data)
+        run = CASES[case_name](context, obj, addon)
+        if case_name in QUALITY_CASES:
+            samples = _quality_samples(obj)
+
+        undo = push_undo('Benchmark setup')
+        baseline = reset_peak_memory()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+        peak = peak_memory()
+        if peak is not None and baseline is not None:
+            peaks.append(max(0, peak - baseline))
+        # What one click leaves behind: the memory the undo step of the
+        # case still holds once it has been pushed.
+        if undo and push_undo(case_name) and baseline is not None:
+            undo_sizes.append(max(0, current_memory() - baseline))
+        if case_name in QUALITY_CASES:
+            errors.append(surface_error(obj, *samples))
+            result_triangles = addon.spark_mesh_stats.count_mesh_triangles(
+                obj.data)
+
+    return {
+        'case': case_name,
+        'mesh': mesh_name,
+        'size': triangles,
+        'triangles': actual_triangles,
+        'times': times,
+        'median': statistics.median(times),
+        'min': min(times),
+        'peak_memory': max(peaks) if peaks else None,
+        'undo_memory': max(undo_sizes) if undo_sizes else None,
+        'result_triangles': result_triangles,
+        'error_mean': (statistics.mean(error for error, _ in errors)
+                       if errors else None),
+        'error_max': max(error for _, error in errors) if errors else None,
+    }
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=ADDON_DIR,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(args):
+    import bpy
+
+    sys.path.insert(0, ADDON_DIR)
+    from spark_batch import load_addon
+
+    addon = load_addon()
+    for module in ('sparkar_panel', 'spark_mesh_stats'):
+        __import__(addon.__name__ + '.' + module)
+
+    results = []
+    for size in args.sizes:
+        for mesh_name in args.meshes:
+            for case_name in args.cases:
+                try:
+                    result = run_case(addon, case_name, mesh_name, size,
+                                      args.repeat)
+                except Exception as error:
+                    result = {'case': case_name, 'mesh': mesh_name,
+                              'size': size, 'error': str(error)}
+                results.append(result)
+                print('{case:>18} {mesh:>14} {size:>9} {status}'.format(
+                    status=('{:.4f}s'.format(result['median'])
+                            if 'median' in result else result['error']),
+                    **result))
+
+    report = {
+        'revision': _git_revision(),
+        'blender': bpy.app.version_string,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': args.repeat,
+        'results': results,
+    }
+    with open(args.output, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            return print_comparison(json.load(baseline_file), report,
+                                    args.threshold)
+    return 0
+
+
+# COMPARISON
+
+def _result_key(result):
+    return result['case'], result['mesh'], result['size']
+
+
+def compare_reports(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """ List the (key, metric, old, new) entries that got worse by more
+    than `threshold`, as a fraction of the baseline."""
+    previous = {_result_key(result): result
+                for result in baseline['results'] if 'median' in result}
+    regressions = []
+    for result in current['results']:
+        old = previous.get(_result_key(result))
+        if old is None or 'median' not in result:
+            continue
+        for metric in ('median', 'peak_memory', 'undo_memory',
+                       'error_mean'):
+            if not old.get(metric) or result.get(metric) is None:
+                continue
+            if result[metric] > old[metric] * (1 + threshold):
+                regressions.append((_result_key(result), metric,
+                                    old[metric], result[metric]))
+    return regressions
+
+
+def print_comparison(baseline, current, threshold):
+    regressions = compare_reports(baseline, current, threshold)
+    for (case, mesh, size), metric, old, new in regressions:
+        print('REGRESSION {} {} {} {}: {:.4g} -> {:.4g} ({:+.1%})'.format(
+            case, mesh, size, metric, old, new, new / old - 1))
+    print('{} regressions over {:.0%} ({} -> {})'.format(
+        len(regressions), threshold, baseline.get('revision'),
+        current.get('revision')))
+    return 1 if regressions else 0
+
+
+def parse_args(argv):
+    def names(choices):
+        def parse(value):
+            values = value.split(',')
+            for name in values:
+                if name not in choices:
+                    raise argparse.ArgumentTypeError(
+                        'unknown name: ' + name)
+            return values
+        return parse
+
+    parser = argparse.ArgumentParser(prog='spark_benchmark')
+    subparsers = parser.add_subparsers(dest='command')
+
+    run = subparsers.add_parser('run')
+    run.add_argument('--output', default='benchmark.json')
+    run.add_argument('--sizes', default=list(DEFAULT_SIZES),
+                     type=lambda value: [int(size)
+                                         for size in value.split(',')])
+    run.add_argument('--cases', default=list(CASES), type=names(CASES))
+    run.add_argument('--meshes', default=list(MESHES), type=names(MESHES))
+    run.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    run.add_argument('--baseline')
+    run.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+
+    compare = subparsers.add_parser('compare')
+    compare.add_argument('baseline')
+    compare.add_argument('current')
+    compare.add_argument('--threshold', type=float,
+                         default=DEFAULT_THRESHOLD)
+
+    if not argv or argv[0] not in ('run', 'compare', '-h', '--help'):
+        argv = ['run'] + list(argv)
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(_script_args(argv))
+    if args.command == 'compare':
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        with open(args.current) as current_file:
+            current = json.load(current_file)
+        return print_comparison(baseline, current, args.threshold)
+    return run_benchmarks(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
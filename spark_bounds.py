@@ -0,0 +1,64 @@
+# Copyright (C) Facebook, Inc. and its affiliates
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+from mathutils import Vector
+
+from .spark_mesh_stats import ObjectStatsCache
+
+# Object types whose evaluated geometry can be read through to_mesh().
+GEOMETRY_TYPES = {'MESH', 'CURVE', 'SURFACE', 'FONT', 'META'}
+
+
+def read_evaluated_coordinates(obj, depsgraph):
+    """ World-space vertex coordinates of the evaluated geometry of obj,
+    modifiers included, as an (n, 3) array."""
+    if obj.type not in GEOMETRY_TYPES:
+        return np.empty((0, 3))
+    evaluated = obj.evaluated_get(depsgraph)
+    if obj.type == 'MESH':
+        mesh = evaluated.data
+    else:
+        mesh = evaluated.to_mesh()
+    try:
+        co = np.empty(len(mesh.vertices) * 3, dtype=np.float64)
+        mesh.vertices.foreach_get('co', co)
+    finally:
+        if obj.type != 'MESH':
+            evaluated.to_mesh_clear()
+    matrix = np.array(obj.matrix_world)
+    return co.reshape(-1, 3) @ matrix[:3, :3].T + matrix[:3, 3]
+
+
+def _compute_world_aabb(obj, depsgraph):
+    co = read_evaluated_coordinates(obj, depsgraph)
+    if len(co) == 0:
+        return None
+    return co.min(axis=0), co.max(axis=0)
+
+
+world_aabb_cache = ObjectStatsCache(_compute_world_aabb,
+                                    track_transform=True)
+
+
+def get_world_bounds(context, objects):
+    """ World-space bounding box of the evaluated geometry of the objects,
+    as (min, max) corners."""
+    bounds = [world_aabb_cache.get(context, obj) for obj in objects]
+    bounds = [bound for bound in bounds if bound is not None]
+    if not bounds:
+        return Vector((0, 0, 0)), Vector((0, 0, 0))
+    return (Vector(np.min([low for low, _ in bounds], axis=0)),
+            Vector(np.max([high for _, high in bounds], axis=0)))
@@ -0,0 +1,164 @@
+# Copyright (C) Facebook, Inc. and its affiliates
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+
+import bpy
+import numpy as np
+
+from .spark_glb_writer import split_mesh_vertices
+from .spark_mesh_stats import ObjectStatsCache
+from .spark_operators_optimization import (
+    TRIS_COUNT_ERROR,
+    TRIS_COUNT_WARNING,
+)
+from .spark_textures import collect_images
+
+# (warning, error) thresholds of each budget metric.
+BUDGET_LIMITS = {
+    'triangles': (TRIS_COUNT_WARNING, TRIS_COUNT_ERROR),
+    'gpu_vertices': (45000, 75000),
+    'draw_calls': (8, 16),
+    'texture_memory': (32 * 1024 * 1024, 64 * 1024 * 1024),  # unit: bytes
+    'gpu_memory': (48 * 1024 * 1024, 96 * 1024 * 1024),  # unit: bytes
+    'download_size': (4 * 1024 * 1024, 8 * 1024 * 1024),  # unit: bytes
+}
+
+POSITION_SIZE = 12  # unit: bytes per vertex
+NORMAL_SIZE = 12
+TEXCOORD_SIZE = 8
+COLOR_SIZE = 8
+GLB_OVERHEAD = 2048  # unit: bytes, header and JSON chunk
+GLB_OBJECT_OVERHEAD = 512  # unit: bytes per node, mesh and accessors
+# Share of the raw RGBA size an unsaved image takes once encoded as PNG.
+IMAGE_COMPRESSION_ESTIMATE = 0.5
+
+
+def _color_layer_count(mesh):
+    if hasattr(mesh, 'color_attributes'):
+        return len(mesh.color_attributes)
+    return len(mesh.vertex_colors)
+
+
+def _compute_mesh_cost(obj, depsgraph):
+    """ Geometry cost of obj as drawn: split vertices per material, draw
+    calls and buffer sizes, from a single read of the evaluated mesh."""
+    obj_eval = obj.evaluated_get(depsgraph)
+    mesh = obj_eval.to_mesh()
+    try:
+        split = split_mesh_vertices(mesh)
+        stride = (POSITION_SIZE + NORMAL_SIZE
+                  + TEXCOORD_SIZE * len(mesh.uv_layers)
+                  + COLOR_SIZE * _color_layer_count(mesh))
+        vertices = len(mesh.vertices)
+    finally:
+        obj_eval.to_mesh_clear()
+
+    triangle_materials = split['triangle_materials']
+    triangles = len(triangle_materials)
+    # Every material is its own primitive, so vertices shared between
+    # materials are stored once per material.
+    corners = split['loop_to_vertex'][split['triangle_loops']].astype(
+        np.int64)
+    corner_keys = (triangle_materials.astype(np.int64)[:, None]
+                   * (len(split['first_loop']) + 1) + corners)
+    gpu_vertices = len(np.unique(corner_keys))
+    draw_calls = len(np.unique(triangle_materials))
+    index_size = 2 if gpu_vertices < 65536 else 4
+    return {
+        'triangles': triangles,
+        'vertices': vertices,
+        'gpu_vertices': gpu_vertices,
+        'draw_calls': draw_calls,
+        'vertex_bytes': gpu_vertices * stride,
+        'index_bytes': triangles * 3 * index_size,
+    }
+
+
+mesh_cost_cache = ObjectStatsCache(_compute_mesh_cost)
+
+
+def image_cost(image):
+    """ (gpu_bytes, file_bytes) of an image: RGBA8 with a full mip chain
+    on the GPU, and its encoded size in the GLB."""
+    width, height = image.size
+    gpu_bytes = width * height * 4 * 4 // 3
+    if image.packed_file:
+        file_bytes = image.packed_file.size
+    else:
+        path = bpy.path.abspath(image.filepath_raw)
+        if image.filepath_raw and os.path.isfile(path):
+            file_bytes = os.path.getsize(path)
+        else:
+            file_bytes = int(width * height * 4 * IMAGE_COMPRESSION_ESTIMATE)
+    return gpu_bytes, file_bytes
+
+
+def _compute_image_costs(obj, depsgraph):
+    """ (size, gpu_bytes, file_bytes) of every image obj uses, by name."""
+    return {image.name: (list(image.size),) + image_cost(image)
+            for image in collect_images([obj])}
+
+
+image_cost_cache = ObjectStatsCache(_compute_image_costs,
+                                    track_materials=True)
+
+
+def budget_status(metric, value):
+    warning, error = BUDGET_LIMITS[metric]
+    if value >= error:
+        return 'ERROR'
+    if value >= warning:
+        return 'WARNING'
+    return 'OK'
+
+
+def analyze_objects(context, objects):
+    """ Cost report of exporting `objects` together: per-object geometry,
+    per-image texture cost and the totals checked against BUDGET_LIMITS."""
+    report = {'objects': {}, 'images': {}}
+    totals = dict.fromkeys(('triangles', 'vertices', 'gpu_vertices',
+                            'draw_calls', 'vertex_bytes', 'index_bytes'), 0)
+    for obj in objects:
+        cost = mesh_cost_cache.get(context, obj)
+        report['objects'][obj.name] = dict(cost)
+        for key in totals:
+            totals[key] += cost[key]
+
+    # Images shared between objects are counted once.
+    images = {}
+    for obj in objects:
+        images.update(image_cost_cache.get(context, obj))
+    texture_memory = 0
+    texture_bytes = 0
+    for name, (size, gpu_bytes, file_bytes) in images.items():
+        report['images'][name] = {
+            'size': list(size),
+            'gpu_bytes': gpu_bytes,
+            'file_bytes': file_bytes,
+        }
+        texture_memory += gpu_bytes
+        texture_bytes += file_bytes
+
+    geometry_bytes = totals['vertex_bytes'] + totals['index_bytes']
+    totals['texture_memory'] = texture_memory
+    totals['gpu_memory'] = geometry_bytes + texture_memory
+    totals['download_size'] = (GLB_OVERHEAD
+                               + GLB_OBJECT_OVERHEAD * len(objects)
+                               + geometry_bytes + texture_bytes)
+    report['totals'] = totals
+    report['status'] = {metric: budget_status(metric, totals[metric])
+                        for metric in BUDGET_LIMITS}
+    return report
@@ -0,0 +1,563 @@
+# Copyright (C) Facebook, Inc. and its affiliates
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import heapq
+import itertools
+import operator
+import threading
+
+import bmesh
+import numpy as np
+
+# Bisection steps on the cluster size when searching for a triangle count.
+CLUSTER_SEARCH_STEPS = 16
+
+# Weight of the constraint planes keeping feature edges in place, relative
+# to the area-weighted face planes.
+BOUNDARY_WEIGHT = 100.0
+SEAM_WEIGHT = 10.0
+MATERIAL_BORDER_WEIGHT = 10.0
+SHARP_EDGE_WEIGHT = 10.0
+SHARP_ANGLE = 1.0471976  # unit: radians
+UV_SEAM_TOLERANCE = 1e-5
+REGULARIZATION_WEIGHT = 1e-6
+# Collapses between two checks of the cancel event.
+CANCEL_CHECK_INTERVAL = 512
+
+
+class DecimationCancelled(Exception):
+    pass
+
+
+# MESH ARRAYS
+#
+# Reading and writing happen on the main thread; everything in between only
+# touches the NumPy copies, so it can run on a worker thread.
+
+def read_mesh_arrays(mesh):
+    """ Copy the triangulated geometry and per-corner attributes of mesh."""
+    mesh.calc_loop_triangles()
+    vertex_count = len(mesh.vertices)
+    triangle_count = len(mesh.loop_triangles)
+
+    positions = np.empty(vertex_count * 3, dtype=np.float32)
+    mesh.vertices.foreach_get('co', positions)
+    loop_vertices = np.empty(len(mesh.loops), dtype=np.int32)
+    mesh.loops.foreach_get('vertex_index', loop_vertices)
+    triangle_loops = np.empty(triangle_count * 3, dtype=np.int32)
+    mesh.loop_triangles.foreach_get('loops', triangle_loops)
+    triangle_loops = triangle_loops.reshape(-1, 3)
+    materials = np.empty(triangle_count, dtype=np.int32)
+    mesh.loop_triangles.foreach_get('material_index', materials)
+
+    uv_layers = []
+    for uv_layer in mesh.uv_layers:
+        uvs = np.empty(len(mesh.loops) * 2, dtype=np.float32)
+        uv_layer.data.foreach_get('uv', uvs)
+        uv_layers.append((uv_layer.name, uvs.reshape(-1, 2)))
+
+    return {
+        'positions': positions.reshape(-1, 3),
+        'triangles': loop_vertices[triangle_loops],
+        # Attributes live on the corners of the source triangles, so the
+        # kept triangles carry them over unchanged.
+        'corner_loops': triangle_loops,
+        'materials': materials,
+        'uv_layers': uv_layers,
+        # Source vertex every vertex of the arrays stands for.
+        'source_vertices': np.arange(vertex_count),
+    }
+
+
+def write_mesh_arrays(mesh, arrays):
+    """ Replace the faces of mesh with decimated arrays in one step.
+
+    The triangles are rebuilt in a BMesh of the source mesh from the
+    vertices and corners they were decimated from, so vertex groups,
+    attributes of every domain, custom normals and the flags of surviving
+    edges come along, as with the decimate modifier.
+    """
+    bm = bmesh.new()
+    try:
+        bm.from_mesh(mesh)
+        bm.verts.ensure_lookup_table()
+        source_faces = list(bm.faces)
+        # BMesh keeps the face and corner order of the mesh.
+        source_loops = [loop for face in source_faces for loop in face.loops]
+        verts = [bm.verts[index]
+                 for index in arrays['source_vertices'].tolist()]
+        for vert, position in zip(verts, arrays['positions'].tolist()):
+            vert.co = position
+
+        faces = set()
+        for triangle, corners in zip(arrays['triangles'].tolist(),
+                                     arrays['corner_loops'].tolist()):
+            face_verts = [verts[index] for index in triangle]
+            try:
+                face = bm.faces.new(face_verts,
+                                    source_loops[corners[0]].face)
+            except ValueError:
+                # A source face on the same vertices, e.g. a triangle the
+                # decimation left alone, is kept with its data.
+                faces.add(bm.faces.get(face_verts))
+                continue
+            faces.add(face)
+            for loop, corner in zip(face.loops, corners):
+                loop.copy_from(source_loops[corner])
+
+        bmesh.ops.delete(bm, geom=[face for face in source_faces
+                                   if face not in faces],
+                         context='FACES_ONLY')
+        bmesh.ops.delete(bm, geom=[edge for edge in bm.edges
+                                   if not edge.link_faces],
+                         context='EDGES')
+        bmesh.ops.delete(bm, geom=[vert for vert in bm.verts
+                                   if not vert.link_edges],
+                         context='VERTS')
+        bm.to_mesh(mesh)
+    finally:
+        bm.free()
+    mesh.update()
+
+
+# VERTEX CLUSTERING
+
+def _cluster_vertices(positions, cell_size):
+    """ Cluster of every vertex on a uniform grid, and cluster centers."""
+    cells = np.floor((positions - positions.min(axis=0)) / cell_size)\
+        .astype(np.int64)
+    dims = cells.max(axis=0) + 1
+    keys = (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+    _, clusters, counts = np.unique(keys, return_inverse=True,
+                                    return_counts=True)
+    clusters = clusters.ravel()
+    centers = np.stack([np.bincount(clusters, weights=positions[:, axis])
+                        for axis in range(3)], axis=-1) / counts[:, None]
+    return clusters, centers
+
+
+def _collapse(triangles, clusters):
+    """ Indices of the triangles that survive clustering: corners in three
+    different clusters, one per set of clusters."""
+    collapsed = clusters[triangles]
+    keep = ((collapsed[:, 0] != collapsed[:, 1])
+            & (collapsed[:, 1] != collapsed[:, 2])
+            & (collapsed[:, 2] != collapsed[:, 0]))
+    kept = np.flatnonzero(keep)
+    _, first = np.unique(np.sort(collapsed[kept], axis=1), axis=0,
+                         return_index=True)
+    return np.sort(kept[first])
+
+
+def cluster_decimate(arrays, target_triangles, progress=None, cancel=None):
+    """ Reduce the arrays to at most target_triangles by merging vertices
+    on a uniform grid, searching the grid size by bisection.
+
+    progress(fraction) is called after every step, and the search stops
+    with DecimationCancelled once the cancel event is set.
+    """
+    positions = arrays['positions']
+    triangles = arrays['triangles']
+    if len(triangles) <= target_triangles or len(positions) == 0:
+        return arrays
+
+    extent = float(np.max(positions.max(axis=0) - positions.min(axis=0)))
+    low, high = 0.0, max(extent, 1e-9)
+    best = None
+    for step in range(CLUSTER_SEARCH_STEPS):
+        if cancel is not None and cancel.is_set():
+            raise DecimationCancelled()
+        cell_size = (low + high) / 2
+        clusters, centers = _cluster_vertices(positions, cell_size)
+        kept = _collapse(triangles, clusters)
+        if len(kept) <= target_triangles:
+            high = cell_size
+            best = (clusters, centers, kept)
+        else:
+            low = cell_size
+        if progress is not None:
+            progress((step + 1) / CLUSTER_SEARCH_STEPS)
+    if best is None:
+        clusters, centers = _cluster_vertices(positions, high)
+        best = (clusters, centers, _collapse(triangles, clusters))
+
+    clusters, centers, kept = best
+    # Drop clusters no kept triangle uses and renumber the rest. The first
+    # vertex of a cluster carries its vertex data.
+    used, triangles = np.unique(clusters[triangles[kept]],
+                                return_inverse=True)
+    _, representatives = np.unique(clusters, return_index=True)
+    result = dict(arrays)
+    result.update({
+        'positions': centers[used],
+        'source_vertices': arrays['source_vertices'][representatives[used]],
+        'triangles': triangles.reshape(-1, 3),
+        'corner_loops': arrays['corner_loops'][kept],
+        'materials': arrays['materials'][kept],
+    })
+    return result
+
+
+# QUADRIC ERROR METRIC
+
+def _face_planes(positions, triangles):
+    """ Unit normals, plane offsets and areas of the triangles."""
+    corners = positions[triangles]
+    normals = np.cross(corners[:, 1] - corners[:, 0],
+                       corners[:, 2] - corners[:, 0])
+    lengths = np.linalg.norm(normals, axis=1)
+    areas = lengths / 2
+    normals = normals / np.maximum(lengths, 1e-20)[:, None]
+    offsets = -np.einsum('ij,ij->i', normals, corners[:, 0])
+    return normals, offsets, areas
+
+
+def _plane_quadrics(normals, offsets, weights):
+    planes = np.concatenate((normals, offsets[:, None]), axis=1)
+    return weights[:, None, None] * planes[:, :, None] * planes[:, None, :]
+
+
+def _edge_pairs(arrays):
+    """ Half edges of the triangles, grouped by undirected edge. Returns
+    the edge vertex pairs and, per pair, one or two triangle corners."""
+    triangles = arrays['triangles']
+    corner_loops = arrays['corner_loops']
+    count = len(triangles)
+    starts = triangles.ravel()
+    ends = triangles[:, [1, 2, 0]].ravel()
+    start_loops = corner_loops.ravel()
+    end_loops = corner_loops[:, [1, 2, 0]].ravel()
+    low = np.minimum(starts, ends).astype(np.int64)
+    high = np.maximum(starts, ends).astype(np.int64)
+    keys = low * (int(max(triangles.max(initial=0), 0)) + 1) + high
+    order = np.argsort(keys, kind='stable')
+    _, first, counts = np.unique(keys[order], return_index=True,
+                                 return_counts=True)
+    return {
+        'order': order,
+        'first': first,
+        'counts': counts,
+        'vertices': np.stack((low[order[first]], high[order[first]]), -1),
+        'starts': starts,
+        'ends': ends,
+        'start_loops': start_loops,
+        'end_loops': end_loops,
+        'faces': np.repeat(np.arange(count), 3),
+    }
+
+
+def feature_edge_quadrics(arrays, positions, normals):
+    """ Quadrics of the planes through feature edges, perpendicular to
+    their faces: boundaries, UV seams, material borders and sharp edges.
+    Returns (vertex_pairs, quadrics) to add to both ends of each edge."""
+    edges = _edge_pairs(arrays)
+    order, first, counts = edges['order'], edges['first'], edges['counts']
+    half = order[first]
+    weights = np.where(counts == 1, BOUNDARY_WEIGHT, 0.0)
+
+    # Manifold edges: compare the two faces on either side.
+    paired = np.flatnonzero(counts == 2)
+    a = order[first[paired]]
+    b = order[first[paired] + 1]
+    face_a = edges['faces'][a]
+    face_b = edges['faces'][b]
+    material_border = arrays['materials'][face_a] != \
+        arrays['materials'][face_b]
+    cosines = np.einsum('ij,ij->i', normals[face_a], normals[face_b])
+    sharp = cosines < np.cos(SHARP_ANGLE)
+    seam = np.zeros(len(paired), dtype=bool)
+    same_direction = edges['starts'][a] == edges['starts'][b]
+    loops_b_start = np.where(same_direction, edges['start_loops'][b],
+                             edges['end_loops'][b])
+    loops_b_end = np.where(same_direction, edges['end_loops'][b],
+                           edges['start_loops'][b])
+    for _, uvs in arrays['uv_layers']:
+        seam |= np.any(np.abs(uvs[edges['start_loops'][a]]
+                              - uvs[loops_b_start]) > UV_SEAM_TOLERANCE, 1)
+        seam |= np.any(np.abs(uvs[edges['end_loops'][a]]
+                              - uvs[loops_b_end]) > UV_SEAM_TOLERANCE, 1)
+    weights[paired] = np.maximum.reduce((
+        np.where(seam, SEAM_WEIGHT, 0.0),
+        np.where(material_border, MATERIAL_BORDER_WEIGHT, 0.0),
+        np.where(sharp, SHARP_EDGE_WEIGHT, 0.0),
+    ))
+
+    features = np.flatnonzero(weights > 0)
+    half = half[features]
+    start = positions[edges['starts'][half]]
+    direction = positions[edges['ends'][half]] - start
+    length = np.linalg.norm(direction, axis=1)
+    plane_normals = np.cross(direction, normals[edges['faces'][half]])
+    plane_normals /= np.maximum(np.linalg.norm(plane_normals, axis=1),
+                                1e-20)[:, None]
+    offsets = -np.einsum('ij,ij->i', plane_normals, start)
+    quadrics = _plane_quadrics(plane_normals, offsets,
+                               weights[features] * length ** 2)
+    return edges['vertices'][features], quadrics
+
+
+def _quadric_components(quadrics):
+    """ The ten distinct entries of symmetric 4x4 quadrics, row by row."""
+    rows, columns = np.triu_indices(4)
+    return quadrics[:, rows, columns]
+
+
+def _quadric_error(q, x, y, z):
+    return (q[0] * x * x + 2 * q[1] * x * y + 2 * q[2] * x * z
+            + 2 * q[3] * x + q[4] * y * y + 2 * q[5] * y * z
+            + 2 * q[6] * y + q[7] * z * z + 2 * q[8] * z + q[9])
+
+
+def _collapse_target(q, position_a, position_b):
+    """ Error and position minimizing the quadric q. Falls back to the
+    best of the ends and midpoint when the system is ill-conditioned.
+
+    Plain float arithmetic: this runs once per heap entry, where NumPy
+    call overhead would dominate.
+    """
+    a, b, c, d = q[0], q[1], q[2], q[3]
+    e, f, g = q[4], q[5], q[6]
+    h, i = q[7], q[8]
+    cofactor_x = e * h - f * f
+    cofactor_y = f * c - b * h
+    cofactor_z = b * f - e * c
+    det = a * cofactor_x + b * cofactor_y + c * cofactor_z
+    # Relative to the magnitude of the quadric, which scales with area.
+    if abs(det) > 1e-9 * (a + e + h) ** 3:
+        # Cramer's rule on the upper 3x3 block, right hand side -(d, g, i).
+        x = -(d * cofactor_x + g * cofactor_y + i * cofactor_z) / det
+        y = -(a * (g * h - i * f) - d * (b * h - c * f)
+              + c * (b * i - c * g)) / det
+        z = -(a * (e * i - f * g) - b * (b * i - c * g)
+              + d * (b * f - c * e)) / det
+        return _quadric_error(q, x, y, z), (x, y, z)
+    midpoint = tuple((u + v) / 2 for u, v in zip(position_a, position_b))
+    return min((_quadric_error(q, *position), position)
+               for position in (position_a, position_b, midpoint))
+
+
+def _normal(p0, p1, p2):
+    ux, uy, uz = p1[0] - p0[0], p1[1] - p0[1], p1[2] - p0[2]
+    vx, vy, vz = p2[0] - p0[0], p2[1] - p0[1], p2[2] - p0[2]
+    return uy * vz - uz * vy, uz * vx - ux * vz, ux * vy - uy * vx
+
+
+def _flips(positions, triangles, faces, vertex, position, ignore):
+    """ Whether moving vertex to position flips or collapses one of its
+    faces that survive the collapse."""
+    for face in faces:
+        if face in ignore:
+            continue
+        corners = [positions[index] for index in triangles[face]]
+        before = _normal(*corners)
+        corners[triangles[face].index(vertex)] = position
+        after = _normal(*corners)
+        if (before[0] * after[0] + before[1] * after[1]
+                + before[2] * after[2]) <= 0:
+            return True
+    return False
+
+
+def quadric_decimate(arrays, target_triangles, progress=None, cancel=None):
+    """ Reduce the arrays to at most target_triangles with quadric error
+    edge collapses, cheapest first from a heap.
+
+    Face quadrics are area weighted; boundaries, UV seams, material
+    borders and sharp edges get extra constraint planes so they survive
+    longer. Kept triangles keep their source corners and vertices, so UVs
+    and other attributes come along unchanged.
+    """
+    source_positions = arrays['positions']
+    if (len(arrays['triangles']) <= target_triangles
+            or len(source_positions) == 0):
+        return arrays
+
+    # Work in a unit box so the error and determinant thresholds do not
+    # depend on the scale of the model.
+    center = (source_positions.max(axis=0)
+              + source_positions.min(axis=0)) / 2
+    scale = max(float(np.max(source_positions.max(axis=0)
+                             - source_positions.min(axis=0))), 1e-9)
+    unit_positions = (source_positions.astype(np.float64) - center) / scale
+    source_triangles = arrays['triangles'].astype(np.int64)
+
+    # The quadrics are built with NumPy, the collapses run on lists.
+    normals, offsets, areas = _face_planes(unit_positions, source_triangles)
+    vertex_quadrics = np.zeros((len(unit_positions), 4, 4))
+    face_quadrics = _plane_quadrics(normals, offsets, areas)
+    for corner in range(3):
+        np.add.at(vertex_quadrics, source_triangles[:, corner],
+                  face_quadrics)
+    pairs, edge_quadrics = feature_edge_quadrics(arrays, unit_positions,
+                                                 normals)
+    np.add.at(vertex_quadrics, pairs[:, 0], edge_quadrics)
+    np.add.at(vertex_quadrics, pairs[:, 1], edge_quadrics)
+    # A weak pull towards the source position of each vertex, so flat
+    # regions, where every collapse is free, shrink evenly instead of
+    # fanning into a few vertices of very high valence.
+    weight = REGULARIZATION_WEIGHT * float(areas.mean())
+    vertex_quadrics[:, :3, :3] += weight * np.eye(3)
+    vertex_quadrics[:, :3, 3] -= weight * unit_positions
+    vertex_quadrics[:, 3, :3] -= weight * unit_positions
+    vertex_quadrics[:, 3, 3] += weight * np.einsum(
+        'ij,ij->i', unit_positions, unit_positions)
+    quadrics = [tuple(q) for q in
+                _quadric_components(vertex_quadrics).tolist()]
+    positions = [tuple(position) for position in unit_positions.tolist()]
+    triangles = source_triangles.tolist()
+
+    vertex_faces = [set() for _ in range(len(positions))]
+    for face, corners in enumerate(triangles):
+        for vertex in corners:
+            vertex_faces[vertex].add(face)
+    versions = [0] * len(positions)
+    alive = [True] * len(triangles)
+    alive_count = len(triangles)
+    sequence = itertools.count()
+
+    def entry(a, b):
+        q = tuple(map(operator.add, quadrics[a], quadrics[b]))
+        error, position = _collapse_target(q, positions[a], positions[b])
+        # The sequence number breaks ties before the position is reached.
+        return (error, next(sequence), a, b, versions[a], versions[b],
+                position)
+
+    heap = [entry(a, b) for a, b in _edge_pairs(arrays)['vertices'].tolist()]
+    heapq.heapify(heap)
+
+    def ring(vertex):
+        return {corner for face in vertex_faces[vertex]
+                for corner in triangles[face]}
+
+    collapses = 0
+    to_remove = len(triangles) - target_triangles
+    while heap and alive_count > target_triangles:
+        _, _, a, b, version_a, version_b, position = heapq.heappop(heap)
+        if versions[a] != version_a or versions[b] != version_b:
+            continue
+        shared = vertex_faces[a] & vertex_faces[b]
+        if not shared:
+            continue
+        # Link condition: the only vertices next to both ends are the
+        # opposite corners of the shared faces, or the surface would
+        # pinch into a non-manifold edge.
+        opposite = {corner for face in shared for corner in triangles[face]}
+        if (ring(a) & ring(b)) - opposite:
+            continue
+        if (_flips(positions, triangles, vertex_faces[a], a, position,
+                   shared)
+                or _flips(positions, triangles, vertex_faces[b], b,
+                          position, shared)):
+            continue
+
+        # Collapse b into a. Only the edges around a change cost; the
+        # version bumps make the stale heap entries of a and b skip.
+        positions[a] = position
+        quadrics[a] = tuple(map(operator.add, quadrics[a], quadrics[b]))
+        for face in shared:
+            alive[face] = False
+            for vertex in triangles[face]:
+                vertex_faces[vertex].discard(face)
+        alive_count -= len(shared)
+        for face in vertex_faces[b]:
+            corners = triangles[face]
+            corners[corners.index(b)] = a
+        vertex_faces[a] |= vertex_faces[b]
+        vertex_faces[b] = set()
+        versions[a] += 1
+        versions[b] += 1
+        for vertex in ring(a) - {a}:
+            heapq.heappush(heap, entry(a, vertex))
+
+        collapses += 1
+        if collapses % CANCEL_CHECK_INTERVAL == 0:
+            if cancel is not None and cancel.is_set():
+                raise DecimationCancelled()
+            if progress is not None:
+                progress(min(1.0, (len(triangles) - alive_count)
+                             / to_remove))
+
+    kept = np.flatnonzero(alive)
+    used, remapped = np.unique(np.array(triangles)[kept],
+                               return_inverse=True)
+    result = dict(arrays)
+    result.update({
+        'positions': np.array(positions)[used] * scale + center,
+        'source_vertices': arrays['source_vertices'][used],
+        'triangles': remapped.reshape(-1, 3),
+        'corner_loops': arrays['corner_loops'][kept],
+        'materials': arrays['materials'][kept],
+    })
+    if progress is not None:
+        progress(1.0)
+    return result
+
+
+DECIMATION_ENGINES = {
+    'CLUSTER': cluster_decimate,
+    'QUADRIC': quadric_decimate,
+}
+
+
+def decimate_mesh(mesh, target_triangles, engine='QUADRIC'):
+    """ Decimate mesh in place on the calling thread."""
+    arrays = read_mesh_arrays(mesh)
+    if len(arrays['triangles']) <= target_triangles:
+        return
+    write_mesh_arrays(mesh, DECIMATION_ENGINES[engine](arrays,
+                                                       target_triangles))
+
+
+# BACKGROUND JOBS
+
+class DecimationJob(object):
+    """ Decimate several meshes one after the other on a worker thread.
+
+    `tasks` maps a key to (arrays, target_triangles). The main thread polls
+    progress and done, and reads results or error once done is set.
+    """
+
+    def __init__(self, tasks, decimate=cluster_decimate):
+        self.tasks = tasks
+        self.decimate = decimate
+        self.progress = 0.0
+        self.results = {}
+        self.error = None
+        self.cancel_event = threading.Event()
+        self.done = threading.Event()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def cancel(self):
+        self.cancel_event.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def run(self):
+        try:
+            for index, (key, (arrays, target)) in enumerate(
+                    self.tasks.items()):
+                def progress(fraction, index=index):
+                    self.progress = (index + fraction) / len(self.tasks)
+                self.results[key] = self.decimate(
+                    arrays, target, progress, self.cancel_event)
+        except DecimationCancelled:
+            pass
+        except Exception as error:
+            self.error = error
+        finally:
+            self.done.set()
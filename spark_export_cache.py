@@ -0,0 +1,236 @@
+# Copyright (C) Facebook, Inc. and its affiliates
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from .spark_disk_cache import evict_lru
+from .spark_textures import source_bytes
+
+EXPORT_CACHE_DIR = os.path.join(tempfile.gettempdir(),
+                                'kivicube_ar_toolkit', 'exports')
+EXPORT_CACHE_MAX_SIZE = 1024 * 1024 * 1024  # unit: bytes
+
+# Bump when the exporter output changes for identical inputs.
+EXPORT_CACHE_VERSION = 1
+
+# Property read for the values of each generic attribute type, its dtype
+# and components.
+ATTRIBUTE_VALUES = {
+    'FLOAT': ('value', np.float32, 1),
+    'INT': ('value', np.int32, 1),
+    'INT8': ('value', np.int32, 1),
+    'BOOLEAN': ('value', bool, 1),
+    'FLOAT2': ('vector', np.float32, 2),
+    'FLOAT_VECTOR': ('vector', np.float32, 3),
+    'FLOAT_COLOR': ('color', np.float32, 4),
+    'BYTE_COLOR': ('color', np.float32, 4),
+    'INT32_2D': ('value', np.int32, 2),
+    'QUATERNION': ('value', np.float32, 4),
+}
+# Node properties that only affect the node editor.
+NODE_LAYOUT_PROPERTIES = frozenset((
+    'location', 'width', 'width_hidden', 'height', 'dimensions', 'select',
+    'hide', 'show_options', 'show_preview', 'show_texture',
+))
+
+
+def _hash_array(digest, collection, attribute, dtype, components=1):
+    values = np.empty(len(collection) * components, dtype=dtype)
+    collection.foreach_get(attribute, values)
+    digest.update(attribute.encode())
+    digest.update(values.tobytes())
+
+
+def _hash_rna(digest, struct, skip=()):
+    """ Hash the plain property values of an RNA struct, and the names of
+    the IDs it points to."""
+    for prop in struct.bl_rna.properties:
+        identifier = prop.identifier
+        if (identifier == 'rna_type' or prop.type == 'COLLECTION'
+                or identifier in skip):
+            continue
+        value = getattr(struct, identifier, None)
+        if prop.type == 'POINTER':
+            value = getattr(value, 'name', None)
+        elif getattr(prop, 'is_array', False):
+            value = tuple(value)
+        digest.update('{}={!r};'.format(identifier, value).encode())
+
+
+def _hash_mesh(digest, mesh):
+    _hash_array(digest, mesh.vertices, 'co', np.float32, 3)
+    _hash_array(digest, mesh.loops, 'vertex_index', np.int32)
+    _hash_array(digest, mesh.polygons, 'loop_total', np.int32)
+    _hash_array(digest, mesh.polygons, 'material_index', np.int32)
+    _hash_array(digest, mesh.polygons, 'use_smooth', bool)
+    for uv_layer in mesh.uv_layers:
+        digest.update(uv_layer.name.encode())
+        _hash_array(digest, uv_layer.data, 'uv', np.float32, 2)
+    if mesh.has_custom_normals:
+        _hash_array(digest, mesh.loops, 'normal', np.float32, 3)
+    for attribute in mesh.attributes:
+        if attribute.name.startswith('.'):
+            continue
+        digest.update('{}:{}:{}'.format(attribute.name, attribute.domain,
+                                        attribute.data_type).encode())
+        if attribute.data_type in ATTRIBUTE_VALUES:
+            _hash_array(digest, attribute.data,
+                        *ATTRIBUTE_VALUES[attribute.data_type])
+    if mesh.shape_keys:
+        for key_block in mesh.shape_keys.key_blocks:
+            digest.update(key_block.name.encode())
+            _hash_array(digest, key_block.data, 'co', np.float32, 3)
+
+
+def _hash_vertex_groups(digest, obj):
+    """ Hash the vertex group names of obj and the weights of its mesh."""
+    if not obj.vertex_groups:
+        return
+    digest.update(repr([group.name for group in obj.vertex_groups]).encode())
+    weights = [(vertex.index, element.group, element.weight)
+               for vertex in obj.data.vertices
+               for element in vertex.groups]
+    digest.update(np.array(weights, dtype=np.float64).tobytes())
+
+
+def _hash_node(digest, node):
+    _hash_rna(digest, node, skip=NODE_LAYOUT_PROPERTIES)
+    color_ramp = getattr(node, 'color_ramp', None)
+    if color_ramp is not None:
+        _hash_rna(digest, color_ramp)
+        for element in color_ramp.elements:
+            _hash_rna(digest, element)
+    curves = getattr(getattr(node, 'mapping', None), 'curves', None)
+    if curves is not None:
+        for curve in curves:
+            for point in curve.points:
+                _hash_rna(digest, point)
+
+
+def _hash_node_tree(digest, node_tree, image_digests, seen):
+    """ Hash the nodes, socket values, images and links of node_tree and
+    of the node groups it uses, each group once."""
+    seen.add(node_tree.name)
+    for node in node_tree.nodes:
+        digest.update('{}:{}'.format(node.bl_idname, node.name).encode())
+        _hash_node(digest, node)
+        for socket in node.inputs:
+            if hasattr(socket, 'default_value'):
+                value = socket.default_value
+                if hasattr(value, '__len__'):
+                    value = tuple(value)
+                digest.update(repr(value).encode())
+        image = getattr(node, 'image', None)
+        if image is not None:
+            if image.name not in image_digests:
+                data = source_bytes(image)
+                image_digests[image.name] = (
+                    hashlib.sha1(data).hexdigest() if data is not None
+                    else repr((image.name, tuple(image.size))))
+            digest.update(image_digests[image.name].encode())
+        group = getattr(node, 'node_tree', None)
+        if group is not None and group.name not in seen:
+            _hash_node_tree(digest, group, image_digests, seen)
+    for link in node_tree.links:
+        digest.update('{}.{}>{}.{}'.format(
+            link.from_node.name, link.from_socket.identifier,
+            link.to_node.name, link.to_socket.identifier).encode())
+
+
+def _hash_material(digest, material, image_digests):
+    digest.update(material.name.encode())
+    if not material.node_tree:
+        _hash_rna(digest, material)
+        return
+    _hash_node_tree(digest, material.node_tree, image_digests, set())
+
+
+def hash_object_content(obj, digest=None, image_digests=None):
+    """ Hash what obj looks like: transform, modifiers, animation, mesh
+    data, vertex weights and materials, but not its custom properties."""
+    digest = digest or hashlib.sha1()
+    image_digests = {} if image_digests is None else image_digests
+    digest.update(repr([tuple(row) for row in obj.matrix_world]).encode())
+    digest.update(repr(obj.parent.name if obj.parent else None).encode())
+    for modifier in obj.modifiers:
+        _hash_rna(digest, modifier)
+    if obj.animation_data and obj.animation_data.action:
+        action = obj.animation_data.action
+        digest.update(action.name.encode())
+        for fcurve in action.fcurves:
+            digest.update(fcurve.data_path.encode())
+            _hash_array(digest, fcurve.keyframe_points, 'co',
+                        np.float32, 2)
+    _hash_mesh(digest, obj.data)
+    _hash_vertex_groups(digest, obj)
+    for material_slot in obj.material_slots:
+        if material_slot.material:
+            _hash_material(digest, material_slot.material, image_digests)
+    return digest
+
+
+def fingerprint_objects(objects, export_settings):
+    """ Content hash of everything the GLB export of `objects` depends on:
+    geometry arrays, transforms, custom properties, modifiers, materials,
+    image contents and the exporter settings."""
+    digest = hashlib.sha1()
+    digest.update(json.dumps([EXPORT_CACHE_VERSION, export_settings],
+                             sort_keys=True, default=str).encode())
+    image_digests = {}
+    for obj in sorted(objects, key=lambda obj: obj.name):
+        digest.update(obj.name.encode())
+        for key in sorted(obj.keys()):
+            value = obj[key]
+            if hasattr(value, 'to_dict'):
+                value = value.to_dict()
+            elif hasattr(value, 'to_list'):
+                value = value.to_list()
+            digest.update('{}={!r}'.format(key, value).encode())
+        hash_object_content(obj, digest, image_digests)
+    return digest.hexdigest()
+
+
+def _cache_file(key):
+    return os.path.join(EXPORT_CACHE_DIR, key + '.glb')
+
+
+def fetch_cached_export(key, filepath):
+    """ Copy the cached export for `key` to filepath if there is one."""
+    cached = _cache_file(key)
+    # Touching the entry first marks it as just used, so eviction by
+    # another process keeps it while it is copied.
+    try:
+        os.utime(cached)
+    except FileNotFoundError:
+        return False
+    shutil.copyfile(cached, filepath)
+    return True
+
+
+def store_export(key, filepath, max_size=EXPORT_CACHE_MAX_SIZE):
+    os.makedirs(EXPORT_CACHE_DIR, exist_ok=True)
+    shutil.copyfile(filepath, _cache_file(key))
+    evict_exports(max_size)
+
+
+def evict_exports(max_size=EXPORT_CACHE_MAX_SIZE):
+    """ Drop the least recently used exports until the cache fits."""
+    evict_lru(EXPORT_CACHE_DIR, max_size)
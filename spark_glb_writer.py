@@ -0,0 +1,546 @@
+# Copyright (C) Facebook, Inc. and its affiliates
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .spark_textures import source_bytes
+from .spark_vertex_cache import optimize_triangle_order
+
+GLB_MAGIC = 0x46546C67
+GLB_VERSION = 2
+CHUNK_JSON = 0x4E4F534A
+CHUNK_BIN = 0x004E4942
+
+COMPONENT_TYPES = {
+    np.dtype(np.int8): 5120,
+    np.dtype(np.uint8): 5121,
+    np.dtype(np.int16): 5122,
+    np.dtype(np.uint16): 5123,
+    np.dtype(np.uint32): 5125,
+    np.dtype(np.float32): 5126,
+}
+ACCESSOR_TYPES = {1: 'SCALAR', 2: 'VEC2', 3: 'VEC3', 4: 'VEC4'}
+TARGET_ARRAY_BUFFER = 34962
+TARGET_ELEMENT_ARRAY_BUFFER = 34963
+
+IMAGE_MIME_TYPES = {'PNG': 'image/png', 'JPEG': 'image/jpeg'}
+
+KHR_MESH_QUANTIZATION = 'KHR_mesh_quantization'
+POSITION_QUANTIZATION_MAX = 32767  # int16
+NORMAL_QUANTIZATION_MAX = 127  # int8, normalized
+TEXCOORD_QUANTIZATION_MAX = 65535  # uint16, normalized
+
+# Blender is Z up, glTF is Y up.
+AXIS_CONVERSION = np.array([[1, 0, 0],
+                            [0, 0, 1],
+                            [0, -1, 0]], dtype=np.float32)
+
+
+class UnsupportedFeature(Exception):
+    pass
+
+
+# FEATURE CHECKS
+
+def _principled_node(material):
+    if material is None:
+        return None
+    if not material.use_nodes or not material.node_tree:
+        raise UnsupportedFeature('material without nodes: ' + material.name)
+    output = next((node for node in material.node_tree.nodes
+                   if node.type == 'OUTPUT_MATERIAL'
+                   and node.is_active_output), None)
+    surface = output.inputs['Surface'] if output else None
+    if surface is None or not surface.is_linked:
+        raise UnsupportedFeature('material without output: ' + material.name)
+    node = surface.links[0].from_node
+    if node.type != 'BSDF_PRINCIPLED':
+        raise UnsupportedFeature('non principled material: ' + material.name)
+    return node
+
+
+def _base_color_image(principled):
+    """ The image directly feeding Base Color, or None if unlinked."""
+    image = None
+    for socket in principled.inputs:
+        if not socket.is_linked:
+            continue
+        if socket.name != 'Base Color':
+            raise UnsupportedFeature('linked input: ' + socket.name)
+        node = socket.links[0].from_node
+        if node.type != 'TEX_IMAGE' or node.image is None:
+            raise UnsupportedFeature('base color from ' + node.type)
+        image = node.image
+        if image.file_format not in IMAGE_MIME_TYPES:
+            raise UnsupportedFeature('image format ' + image.file_format)
+        if source_bytes(image) is None:
+            raise UnsupportedFeature('image without data: ' + image.name)
+    return image
+
+
+def check_fast_export(objects):
+    """ Raise UnsupportedFeature if any object needs the full exporter."""
+    for obj in objects:
+        if obj.type != 'MESH':
+            raise UnsupportedFeature('non mesh object: ' + obj.name)
+        if obj.parent is not None:
+            raise UnsupportedFeature('parented object: ' + obj.name)
+        if obj.animation_data or obj.data.animation_data:
+            raise UnsupportedFeature('animated object: ' + obj.name)
+        if obj.data.shape_keys:
+            raise UnsupportedFeature('shape keys: ' + obj.name)
+        if any(modifier.type == 'ARMATURE' for modifier in obj.modifiers):
+            raise UnsupportedFeature('skinned object: ' + obj.name)
+        if getattr(obj.data, 'color_attributes', None) or getattr(
+                obj.data, 'vertex_colors', None):
+            raise UnsupportedFeature('vertex colors: ' + obj.name)
+        for material_slot in obj.material_slots:
+            principled = _principled_node(material_slot.material)
+            if (principled is not None
+                    and _base_color_image(principled) is not None
+                    and not obj.data.uv_layers):
+                raise UnsupportedFeature('texture without uvs: ' + obj.name)
+
+
+def can_fast_export(objects):
+    try:
+        check_fast_export(objects)
+    except UnsupportedFeature:
+        return False
+    return True
+
+
+# MESH EXTRACTION
+
+def _read(collection, attribute, dtype, components=1):
+    values = np.empty(len(collection) * components, dtype=dtype)
+    collection.foreach_get(attribute, values)
+    return values.reshape(-1, components) if components > 1 else values
+
+
+def _loop_normals(mesh):
+    if hasattr(mesh, 'corner_normals'):
+        return _read(mesh.corner_normals, 'vector', np.float32, 3)
+    mesh.calc_normals_split()
+    return _read(mesh.loops, 'normal', np.float32, 3)
+
+
+def split_mesh_vertices(mesh):
+    """ Triangulate mesh and split its loops into glTF vertices, the unique
+    (vertex, normal, uv) combinations.
+
+    Returns the loop level arrays together with first_loop, one loop per
+    glTF vertex, and loop_to_vertex, the glTF vertex of every loop.
+    """
+    mesh.calc_loop_triangles()
+    arrays = {
+        'triangle_loops': _read(mesh.loop_triangles, 'loops', np.int32, 3),
+        'triangle_materials': _read(mesh.loop_triangles, 'material_index',
+                                    np.int32),
+        'loop_verts': _read(mesh.loops, 'vertex_index', np.int32),
+        'normals': _loop_normals(mesh),
+        'uvs': None,
+    }
+    uv_layer = mesh.uv_layers.active
+    if uv_layer:
+        arrays['uvs'] = _read(uv_layer.data, 'uv', np.float32, 2)
+
+    columns = [arrays['loop_verts'].view(np.float32)[:, None],
+               arrays['normals']]
+    if arrays['uvs'] is not None:
+        columns.append(arrays['uvs'])
+    loop_keys = np.ascontiguousarray(np.hstack(columns))
+    row = np.dtype((np.void, loop_keys.dtype.itemsize * loop_keys.shape[1]))
+    _, first_loop, loop_to_vertex = np.unique(
+        loop_keys.view(row).ravel(), return_index=True, return_inverse=True)
+    arrays['first_loop'] = first_loop
+    arrays['loop_to_vertex'] = loop_to_vertex.ravel()
+    return arrays
+
+
+def extract_mesh_arrays(mesh, matrix_world):
+    """ Triangulated, de-duplicated glTF vertex and index arrays.
+
+    Returns positions, normals, optional texcoords, per-triangle material
+    indices and the triangle index buffer, already converted to Y up.
+    Mirrored transforms get their triangle winding reversed so the front
+    faces stay counter-clockwise.
+    """
+    split = split_mesh_vertices(mesh)
+    co = _read(mesh.vertices, 'co', np.float32, 3)
+    loop_verts = split['loop_verts']
+    normals = split['normals']
+    uvs = split['uvs']
+    first_loop = split['first_loop']
+
+    matrix = np.array(matrix_world, dtype=np.float32)
+    linear = AXIS_CONVERSION @ matrix[:3, :3]
+    translation = AXIS_CONVERSION @ matrix[:3, 3]
+    normal_matrix = AXIS_CONVERSION @ np.linalg.inv(matrix[:3, :3]).T
+
+    positions = co[loop_verts[first_loop]] @ linear.T + translation
+    vertex_normals = normals[first_loop] @ normal_matrix.T
+    lengths = np.linalg.norm(vertex_normals, axis=1, keepdims=True)
+    vertex_normals /= np.where(lengths > 0, lengths, 1)
+    texcoords = None
+    if uvs is not None:
+        texcoords = uvs[first_loop].copy()
+        texcoords[:, 1] = 1 - texcoords[:, 1]
+
+    indices = split['loop_to_vertex'][split['triangle_loops']]
+    if np.linalg.det(matrix[:3, :3]) < 0:
+        indices = indices[:, ::-1]
+
+    return {
+        'positions': np.ascontiguousarray(positions, dtype=np.float32),
+        'normals': np.ascontiguousarray(vertex_normals, dtype=np.float32),
+        'texcoords': texcoords,
+        'materials': split['triangle_materials'],
+        'indices': np.ascontiguousarray(indices, dtype=np.uint32),
+    }
+
+
+def optimize_vertex_fetch(arrays):
+    """ Group the triangles by material and renumber the vertices in the
+    order the index buffer first uses them, dropping unused ones, so the
+    GPU reads the vertex buffer front to back."""
+    order = np.argsort(arrays['materials'], kind='stable')
+    indices = arrays['indices'][order]
+    flat = indices.ravel()
+    used, first_use = np.unique(flat, return_index=True)
+    fetch_order = used[np.argsort(first_use)]
+    remap = np.empty(len(arrays['positions']), dtype=np.uint32)
+    remap[fetch_order] = np.arange(len(fetch_order), dtype=np.uint32)
+
+    optimized = dict(arrays)
+    for key in ('positions', 'normals', 'texcoords'):
+        if arrays[key] is not None:
+            optimized[key] = np.ascontiguousarray(arrays[key][fetch_order])
+    optimized['materials'] = arrays['materials'][order]
+    optimized['indices'] = remap[indices]
+    return optimized
+
+
+def optimize_vertex_cache(arrays):
+    """ Reorder the triangles of every material for vertex cache locality
+    and overdraw. Vertex fetch order is left to optimize_vertex_fetch."""
+    order = optimize_triangle_order(arrays['indices'], arrays['positions'],
+                                    arrays['materials'])
+    optimized = dict(arrays)
+    optimized['indices'] = arrays['indices'][order]
+    optimized['materials'] = arrays['materials'][order]
+    return optimized
+
+
+def quantize_mesh_arrays(arrays):
+    """ Quantize the vertex attributes as allowed by KHR_mesh_quantization.
+
+    Positions become int16 spanning the bounding box of the mesh; the
+    returned 'translation' and 'scale' map them back and belong on the
+    node. The scale is uniform, as the node scale also transforms the
+    normals. Normals become normalized int8 and texture coordinates in
+    [0, 1] normalized uint16.
+    """
+    quantized = dict(arrays)
+    positions = arrays['positions']
+    if len(positions):
+        low, high = positions.min(axis=0), positions.max(axis=0)
+    else:
+        low = high = np.zeros(3, dtype=np.float32)
+    center = (low + high) / 2
+    scale = np.full(3, max(float((high - low).max()) / 2, 1e-8),
+                    dtype=np.float32)
+    quantized['positions'] = np.round(
+        (positions - center) / scale * POSITION_QUANTIZATION_MAX
+    ).astype(np.int16)
+    quantized['translation'] = center.tolist()
+    quantized['scale'] = (scale / POSITION_QUANTIZATION_MAX).tolist()
+    quantized['normals'] = np.round(
+        arrays['normals'] * NORMAL_QUANTIZATION_MAX).astype(np.int8)
+    texcoords = arrays['texcoords']
+    if (texcoords is not None and len(texcoords)
+            and texcoords.min() >= 0 and texcoords.max() <= 1):
+        quantized['texcoords'] = np.round(
+            texcoords * TEXCOORD_QUANTIZATION_MAX).astype(np.uint16)
+    return quantized
+
+
+def optimize_mesh_arrays(arrays, quantize=False, reorder=False,
+                         optimize_cache=False):
+    if optimize_cache:
+        arrays = optimize_vertex_cache(arrays)
+    if reorder or optimize_cache:
+        arrays = optimize_vertex_fetch(arrays)
+    if quantize:
+        arrays = quantize_mesh_arrays(arrays)
+    return arrays
+
+
+# GLB ASSEMBLY
+
+class GlbBuilder(object):
+    def __init__(self):
+        self.gltf = {
+            'asset': {'version': '2.0', 'generator': 'Kivicube AR Toolkit'},
+            'scene': 0,
+            'scenes': [{'nodes': []}],
+            'nodes': [],
+            'meshes': [],
+            'materials': [],
+            'textures': [],
+            'images': [],
+            'samplers': [],
+            'accessors': [],
+            'bufferViews': [],
+            'buffers': [],
+        }
+        self.chunks = []
+        self.byte_length = 0
+        self.quantization_saving = 0
+        self._materials = {}
+
+    def add_buffer_view(self, data, target=None, byte_stride=None):
+        view = memoryview(data).cast('B')
+        padding = -self.byte_length % 4
+        if padding:
+            self.chunks.append(bytes(padding))
+            self.byte_length += padding
+        buffer_view = {
+            'buffer': 0,
+            'byteOffset': self.byte_length,
+            'byteLength': view.nbytes,
+        }
+        if target is not None:
+            buffer_view['target'] = target
+        if byte_stride is not None:
+            buffer_view['byteStride'] = byte_stride
+        self.chunks.append(view)
+        self.byte_length += view.nbytes
+        self.gltf['bufferViews'].append(buffer_view)
+        return len(self.gltf['bufferViews']) - 1
+
+    def add_accessor(self, array, target=None, bounds=False, **extra):
+        array = np.ascontiguousarray(array)
+        components = array.shape[1] if array.ndim > 1 else 1
+        data, byte_stride = array, None
+        element_size = array.itemsize * components
+        if target == TARGET_ARRAY_BUFFER and element_size % 4:
+            # Vertex attributes must start on 4 byte boundaries, so small
+            # quantized elements are padded through a byte stride.
+            byte_stride = element_size + (-element_size % 4)
+            data = np.zeros((len(array), byte_stride), dtype=np.uint8)
+            data[:, :element_size] = array.view(np.uint8).reshape(
+                len(array), element_size)
+        accessor = {
+            'bufferView': self.add_buffer_view(data, target, byte_stride),
+            'componentType': COMPONENT_TYPES[array.dtype],
+            'count': len(array),
+            'type': ACCESSOR_TYPES[components],
+        }
+        if bounds:
+            accessor['min'] = np.atleast_1d(array.min(axis=0)).tolist()
+            accessor['max'] = np.atleast_1d(array.max(axis=0)).tolist()
+        accessor.update(extra)
+        self.gltf['accessors'].append(accessor)
+        return len(self.gltf['accessors']) - 1
+
+    def add_image(self, image):
+        data = source_bytes(image)
+        self.gltf['images'].append({
+            'name': image.name,
+            'mimeType': IMAGE_MIME_TYPES[image.file_format],
+            'bufferView': self.add_buffer_view(data),
+        })
+        if not self.gltf['samplers']:
+            self.gltf['samplers'].append({})
+        self.gltf['textures'].append({
+            'sampler': 0,
+            'source': len(self.gltf['images']) - 1,
+        })
+        return len(self.gltf['textures']) - 1
+
+    def add_material(self, material):
+        if material is None:
+            return None
+        if material.name in self._materials:
+            return self._materials[material.name]
+        principled = _principled_node(material)
+        inputs = principled.inputs
+        pbr = {
+            'baseColorFactor': list(inputs['Base Color'].default_value),
+            'metallicFactor': inputs['Metallic'].default_value,
+            'roughnessFactor': inputs['Roughness'].default_value,
+        }
+        image = _base_color_image(principled)
+        if image is not None:
+            pbr['baseColorFactor'] = [1.0, 1.0, 1.0, 1.0]
+            pbr['baseColorTexture'] = {'index': self.add_image(image)}
+        alpha = inputs['Alpha'].default_value
+        pbr['baseColorFactor'][3] *= alpha
+        gltf_material = {
+            'name': material.name,
+            'pbrMetallicRoughness': pbr,
+            'doubleSided': not material.use_backface_culling,
+        }
+        if alpha < 1:
+            gltf_material['alphaMode'] = 'BLEND'
+        self.gltf['materials'].append(gltf_material)
+        index = len(self.gltf['materials']) - 1
+        self._materials[material.name] = index
+        return index
+
+    def add_mesh(self, name, arrays, materials):
+        attributes = {
+            'POSITION': self._add_attribute(arrays['positions'],
+                                            bounds=True, normalized=False),
+            'NORMAL': self._add_attribute(arrays['normals']),
+        }
+        if arrays['texcoords'] is not None:
+            attributes['TEXCOORD_0'] = self._add_attribute(
+                arrays['texcoords'])
+        if any(arrays[key] is not None and arrays[key].dtype != np.float32
+               for key in ('positions', 'normals', 'texcoords')):
+            self.use_extension(KHR_MESH_QUANTIZATION, required=True)
+
+        index_type = (np.uint16 if len(arrays['positions']) < 65536
+                      else np.uint32)
+        primitives = []
+        triangle_materials = arrays['materials']
+        for material_index in np.unique(triangle_materials):
+            indices = arrays['indices'][triangle_materials == material_index]
+            primitive = {
+                'attributes': attributes,
+                'indices': self.add_accessor(
+                    indices.ravel().astype(index_type),
+                    TARGET_ELEMENT_ARRAY_BUFFER),
+                'mode': 4,
+            }
+            if material_index < len(materials):
+                material = self.add_material(materials[material_index])
+                if material is not None:
+                    primitive['material'] = material
+            primitives.append(primitive)
+        self.gltf['meshes'].append({'name': name, 'primitives': primitives})
+        return len(self.gltf['meshes']) - 1
+
+    def _add_attribute(self, array, bounds=False, normalized=True):
+        # Bytes the attribute would take as float32, for reporting.
+        self.quantization_saving += array.size * 4 - array.nbytes
+        extra = {}
+        if normalized and array.dtype != np.float32:
+            extra['normalized'] = True
+        return self.add_accessor(array, TARGET_ARRAY_BUFFER, bounds=bounds,
+                                 **extra)
+
+    def use_extension(self, name, required=False):
+        used = self.gltf.setdefault('extensionsUsed', [])
+        if name not in used:
+            used.append(name)
+        if required:
+            required_list = self.gltf.setdefault('extensionsRequired', [])
+            if name not in required_list:
+                required_list.append(name)
+
+    def add_node(self, node):
+        self.gltf['nodes'].append(node)
+        self.gltf['scenes'][0]['nodes'].append(len(self.gltf['nodes']) - 1)
+
+    def write(self, filepath):
+        for key in [key for key, value in self.gltf.items()
+                    if isinstance(value, list) and not value]:
+            del self.gltf[key]
+        padding = -self.byte_length % 4
+        if padding:
+            self.chunks.append(bytes(padding))
+            self.byte_length += padding
+        self.gltf['buffers'] = [{'byteLength': self.byte_length}]
+
+        json_chunk = json.dumps(self.gltf, separators=(',', ':')).encode()
+        json_chunk += b' ' * (-len(json_chunk) % 4)
+        total = 12 + 8 + len(json_chunk) + 8 + self.byte_length
+        with open(filepath, 'wb') as glb_file:
+            glb_file.write(struct.pack('<III', GLB_MAGIC, GLB_VERSION, total))
+            glb_file.write(struct.pack('<II', len(json_chunk), CHUNK_JSON))
+            glb_file.write(json_chunk)
+            glb_file.write(struct.pack('<II', self.byte_length, CHUNK_BIN))
+            for chunk in self.chunks:
+                glb_file.write(chunk)
+        return total
+
+
+def _extras(obj):
+    extras = {}
+    for key in obj.keys():
+        value = obj[key]
+        if isinstance(value, (int, float, str)):
+            extras[key] = value
+    return extras
+
+
+def write_glb(context, objects, filepath, quantize=False, reorder=False,
+              optimize_cache=False, max_workers=None):
+    """ Write the evaluated static meshes straight to a GLB file.
+
+    The meshes are read on the main thread; reordering and quantization
+    run in a thread pool when there are several objects. Callers must
+    check can_fast_export() first. Returns the file size and the size the
+    file would have with float vertex attributes.
+    """
+    depsgraph = context.evaluated_depsgraph_get()
+    mesh_arrays = []
+    written = []
+    for obj in objects:
+        obj_eval = obj.evaluated_get(depsgraph)
+        mesh = obj_eval.to_mesh()
+        try:
+            arrays = extract_mesh_arrays(mesh, obj.matrix_world)
+        finally:
+            obj_eval.to_mesh_clear()
+        # glTF accessors cannot be empty, so objects without faces are
+        # left out.
+        if len(arrays['indices']):
+            mesh_arrays.append(arrays)
+            written.append(obj)
+
+    def optimize(arrays):
+        return optimize_mesh_arrays(arrays, quantize, reorder,
+                                    optimize_cache)
+
+    if (quantize or reorder or optimize_cache) and len(written) > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            mesh_arrays = list(executor.map(optimize, mesh_arrays))
+    else:
+        mesh_arrays = [optimize(arrays) for arrays in mesh_arrays]
+
+    builder = GlbBuilder()
+    for obj, arrays in zip(written, mesh_arrays):
+        materials = [slot.material for slot in obj.material_slots]
+        node = {
+            'name': obj.name,
+            'mesh': builder.add_mesh(obj.data.name, arrays, materials),
+        }
+        if 'translation' in arrays:
+            node['translation'] = arrays['translation']
+            node['scale'] = arrays['scale']
+        extras = _extras(obj)
+        if extras:
+            node['extras'] = extras
+        builder.add_node(node)
+    size = builder.write(filepath)
+    return size, size + builder.quantization_saving
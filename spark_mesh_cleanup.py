@@ -0,0 +1,172 @@
+# Copyright (C) Facebook, Inc. and its affiliates
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import itertools
+
+import bmesh
+import numpy as np
+
+
+def read_mesh_arrays(mesh):
+    """ Read the mesh topology into NumPy arrays with one foreach_get per
+    attribute."""
+    vertex_count = len(mesh.vertices)
+    edge_count = len(mesh.edges)
+    loop_count = len(mesh.loops)
+    polygon_count = len(mesh.polygons)
+
+    co = np.empty(vertex_count * 3, dtype=np.float32)
+    mesh.vertices.foreach_get('co', co)
+    edges = np.empty(edge_count * 2, dtype=np.int32)
+    mesh.edges.foreach_get('vertices', edges)
+    loop_edges = np.empty(loop_count, dtype=np.int32)
+    mesh.loops.foreach_get('edge_index', loop_edges)
+    loop_totals = np.empty(polygon_count, dtype=np.int32)
+    mesh.polygons.foreach_get('loop_total', loop_totals)
+    areas = np.empty(polygon_count, dtype=np.float32)
+    mesh.polygons.foreach_get('area', areas)
+
+    return {
+        'co': co.reshape(-1, 3),
+        'edges': edges.reshape(-1, 2),
+        'loop_edges': loop_edges,
+        'loop_totals': loop_totals,
+        'areas': areas,
+    }
+
+
+def find_loose_geometry(arrays):
+    """ Vertices without edges and edges without faces, as boolean masks."""
+    vertex_count = len(arrays['co'])
+    edge_count = len(arrays['edges'])
+
+    loose_verts = np.ones(vertex_count, dtype=bool)
+    loose_verts[arrays['edges'].ravel()] = False
+    loose_edges = np.ones(edge_count, dtype=bool)
+    loose_edges[arrays['loop_edges']] = False
+    return loose_verts, loose_edges
+
+
+def _pack_cell_keys(cells):
+    cells = cells - cells.min(axis=0)
+    extent = cells.max(axis=0).astype(np.float64) + 1
+    if np.prod(extent) >= 2 ** 62:
+        return np.unique(cells, axis=0, return_inverse=True)[1].ravel()
+    extent = extent.astype(np.int64)
+    return (cells[:, 0] * extent[1] + cells[:, 1]) * extent[2] + cells[:, 2]
+
+
+def find_weld_candidates(co, threshold):
+    """ Vertices that may lie within `threshold` of another vertex.
+
+    Hashes the coordinates into cells twice the threshold wide, on the
+    eight grids shifted by the threshold along each axis. Two points
+    closer than the threshold share a cell on at least one of them, so
+    the result is a superset of the vertices remove_doubles will merge.
+    """
+    candidates = np.zeros(len(co), dtype=bool)
+    if len(co) < 2 or threshold <= 0:
+        return candidates
+    size = threshold * 2
+    for offset in itertools.product((0, threshold), repeat=3):
+        cells = np.floor((co + np.asarray(offset)) / size).astype(np.int64)
+        keys = _pack_cell_keys(cells)
+        _, inverse, counts = np.unique(keys, return_inverse=True,
+                                       return_counts=True)
+        candidates |= counts[inverse.ravel()] > 1
+    return candidates
+
+
+def find_degenerate_edges(arrays, threshold):
+    """ Edges shorter than `threshold` or belonging to zero-area faces."""
+    co = arrays['co']
+    edges = arrays['edges']
+    lengths = np.linalg.norm(co[edges[:, 0]] - co[edges[:, 1]], axis=1)
+    degenerate = lengths < threshold
+
+    flat_polygons = np.repeat(arrays['areas'] < threshold * threshold,
+                              arrays['loop_totals'])
+    degenerate[arrays['loop_edges'][flat_polygons]] = True
+    return degenerate
+
+
+def cleanup_mesh(mesh, remove_doubles_threshold, nonplanar_angle_limit):
+    """ Run the Spark mesh clean up on `mesh` in a single BMesh pass.
+
+    The NumPy analysis restricts every bmesh operator to the elements it
+    can actually change, and the BMesh round trip is skipped entirely when
+    there is nothing to do. Returns the number of elements handed to each
+    step.
+    """
+    arrays = read_mesh_arrays(mesh)
+    loose_verts, loose_edges = find_loose_geometry(arrays)
+    weld_candidates = find_weld_candidates(arrays['co'],
+                                           remove_doubles_threshold)
+    degenerate_edges = find_degenerate_edges(arrays,
+                                             remove_doubles_threshold)
+    ngons = arrays['loop_totals'] > 3
+
+    stats = {
+        'loose_verts': int(loose_verts.sum()),
+        'loose_edges': int(loose_edges.sum()),
+        'degenerate_edges': int(degenerate_edges.sum()),
+        'weld_candidates': int(weld_candidates.sum()),
+        'ngons': int(ngons.sum()),
+    }
+    if not any(stats.values()):
+        return stats
+
+    bm = bmesh.new()
+    bm.from_mesh(mesh)
+    bm.verts.ensure_lookup_table()
+    bm.edges.ensure_lookup_table()
+    bm.faces.ensure_lookup_table()
+
+    # Resolve every index before the first operator changes the topology.
+    verts = bm.verts
+    edges = bm.edges
+    loose_edges = [edges[i] for i in np.flatnonzero(loose_edges)]
+    loose_verts = [verts[i] for i in np.flatnonzero(loose_verts)]
+    degenerate = [edges[i] for i in np.flatnonzero(degenerate_edges)]
+    candidates = [verts[i] for i in np.flatnonzero(weld_candidates)]
+    faces = [bm.faces[i] for i in np.flatnonzero(ngons)]
+
+    if loose_edges:
+        bmesh.ops.delete(bm, geom=loose_edges, context='EDGES')
+    if loose_verts:
+        bmesh.ops.delete(bm, geom=loose_verts, context='VERTS')
+    degenerate = [edge for edge in degenerate if edge.is_valid]
+    if degenerate:
+        bmesh.ops.dissolve_degenerate(bm, dist=remove_doubles_threshold,
+                                      edges=degenerate)
+    candidates = [vert for vert in candidates if vert.is_valid]
+    if candidates:
+        bmesh.ops.remove_doubles(bm, verts=candidates,
+                                 dist=remove_doubles_threshold)
+
+    faces = [face for face in faces
+             if face.is_valid and len(face.verts) > 3]
+    if faces:
+        bmesh.ops.planar_faces(bm, faces=faces, iterations=1, factor=1.0)
+        result = bmesh.ops.connect_verts_nonplanar(
+            bm, angle_limit=nonplanar_angle_limit, faces=faces)
+        faces = [face for face in set(faces + result['faces'])
+                 if face.is_valid and len(face.verts) > 3]
+        bmesh.ops.connect_verts_concave(bm, faces=faces)
+
+    bm.to_mesh(mesh)
+    bm.free()
+    mesh.update()
+    return stats
@@ -0,0 +1,137 @@
+# Copyright (C) Facebook, Inc. and its affiliates
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import bpy
+import numpy as np
+from bpy.app.handlers import persistent
+
+
+def object_state_key(obj):
+    """ Cheap fingerprint of the object data and modifier stack."""
+    data = obj.data
+    modifiers = tuple(
+        (modifier.name, modifier.type, modifier.show_viewport,
+         getattr(modifier, 'ratio', None))
+        for modifier in obj.modifiers)
+    return (data.name if data else None, modifiers)
+
+
+class ObjectStatsCache(object):
+    """ Per-object cache of values computed from the evaluated depsgraph.
+
+    Entries are dropped by invalidate_from_depsgraph() when the depsgraph
+    reports a relevant update and are re-validated against
+    object_state_key() on every read. Caches tracking materials are also
+    cleared by any material, node tree or image update.
+    """
+
+    def __init__(self, compute, track_transform=False,
+                 track_materials=False):
+        self._compute = compute
+        self._entries = {}
+        self.track_transform = track_transform
+        self.track_materials = track_materials
+        _caches.append(self)
+
+    def get(self, context, obj):
+        key = object_state_key(obj)
+        if self.track_transform:
+            # Operators move objects before the depsgraph handler can
+            # invalidate the entry, so the transform is part of the key.
+            key += (tuple(map(tuple, obj.matrix_world)),)
+        if self.track_materials:
+            key += (tuple(slot.material.name if slot.material else None
+                          for slot in obj.material_slots),)
+        entry = self._entries.get(obj.name)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+        value = self._compute(obj, context.evaluated_depsgraph_get())
+        self._entries[obj.name] = (key, value)
+        return value
+
+    def invalidate(self, name):
+        self._entries.pop(name, None)
+
+    def invalidate_data(self, data_name):
+        stale = [name for name, (key, _) in self._entries.items()
+                 if key[0] == data_name]
+        for name in stale:
+            del self._entries[name]
+
+    def clear(self):
+        self._entries.clear()
+
+
+_caches = []
+
+
+def count_mesh_triangles(mesh):
+    polygon_count = len(mesh.polygons)
+    if polygon_count == 0:
+        return 0
+    loop_totals = np.empty(polygon_count, dtype=np.int32)
+    mesh.polygons.foreach_get('loop_total', loop_totals)
+    return int(loop_totals.sum()) - 2 * polygon_count
+
+
+def _count_evaluated_triangles(obj, depsgraph):
+    return count_mesh_triangles(obj.evaluated_get(depsgraph).data)
+
+
+tri_count_cache = ObjectStatsCache(_count_evaluated_triangles)
+
+
+def invalidate_from_depsgraph(depsgraph):
+    for update in depsgraph.updates:
+        id_original = update.id.original
+        if isinstance(id_original, bpy.types.Object):
+            for cache in _caches:
+                if (update.is_updated_geometry
+                        or (cache.track_transform
+                            and update.is_updated_transform)):
+                    cache.invalidate(id_original.name)
+        elif isinstance(id_original, bpy.types.Mesh):
+            for cache in _caches:
+                cache.invalidate_data(id_original.name)
+        elif isinstance(id_original, (bpy.types.Material, bpy.types.Image,
+                                      bpy.types.NodeTree)):
+            for cache in _caches:
+                if cache.track_materials:
+                    cache.clear()
+
+
+def invalidate_object(name):
+    """ Drop the entries of obj in every cache, for code that edits mesh
+    data in place and reads the caches again before the next depsgraph
+    update."""
+    for cache in _caches:
+        cache.invalidate(name)
+
+
+def clear_all_caches():
+    for cache in _caches:
+        cache.clear()
+
+
+@persistent
+def stats_depsgraph_handler(scene, depsgraph=None):
+    if depsgraph is None:
+        depsgraph = bpy.context.evaluated_depsgraph_get()
+    invalidate_from_depsgraph(depsgraph)
+
+
+@persistent
+def stats_load_handler(*args):
+    clear_all_caches()
@@ -0,0 +1,394 @@
+# Copyright (C) Facebook, Inc. and its affiliates
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import multiprocessing
+import os
+import sys
+
+import bpy
+import numpy as np
+from mathutils import Vector
+from mathutils.bvhtree import BVHTree
+
+BAKE_TILE_SIZE = 64  # unit: pixels
+BAKE_CHUNK_TEXELS = 16384
+RASTER_CHUNK_PIXELS = 1 << 22
+DILATE_PIXELS = 8
+# Ray cage offset along the low poly normal, relative to the diagonal of
+# the low poly bounding box.
+DEFAULT_MAX_DISTANCE = 0.02
+# Names of the nodes a bake adds, so baking again replaces their image.
+NORMAL_TEXTURE_NODE = 'SparkNormalTexture'
+NORMAL_MAP_NODE = 'SparkNormalMap'
+
+# State shared with the worker processes. It is set before the pool forks,
+# so the children inherit it instead of receiving it pickled.
+_bake_state = {}
+
+
+# MESH DATA
+
+def _read(collection, attribute, dtype, components=1):
+    values = np.empty(len(collection) * components, dtype=dtype)
+    collection.foreach_get(attribute, values)
+    return values.reshape(-1, components) if components > 1 else values
+
+
+def _loop_normals(mesh):
+    if hasattr(mesh, 'calc_normals_split'):
+        mesh.calc_normals_split()
+    return _read(mesh.loops, 'normal', np.float32, 3)
+
+
+def _to_world(matrix_world, positions, normals):
+    matrix = np.array(matrix_world, dtype=np.float64)
+    normal_matrix = np.linalg.inv(matrix[:3, :3]).T
+    positions = positions @ matrix[:3, :3].T + matrix[:3, 3]
+    normals = normals @ normal_matrix.T
+    normals /= np.maximum(np.linalg.norm(normals, axis=-1,
+                                         keepdims=True), 1e-20)
+    return positions, normals
+
+
+def read_high_poly(mesh, matrix_world):
+    """ World space triangles and corner normals of the bake source."""
+    mesh.calc_loop_triangles()
+    triangle_loops = _read(mesh.loop_triangles, 'loops', np.int32, 3)
+    loop_vertices = _read(mesh.loops, 'vertex_index', np.int32)
+    positions = _read(mesh.vertices, 'co', np.float32, 3).astype(np.float64)
+    normals = _loop_normals(mesh).astype(np.float64)
+    positions, normals = _to_world(matrix_world, positions, normals)
+    return {
+        'positions': positions,
+        'triangles': loop_vertices[triangle_loops],
+        'corner_normals': normals[triangle_loops],
+    }
+
+
+def read_low_poly(mesh, matrix_world):
+    """ World space corners of the bake target with their UVs, normals
+    and tangents. mesh must have an active UV map."""
+    mesh.calc_tangents(uvmap=mesh.uv_layers.active.name)
+    mesh.calc_loop_triangles()
+    triangle_loops = _read(mesh.loop_triangles, 'loops', np.int32, 3)
+    loop_vertices = _read(mesh.loops, 'vertex_index', np.int32)
+    positions = _read(mesh.vertices, 'co', np.float32, 3).astype(np.float64)
+    normals = _read(mesh.loops, 'normal', np.float32, 3).astype(np.float64)
+    tangents = _read(mesh.loops, 'tangent', np.float32, 3).astype(
+        np.float64)
+    signs = _read(mesh.loops, 'bitangent_sign', np.float32)
+    uvs = _read(mesh.uv_layers.active.data, 'uv', np.float32, 2)
+    mesh.free_tangents()
+
+    matrix = np.array(matrix_world, dtype=np.float64)
+    positions, normals = _to_world(matrix_world, positions, normals)
+    tangents = tangents @ matrix[:3, :3].T
+    tangents /= np.maximum(np.linalg.norm(tangents, axis=-1,
+                                          keepdims=True), 1e-20)
+    # A mirrored object transform flips the handedness of the tangents.
+    if np.linalg.det(matrix[:3, :3]) < 0:
+        signs = -signs
+    return {
+        'positions': positions[loop_vertices[triangle_loops]],
+        'normals': normals[triangle_loops],
+        'tangents': tangents[triangle_loops],
+        'signs': signs[triangle_loops],
+        'uvs': uvs[triangle_loops].astype(np.float64),
+    }
+
+
+# RASTERIZATION
+
+def _rasterize_chunk(uvs, size, first_triangle):
+    """ Texels whose centers fall inside the UV triangles: pixel index,
+    triangle and barycentric coordinates."""
+    points = uvs * size - 0.5
+    low = np.clip(np.floor(points.min(axis=1)), 0, size - 1).astype(
+        np.int64)
+    high = np.clip(np.ceil(points.max(axis=1)), 0, size - 1).astype(
+        np.int64)
+    widths = high[:, 0] - low[:, 0] + 1
+    heights = high[:, 1] - low[:, 1] + 1
+    counts = widths * heights
+    triangles = np.repeat(np.arange(len(uvs)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                                  counts)
+    xs = low[triangles, 0] + offsets % widths[triangles]
+    ys = low[triangles, 1] + offsets // widths[triangles]
+
+    a, b, c = points[:, 0], points[:, 1], points[:, 2]
+    area = ((b[:, 0] - a[:, 0]) * (c[:, 1] - a[:, 1])
+            - (b[:, 1] - a[:, 1]) * (c[:, 0] - a[:, 0]))
+    area = np.where(np.abs(area) > 1e-20, area, np.nan)[triangles]
+
+    def edge(p, q):
+        return ((q[triangles, 0] - p[triangles, 0])
+                * (ys - p[triangles, 1])
+                - (q[triangles, 1] - p[triangles, 1])
+                * (xs - p[triangles, 0]))
+
+    barycentric = np.stack((edge(b, c), edge(c, a), edge(a, b)),
+                           axis=-1) / area[:, None]
+    inside = np.all(barycentric >= -1e-6, axis=1)
+    return (ys[inside] * size + xs[inside],
+            triangles[inside] + first_triangle,
+            barycentric[inside])
+
+
+def rasterize_uvs(uvs, size):
+    """ _rasterize_chunk over all triangles, a bounded number of bounding
+    box pixels at a time."""
+    points = uvs * size
+    box_pixels = np.prod(np.ceil(points.max(axis=1))
+                         - np.floor(points.min(axis=1)) + 1, axis=1)
+    bounds = np.searchsorted(np.cumsum(box_pixels),
+                             np.arange(RASTER_CHUNK_PIXELS,
+                                       box_pixels.sum(),
+                                       RASTER_CHUNK_PIXELS))
+    pixels, triangles, barycentrics = [], [], []
+    for start, stop in zip(np.concatenate(([0], bounds + 1)),
+                           np.concatenate((bounds + 1, [len(uvs)]))):
+        if start >= stop:
+            continue
+        chunk = _rasterize_chunk(uvs[start:stop], size, start)
+        pixels.append(chunk[0])
+        triangles.append(chunk[1])
+        barycentrics.append(chunk[2])
+    if not pixels:
+        return (np.zeros(0, np.int64), np.zeros(0, np.int64),
+                np.zeros((0, 3)))
+    return (np.concatenate(pixels), np.concatenate(triangles),
+            np.concatenate(barycentrics))
+
+
+# RAY CASTING
+
+def _interpolate(corners, triangles, barycentric):
+    return np.einsum('ij,ijk->ik', barycentric, corners[triangles])
+
+
+def _normalize(vectors):
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=-1,
+                                               keepdims=True), 1e-20)
+
+
+def _init_worker():
+    high = _bake_state['high']
+    _bake_state['tree'] = BVHTree.FromPolygons(
+        high['positions'].tolist(), high['triangles'].tolist(),
+        all_triangles=True)
+
+
+def _cast_range(start, stop):
+    """ Cast the rays of texels start:stop against the high poly mesh and
+    return the interpolated normals at the hits, NaN where they miss."""
+    tree = _bake_state['tree']
+    high = _bake_state['high']
+    origins = _bake_state['origins'][start:stop]
+    directions = _bake_state['directions'][start:stop]
+    reach = _bake_state['reach']
+
+    hits = np.full((stop - start, 3), np.nan)
+    faces = np.zeros(stop - start, dtype=np.int64)
+    for index, (origin, direction) in enumerate(
+            zip(origins.tolist(), directions.tolist())):
+        location, _, face, _ = tree.ray_cast(Vector(origin),
+                                             Vector(direction), reach)
+        if location is not None:
+            hits[index] = location
+            faces[index] = face
+    found = ~np.isnan(hits[:, 0])
+
+    # Smooth the hit normal with the barycentric coordinates of the hit.
+    corners = high['positions'][high['triangles'][faces[found]]]
+    v0 = corners[:, 1] - corners[:, 0]
+    v1 = corners[:, 2] - corners[:, 0]
+    v2 = hits[found] - corners[:, 0]
+    d00 = np.einsum('ij,ij->i', v0, v0)
+    d01 = np.einsum('ij,ij->i', v0, v1)
+    d11 = np.einsum('ij,ij->i', v1, v1)
+    d20 = np.einsum('ij,ij->i', v2, v0)
+    d21 = np.einsum('ij,ij->i', v2, v1)
+    denominator = np.where(np.abs(d00 * d11 - d01 * d01) > 1e-30,
+                           d00 * d11 - d01 * d01, 1.0)
+    v = (d11 * d20 - d01 * d21) / denominator
+    w = (d00 * d21 - d01 * d20) / denominator
+    barycentric = np.stack((1 - v - w, v, w), axis=-1)
+    normals = np.full((stop - start, 3), np.nan)
+    normals[found] = _normalize(_interpolate(high['corner_normals'],
+                                             faces[found], barycentric))
+    return normals
+
+
+def _cast_range_args(args):
+    return _cast_range(*args)
+
+
+def _tile_ranges(pixels, size):
+    """ Sort key grouping the texels by tile, and the (start, stop) ranges
+    of roughly BAKE_CHUNK_TEXELS texels, cut at tile boundaries."""
+    tiles_per_row = (size + BAKE_TILE_SIZE - 1) // BAKE_TILE_SIZE
+    xs, ys = pixels % size, pixels // size
+    tiles = (ys // BAKE_TILE_SIZE) * tiles_per_row + xs // BAKE_TILE_SIZE
+    order = np.argsort(tiles, kind='stable')
+    tile_starts = np.flatnonzero(np.diff(tiles[order], prepend=-1))
+    ranges = []
+    start = 0
+    for tile_start in tile_starts.tolist()[1:] + [len(order)]:
+        if tile_start - start >= BAKE_CHUNK_TEXELS or \
+                tile_start == len(order):
+            ranges.append((start, tile_start))
+            start = tile_start
+    return order, [item for item in ranges if item[0] < item[1]]
+
+
+def _can_fork():
+    """ Forking is only safe for a headless Blender on Linux: a session
+    with a window runs UI and driver threads the child would inherit in an
+    unknown state, and macOS does not support fork after Cocoa starts."""
+    return (bpy.app.background and sys.platform.startswith('linux')
+            and 'fork' in multiprocessing.get_all_start_methods())
+
+
+def _cast_all(ranges, processes):
+    if processes > 1 and _can_fork():
+        pool_context = multiprocessing.get_context('fork')
+        with pool_context.Pool(processes, initializer=_init_worker) as pool:
+            return pool.map(_cast_range_args, ranges)
+    _init_worker()
+    return [_cast_range(start, stop) for start, stop in ranges]
+
+
+# BAKING
+
+def dilate(pixels, filled, iterations=DILATE_PIXELS):
+    """ Grow the baked texels into the empty ones around them, so texture
+    filtering near UV seams does not pick up the background."""
+    for _ in range(iterations):
+        if filled.all():
+            break
+        total = np.zeros_like(pixels)
+        count = np.zeros(filled.shape, dtype=np.float32)
+        for axis, shift in ((0, 1), (0, -1), (1, 1), (1, -1)):
+            total += np.roll(pixels * filled[..., None], shift, axis=axis)
+            count += np.roll(filled, shift, axis=axis)
+        grow = ~filled & (count > 0)
+        pixels[grow] = total[grow] / count[grow][:, None]
+        filled = filled | grow
+    return pixels
+
+
+def bake_normal_map(high, low, size, max_distance=DEFAULT_MAX_DISTANCE,
+                    processes=None):
+    """ Tangent space normal map of the high poly surface over the UVs of
+    the low poly mesh, as a (size, size, 4) float array.
+
+    Each texel casts a ray along the inverted low poly normal, from a cage
+    max_distance (relative to the bounding box) outside the surface. Texels
+    whose ray misses keep the low poly normal.
+    """
+    processes = processes or os.cpu_count() or 1
+    pixels, triangles, barycentric = rasterize_uvs(low['uvs'], size)
+    positions = _interpolate(low['positions'], triangles, barycentric)
+    normals = _normalize(_interpolate(low['normals'], triangles,
+                                      barycentric))
+    tangents = _interpolate(low['tangents'], triangles, barycentric)
+    # Gram-Schmidt, since the interpolated tangent drifts off the normal.
+    tangents = _normalize(tangents - normals * np.einsum(
+        'ij,ij->i', tangents, normals)[:, None])
+    bitangents = np.cross(normals, tangents) \
+        * low['signs'][triangles, 0][:, None]
+
+    extent = low['positions'].reshape(-1, 3)
+    distance = max_distance * float(np.linalg.norm(
+        extent.max(axis=0) - extent.min(axis=0)))
+    order, ranges = _tile_ranges(pixels, size)
+    _bake_state.update({
+        'high': high,
+        'origins': (positions + normals * distance)[order],
+        'directions': -normals[order],
+        'reach': 2 * distance,
+    })
+    try:
+        high_normals = np.concatenate(_cast_all(ranges, processes))
+    finally:
+        _bake_state.clear()
+
+    high_normals_sorted = np.empty_like(high_normals)
+    high_normals_sorted[order] = high_normals
+    missed = np.isnan(high_normals_sorted[:, 0])
+    high_normals_sorted[missed] = normals[missed]
+    tangent_space = np.stack((
+        np.einsum('ij,ij->i', high_normals_sorted, tangents),
+        np.einsum('ij,ij->i', high_normals_sorted, bitangents),
+        np.einsum('ij,ij->i', high_normals_sorted, normals),
+    ), axis=-1)
+
+    image = np.zeros((size * size, 4), dtype=np.float32)
+    image[:] = (0.5, 0.5, 1.0, 1.0)
+    image[pixels, :3] = tangent_space * 0.5 + 0.5
+    filled = np.zeros(size * size, dtype=bool)
+    filled[pixels] = True
+    image = dilate(image.reshape(size, size, 4), filled.reshape(size, size))
+    return image
+
+
+def create_normal_image(name, pixels):
+    size = pixels.shape[0]
+    image = bpy.data.images.get(name)
+    if image is not None and tuple(image.size) != (size, size):
+        bpy.data.images.remove(image)
+        image = None
+    if image is None:
+        image = bpy.data.images.new(name, size, size, alpha=False)
+    image.colorspace_settings.name = 'Non-Color'
+    image.pixels.foreach_set(pixels.ravel())
+    image.file_format = 'PNG'
+    image.pack()
+    return image
+
+
+def link_normal_map(material, image, uv_map):
+    """ Feed image into the Normal input of the Principled BSDF of
+    material through a tangent space Normal Map node. The nodes of an
+    earlier bake are reused."""
+    if material is None or not material.use_nodes:
+        return False
+    nodes = material.node_tree.nodes
+    links = material.node_tree.links
+    principled = next((node for node in nodes
+                       if node.type == 'BSDF_PRINCIPLED'), None)
+    if principled is None:
+        return False
+    for link in list(principled.inputs['Normal'].links):
+        links.remove(link)
+    texture = nodes.get(NORMAL_TEXTURE_NODE)
+    if texture is None:
+        texture = nodes.new('ShaderNodeTexImage')
+        texture.name = NORMAL_TEXTURE_NODE
+        texture.location = principled.location.x - 600, \
+            principled.location.y - 400
+    texture.image = image
+    normal_map = nodes.get(NORMAL_MAP_NODE)
+    if normal_map is None:
+        normal_map = nodes.new('ShaderNodeNormalMap')
+        normal_map.name = NORMAL_MAP_NODE
+        normal_map.location = principled.location.x - 300, \
+            principled.location.y - 400
+    normal_map.space = 'TANGENT'
+    normal_map.uv_map = uv_map
+    links.new(texture.outputs['Color'], normal_map.inputs['Color'])
+    links.new(normal_map.outputs['Normal'], principled.inputs['Normal'])
+    return True
@@ -15,10 +15,80 @@
 
 # Copyright (C) 2021 Wendell.Yang
 
+import json
+import os
+import tempfile
+
 import bpy
 from bpy_extras.io_utils import ExportHelper
 
-from .spark_operators_mixin import SparkOperatorsMixin
+from .spark_glb_writer import (
+    can_fast_export,
+    write_glb,
+)
+from .spark_export_cache import (
+    fetch_cached_export,
+    fingerprint_objects,
+    store_export,
+)
+from .spark_operators_mixin import (
+    get_primary_object,
+    get_target_objects,
+    select_target_objects,
+    SparkOperatorsMixin,
+)
+from .spark_operators_optimization import (
+    create_lod_objects,
+    decimate_to_triangle_budget,
+    generate_lod_chain,
+    LOD_RATIOS,
+)
+from .spark_operators_scale import bake_pending_resize
+
+# Temporary objects of an LOD export must not replace the ones generated
+# from the panel.
+EXPORT_LOD_SUFFIX = '_LOD{}_export'
+
+COMPRESSION_ITEMS = [
+    ('NONE', '无', 'Uncompressed float vertex data', 1),
+    ('DRACO', 'Draco', 'Draco mesh compression through the glTF add-on', 2),
+    ('QUANTIZE', '量化', 'KHR_mesh_quantization with vertex fetch '
+     'reordering, written by the fast exporter', 3),
+]
+
+
+class SparkARToolkitExportSettings(bpy.types.PropertyGroup):
+    useFastExporter: bpy.props.BoolProperty(
+        name='Fast exporter',
+        description='Write static meshes directly, without the glTF add-on',
+        default=False,
+    )
+    exportLods: bpy.props.BoolProperty(
+        name='Export LODs',
+        description='Write one GLB per level of detail and a manifest',
+        default=False,
+    )
+    optimizeVertexCache: bpy.props.BoolProperty(
+        name='Optimize vertex cache',
+        description='Reorder triangles and vertices for the GPU caches, '
+                    'with the fast exporter only',
+        default=False,
+    )
+    compression: bpy.props.EnumProperty(
+        name='Compression',
+        items=COMPRESSION_ITEMS,
+        default='NONE',
+    )
+    dracoLevel: bpy.props.IntProperty(
+        name='Draco level', default=6, min=0, max=10)
+    dracoPositionBits: bpy.props.IntProperty(
+        name='Position bits', default=14, min=0, max=30)
+    dracoNormalBits: bpy.props.IntProperty(
+        name='Normal bits', default=10, min=0, max=30)
+    dracoTexcoordBits: bpy.props.IntProperty(
+        name='UV bits', default=12, min=0, max=30)
+    dracoCompareSize: bpy.props.BoolProperty(
+        name='Compare with uncompressed', default=False)
 
 
 class OBJECT_OT_SparkOperator_ExportForSparkAR(bpy.types.Operator,
@@ -37,23 +107,120 @@ class OBJECT_OT_SparkOperator_ExportForSparkAR(bpy.types.Operator,
         options={'HIDDEN'},
         maxlen=255,
     )
+    use_export_cache: bpy.props.BoolProperty(
+        name='Use export cache',
+        description='Reuse the previous export when nothing changed',
+        default=True,
+    )
+    use_fast_exporter: bpy.props.BoolProperty(
+        name='Fast exporter',
+        description='Write static meshes directly, without the glTF add-on',
+        default=False,
+    )
+    export_lods: bpy.props.BoolProperty(
+        name='Export LODs',
+        description='Write one GLB per level of detail and a manifest',
+        default=False,
+    )
+    optimize_vertex_cache: bpy.props.BoolProperty(
+        name='Optimize vertex cache',
+        description='Reorder triangles and vertices for the GPU caches, '
+                    'with the fast exporter only',
+        default=False,
+    )
+    compression: bpy.props.EnumProperty(
+        name='Compression',
+        items=COMPRESSION_ITEMS,
+        default='NONE',
+    )
+    compare_uncompressed: bpy.props.BoolProperty(
+        name='Compare with uncompressed',
+        description='Also export without Draco to report the saving; '
+                    'doubles the export time',
+        default=False,
+    )
+    draco_level: bpy.props.IntProperty(
+        name='Draco level', default=6, min=0, max=10)
+    draco_position_bits: bpy.props.IntProperty(
+        name='Position bits', default=14, min=0, max=30)
+    draco_normal_bits: bpy.props.IntProperty(
+        name='Normal bits', default=10, min=0, max=30)
+    draco_texcoord_bits: bpy.props.IntProperty(
+        name='UV bits', default=12, min=0, max=30)
 
     def execute(self, context):
+        bake_pending_resize()
+        objects = get_target_objects(context)
+        select_target_objects(context, objects)
+        settings = get_primary_object(context, objects).sparkar_optimization
+        if settings.EnforceTriangleBudget:
+            decimate_to_triangle_budget(context, objects,
+                                        settings.TargetTriangleCount)
         if bpy.ops.object.spark_decimation.poll():
             bpy.ops.object.spark_decimation()
 
         self.tag_from_plugin(context)
-        self._export_mesh()
+        if self.export_lods:
+            self._export_lods(context, objects, settings.TargetTriangleCount)
+            self.report({'INFO'}, '导出成功 (LOD)')
+            return {'FINISHED'}
+        if not self.use_export_cache:
+            self._export_and_report(context, objects)
+            return {'FINISHED'}
 
-        self.report({'INFO'}, '导出成功')
+        export_settings = self._gltf_export_settings()
+        export_settings['fast'] = self._use_fast_exporter(objects)
+        export_settings['compression'] = self.compression
+        export_settings['optimize_vertex_cache'] = (
+            self.optimize_vertex_cache and export_settings['fast'])
+        if self.compression == 'DRACO':
+            export_settings.update(self._draco_export_settings())
+        key = fingerprint_objects(objects, export_settings)
+        if fetch_cached_export(key, self.filepath):
+            self.report({'INFO'}, '导出成功 (缓存)')
+            return {'FINISHED'}
+        self._export_and_report(context, objects)
+        store_export(key, self.filepath)
 
         return {'FINISHED'}
 
-    def _export_mesh(self):
-        bpy.ops.export_scene.gltf(
+    def _export_and_report(self, context, objects):
+        """ Export and report the size. Quantized exports know their size
+        with float attributes; Draco exports only measure an uncompressed
+        export when compare_uncompressed is set."""
+        if self.compression == 'NONE':
+            self._export_mesh(context, objects)
+            self.report({'INFO'}, '导出成功')
+            return
+        if (self.compression == 'QUANTIZE'
+                and not self._use_fast_exporter(objects)):
+            self._export_mesh(context, objects)
+            self.report({'WARNING'}, '模型不支持快速导出, 未量化')
+            return
+        before = None
+        if self.compression == 'DRACO' and self.compare_uncompressed:
+            fd, uncompressed_path = tempfile.mkstemp(suffix='.glb')
+            os.close(fd)
+            try:
+                self._export_mesh(context, objects, uncompressed_path,
+                                  compressed=False)
+                before = os.path.getsize(uncompressed_path)
+            finally:
+                os.remove(uncompressed_path)
+        sizes = self._export_mesh(context, objects)
+        if sizes is not None:
+            before = sizes[1]
+        after = os.path.getsize(self.filepath)
+        if not before:
+            self.report({'INFO'}, '导出成功 {:.1f} KB'.format(after / 1024))
+            return
+        self.report({'INFO'}, '导出成功 {:.1f} KB → {:.1f} KB ({:+.0%})'
+                    .format(before / 1024, after / 1024, after / before - 1))
+
+    def _gltf_export_settings(self):
+        return dict(
             # Format
             export_format='GLB',
-            filepath=self.filepath,
             check_existing=False,
 
             # Setup
@@ -80,3 +247,75 @@ class OBJECT_OT_SparkOperator_ExportForSparkAR(bpy.types.Operator,
             export_animations=True,
             export_force_sampling=False
         )
+
+    def _draco_export_settings(self):
+        return dict(
+            export_draco_mesh_compression_enable=True,
+            export_draco_mesh_compression_level=self.draco_level,
+            export_draco_position_quantization=self.draco_position_bits,
+            export_draco_normal_quantization=self.draco_normal_bits,
+            export_draco_texcoord_quantization=self.draco_texcoord_bits,
+        )
+
+    def _use_fast_exporter(self, objects):
+        if self.compression == 'DRACO':
+            return False
+        # Quantized output is only written by the fast exporter.
+        return ((self.use_fast_exporter or self.compression == 'QUANTIZE')
+                and can_fast_export(objects))
+
+    def _export_mesh(self, context, objects, filepath=None,
+                     compressed=True):
+        """ Export objects to filepath. The fast exporter returns the
+        file size and the size with float attributes, the glTF add-on
+        None."""
+        filepath = filepath or self.filepath
+        if self._use_fast_exporter(objects):
+            quantize = compressed and self.compression == 'QUANTIZE'
+            return write_glb(context, objects, filepath, quantize=quantize,
+                             reorder=quantize,
+                             optimize_cache=self.optimize_vertex_cache)
+        if self.optimize_vertex_cache:
+            # The glTF add-on keeps the face order of the scene meshes,
+            # which an export must not rewrite.
+            self.report({'WARNING'}, '模型不支持快速导出, 未优化顶点缓存')
+        settings = self._gltf_export_settings()
+        if compressed and self.compression == 'DRACO':
+            settings.update(self._draco_export_settings())
+        bpy.ops.export_scene.gltf(filepath=filepath, **settings)
+
+    def _export_lods(self, context, objects, budget):
+        """ Export LOD0 to the chosen path, LODn to <name>_LODn.glb next to
+        it, and describe the chain in <name>.lods.json."""
+        levels_per_object = [generate_lod_chain(context, obj, budget)
+                             for obj in objects]
+        lod_objects = [create_lod_objects(context, obj, levels,
+                                          EXPORT_LOD_SUFFIX)
+                       for obj, levels in zip(objects, levels_per_object)]
+        base, extension = os.path.splitext(self.filepath)
+        manifest = {'budget': budget, 'levels': []}
+        try:
+            for index, ratio in enumerate(LOD_RATIOS):
+                filepath = (self.filepath if index == 0
+                            else '{}_LOD{}{}'.format(base, index, extension))
+                level_objects = [lods[index] for lods in lod_objects]
+                select_target_objects(context, level_objects)
+                self._export_mesh(context, level_objects, filepath)
+                manifest['levels'].append({
+                    'file': os.path.basename(filepath),
+                    'bytes': os.path.getsize(filepath),
+                    'ratio': ratio,
+                    'triangles': sum(levels[index][1]
+                                     for levels in levels_per_object),
+                })
+        finally:
+            for lods in lod_objects:
+                for lod_object in lods:
+                    mesh = lod_object.data
+                    bpy.data.objects.remove(lod_object)
+                    bpy.data.meshes.remove(mesh)
+            select_target_objects(context, objects)
+
+        with open(base + '.lods.json', 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+
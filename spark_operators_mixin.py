@@ -13,19 +13,76 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import bpy
+
+from .spark_profiling import profiled_method
+
 SPARK_ADDON_TAG = 'spark_blender_addon'
+# Custom property marking the generated levels of detail, which are never
+# targets themselves.
+SPARK_LOD_TAG = 'sparkar_lod'
+
+
+class SparkARToolkitTargetSettings(bpy.types.PropertyGroup):
+    targetMode: bpy.props.EnumProperty(
+        name='Target',
+        items=[
+            ('SELECTION', '选中的网格', '', 1),
+            ('COLLECTION', '当前集合', '', 2),
+        ],
+        description='Meshes processed by the toolkit operators',
+        default='SELECTION',
+    )
+
+
+def get_target_objects(context):
+    """ Meshes the operators work on: the selection or the active
+    collection, depending on the target setting of the screen."""
+    settings = getattr(context.screen, 'sparkar_target', None)
+    if settings is not None and settings.targetMode == 'COLLECTION':
+        view_layer_objects = context.view_layer.objects
+        objects = [obj for obj in context.collection.all_objects
+                   if obj.name in view_layer_objects]
+    else:
+        objects = context.selected_objects
+    return [obj for obj in objects
+            if obj.type == 'MESH' and SPARK_LOD_TAG not in obj]
+
+
+def get_primary_object(context, objects=None):
+    if objects is None:
+        objects = get_target_objects(context)
+    if context.active_object in objects:
+        return context.active_object
+    return objects[0] if objects else None
 
 
 def is_context_valid(context):
-    return (len(context.selected_objects) == 1
-            and context.active_object is not None
-            and context.active_object.type == 'MESH')
+    return len(get_target_objects(context)) > 0
+
+
+def select_target_objects(context, objects):
+    """ Make the targets the only selected objects, so operators that act
+    on the selection process exactly them."""
+    for obj in context.selected_objects:
+        if obj not in objects:
+            obj.select_set(False)
+    for obj in objects:
+        obj.select_set(True)
+    context.view_layer.objects.active = get_primary_object(context, objects)
 
 
 class SparkOperatorsMixin(object):
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if 'execute' in cls.__dict__:
+            cls.execute = profiled_method('operator', cls.bl_idname)(
+                cls.execute)
+
     @classmethod
     def poll(cls, context):
         return is_context_valid(context)
 
     def tag_from_plugin(self, context):
-        context.active_object[SPARK_ADDON_TAG] = 1
+        for obj in get_target_objects(context):
+            obj[SPARK_ADDON_TAG] = 1
@@ -13,43 +13,308 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import bmesh
 import bpy
+from mathutils import Matrix
 
 from .spark_operators_mixin import (
+    get_primary_object,
+    get_target_objects,
     is_context_valid,
+    select_target_objects,
+    SPARK_LOD_TAG,
     SparkOperatorsMixin,
 )
+from .spark_asset_state import (
+    content_hash,
+    record_step,
+    recording_step,
+)
+from .spark_atlas import bake_texture_atlas
+from .spark_decimate import (
+    DECIMATION_ENGINES,
+    DecimationJob,
+    decimate_mesh,
+    read_mesh_arrays,
+    write_mesh_arrays,
+)
+from .spark_mesh_cleanup import cleanup_mesh
+from .spark_mesh_stats import count_mesh_triangles, invalidate_object
+from .spark_normal_bake import (
+    DEFAULT_MAX_DISTANCE,
+    bake_normal_map,
+    create_normal_image,
+    link_normal_map,
+    read_high_poly,
+    read_low_poly,
+)
+from .spark_operators_scale import apply_matrix_to_objects
+from .spark_textures import (
+    collect_images,
+    downscale_images,
+)
+from .spark_vertex_cache import reorder_mesh
 
 SPARK_DECIMATE_MODIFIER_NAME = 'SparkDecimateModifier'
 
+TRIS_COUNT_ERROR = 50000
+TRIS_COUNT_WARNING = 30000
+
+# Share of the triangle budget given to each level of detail.
+LOD_RATIOS = (1.0, 0.5, 0.2, 0.05)
+LOD_SUFFIX = '_LOD{}'
+LOD_COLLECTION_SUFFIX = '_LODs'
+
+DECIMATION_ENGINE_ITEMS = [
+    ('MODIFIER', '修改器', 'Blender decimate modifier'),
+    ('QUADRIC', '二次误差', 'Quadric error edge collapse that keeps UV '
+     'seams, material borders and sharp edges'),
+]
+
+ATLAS_RESOLUTION_ITEMS = [
+    ('512', '512', ''),
+    ('1024', '1024', ''),
+    ('2048', '2048', ''),
+    ('4096', '4096', ''),
+]
+
 
 def update_sparkar_optimization_settings(context):
     if not is_context_valid(context):
         return
-    settings = context.active_object.sparkar_optimization
+    obj = get_primary_object(context)
+    settings = obj.sparkar_optimization
     percentage = settings.InvertedReducePercentage
-    if context.object.modifiers.find(SPARK_DECIMATE_MODIFIER_NAME) != -1:
+    if obj.modifiers.find(SPARK_DECIMATE_MODIFIER_NAME) != -1:
         ratio_field = (100 - percentage) / 100
-        ratio_modifier = context.object.modifiers[
-            SPARK_DECIMATE_MODIFIER_NAME].ratio
+        ratio_modifier = obj.modifiers[SPARK_DECIMATE_MODIFIER_NAME].ratio
         if ratio_field != ratio_modifier:
             settings.InvertedReducePercentage = (1 - ratio_modifier) * 100
 
 
+def ensure_spark_decimate_modifier(obj):
+    modifier = obj.modifiers.get(SPARK_DECIMATE_MODIFIER_NAME)
+    if modifier is None:
+        modifier = obj.modifiers.new(SPARK_DECIMATE_MODIFIER_NAME,
+                                     'DECIMATE')
+        modifier.decimate_type = 'COLLAPSE'
+    return modifier
+
+
+def apply_spark_decimate_modifier(context, obj):
+    """ Bake the Spark decimate modifier of obj into its mesh and remove
+    the modifier, like modifier_apply but without going through an
+    operator: the other modifiers stay in the stack unapplied. The result
+    is written into obj.data itself, so every other user of the mesh gets
+    it too. Returns False, leaving obj untouched, when the mesh has shape
+    keys."""
+    modifier = obj.modifiers[SPARK_DECIMATE_MODIFIER_NAME]
+    if obj.data.shape_keys is not None:
+        return False
+    shown = [(other, other.show_viewport) for other in obj.modifiers]
+    for other, _ in shown:
+        other.show_viewport = other == modifier
+    try:
+        depsgraph = context.evaluated_depsgraph_get()
+        result = bpy.data.meshes.new_from_object(
+            obj.evaluated_get(depsgraph), preserve_all_data_layers=True,
+            depsgraph=depsgraph)
+    finally:
+        for other, show_viewport in shown:
+            other.show_viewport = show_viewport
+
+    bm = bmesh.new()
+    try:
+        bm.from_mesh(result)
+        bm.to_mesh(obj.data)
+    finally:
+        bm.free()
+        bpy.data.meshes.remove(result)
+    obj.data.update()
+    obj.modifiers.remove(modifier)
+    return True
+
+
 def update_spark_decimation_ratio(self, context):
-    if not is_context_valid(context):
+    percentage = self.InvertedReducePercentage
+    if percentage == 0:
         return
-    percentage = context.active_object.sparkar_optimization\
-        .InvertedReducePercentage
-    if percentage != 0:
-        if context.object.modifiers.find(SPARK_DECIMATE_MODIFIER_NAME) == -1:
-            bpy.ops.object.mode_set(mode='OBJECT')
-            bpy.ops.object.modifier_add(type='DECIMATE')
-            context.object.modifiers[-1].name = SPARK_DECIMATE_MODIFIER_NAME
-            context.object.modifiers[
-                SPARK_DECIMATE_MODIFIER_NAME].decimate_type = 'COLLAPSE'
-        ratio = (100 - percentage) / 100
-        context.object.modifiers[SPARK_DECIMATE_MODIFIER_NAME].ratio = ratio
+    objects = get_target_objects(context)
+    if self.id_data not in objects:
+        objects = [self.id_data]
+    for obj in objects:
+        modifier = ensure_spark_decimate_modifier(obj)
+        modifier.ratio = (100 - percentage) / 100
+
+
+def _evaluate_tri_count_at_ratio(context, objects, modifiers, ratio):
+    for modifier in modifiers:
+        modifier.ratio = ratio
+    depsgraph = context.evaluated_depsgraph_get()
+    return sum(count_mesh_triangles(obj.evaluated_get(depsgraph).data)
+               for obj in objects)
+
+
+def decimate_to_triangle_budget(context, objects, budget, tolerance=0.02,
+                                max_evaluations=8):
+    """ Find the decimate ratio that lands just under the triangle budget.
+
+    Runs a secant search on the Spark decimate modifier ratio shared by
+    all objects, guarded by a bisection bracket, and leaves the modifiers
+    set to the best ratio found. The modifiers are never applied, so
+    every step is a single depsgraph evaluation of the modifier stacks.
+    Returns (ratio, tri_count, evaluations).
+    """
+    modifiers = [ensure_spark_decimate_modifier(obj) for obj in objects]
+    source_count = _evaluate_tri_count_at_ratio(context, objects, modifiers,
+                                                1.0)
+    evaluations = 1
+    if source_count <= budget or budget <= 0:
+        for obj, modifier in zip(objects, modifiers):
+            obj.modifiers.remove(modifier)
+            obj.sparkar_optimization.InvertedReducePercentage = 0
+        return 1.0, source_count, evaluations
+
+    target = budget * (1 - tolerance / 2)
+    low, high = 0.0, 1.0
+    best, best_count = None, 0
+    previous, previous_count = 1.0, source_count
+    ratio = budget / source_count
+    while evaluations < max_evaluations:
+        count = _evaluate_tri_count_at_ratio(context, objects, modifiers,
+                                             ratio)
+        evaluations += 1
+        if count <= budget:
+            low = ratio
+            if best is None or count > best_count:
+                best, best_count = ratio, count
+            if count >= budget * (1 - tolerance):
+                break
+        else:
+            high = ratio
+
+        # Secant step through the last two evaluations, falling back to
+        # bisection whenever it would leave the bracket.
+        next_ratio = (low + high) / 2
+        if count != previous_count:
+            secant = ratio + (target - count) * (previous - ratio) / (
+                previous_count - count)
+            if low < secant < high:
+                next_ratio = secant
+        previous, previous_count = ratio, count
+        ratio = next_ratio
+
+    # Nothing landed under the budget yet: keep bisecting below the
+    # lowest ratio over it, ending at the bottom of the bracket, so the
+    # count returned is always the one of the ratio applied.
+    while best is None:
+        ratio = low if evaluations >= 2 * max_evaluations else (
+            (low + high) / 2)
+        count = _evaluate_tri_count_at_ratio(context, objects, modifiers,
+                                             ratio)
+        evaluations += 1
+        if count <= budget or ratio == low:
+            best, best_count = ratio, count
+        else:
+            high = ratio
+    for obj, modifier in zip(objects, modifiers):
+        modifier.ratio = best
+        # Item assignment skips the update callback, which would otherwise
+        # push the ratio to every target once per object.
+        obj.sparkar_optimization['InvertedReducePercentage'] = (
+            (1 - best) * 100)
+    return best, best_count, evaluations
+
+
+def generate_lod_chain(context, obj, budget, ratios=LOD_RATIOS):
+    """ Build one mesh per level of detail from a single evaluation of obj.
+
+    Every level is decimated from the previous one rather than from the
+    source, down to budget * ratio triangles. Returns a list of
+    (mesh, tri_count) pairs; the meshes are new, unused data-blocks.
+    """
+    depsgraph = context.evaluated_depsgraph_get()
+    source = bpy.data.meshes.new_from_object(obj.evaluated_get(depsgraph))
+    source_count = count_mesh_triangles(source)
+
+    work_object = bpy.data.objects.new(obj.name + '_lod_work', source)
+    context.scene.collection.objects.link(work_object)
+    levels = []
+    previous, previous_count = source, source_count
+    try:
+        for ratio in ratios:
+            target = int(budget * ratio)
+            if previous_count <= target:
+                mesh, count = previous.copy(), previous_count
+            else:
+                work_object.data = previous
+                _, count, _ = decimate_to_triangle_budget(
+                    context, [work_object], target)
+                depsgraph = context.evaluated_depsgraph_get()
+                mesh = bpy.data.meshes.new_from_object(
+                    work_object.evaluated_get(depsgraph))
+                work_object.modifiers.clear()
+            levels.append((mesh, count))
+            previous, previous_count = mesh, count
+    finally:
+        bpy.data.objects.remove(work_object)
+        bpy.data.meshes.remove(source)
+    return levels
+
+
+def _find_layer_collection(layer_collection, collection):
+    if layer_collection.collection == collection:
+        return layer_collection
+    for child in layer_collection.children:
+        found = _find_layer_collection(child, collection)
+        if found is not None:
+            return found
+    return None
+
+
+def lod_collection(context, obj):
+    """ Collection holding the LODs of obj: a child of its collection,
+    excluded from the view layer so the LODs neither overlap obj in the
+    viewport nor become targets."""
+    name = obj.name + LOD_COLLECTION_SUFFIX
+    collection = bpy.data.collections.get(name)
+    if collection is None:
+        collection = bpy.data.collections.new(name)
+        parent = (obj.users_collection[0] if obj.users_collection
+                  else context.scene.collection)
+        parent.children.link(collection)
+    layer_collection = _find_layer_collection(
+        context.view_layer.layer_collection, collection)
+    if layer_collection is not None:
+        layer_collection.exclude = True
+    return collection
+
+
+def create_lod_objects(context, obj, levels, suffix=LOD_SUFFIX,
+                       collection=None):
+    """ Link one object per LOD mesh into collection, or next to obj,
+    replacing older ones and their meshes."""
+    lod_objects = []
+    for index, (mesh, _) in enumerate(levels):
+        name = obj.name + suffix.format(index)
+        previous = bpy.data.objects.get(name)
+        if previous is not None:
+            previous_mesh = previous.data
+            bpy.data.objects.remove(previous)
+            if previous_mesh is not None and previous_mesh.users == 0:
+                bpy.data.meshes.remove(previous_mesh)
+        mesh.name = name
+        lod_object = bpy.data.objects.new(name, mesh)
+        lod_object.matrix_world = obj.matrix_world
+        for key in obj.keys():
+            if key != 'sparkar_optimization':
+                lod_object[key] = obj[key]
+        lod_object[SPARK_LOD_TAG] = index
+        for target in ([collection] if collection is not None
+                       else obj.users_collection):
+            target.objects.link(lod_object)
+        lod_objects.append(lod_object)
+    return lod_objects
 
 
 class SparkARToolkitOptimizationSettings(bpy.types.PropertyGroup):
@@ -58,6 +323,34 @@ class SparkARToolkitOptimizationSettings(bpy.types.PropertyGroup):
         update=update_spark_decimation_ratio,
         default=0, min=0, precision=0, name='',
     )
+    TargetTriangleCount: bpy.props.IntProperty(
+        name='Triangle budget',
+        default=TRIS_COUNT_WARNING, min=0,
+    )
+    EnforceTriangleBudget: bpy.props.BoolProperty(
+        name='Enforce on export',
+        default=False,
+    )
+    LodTriangleCounts: bpy.props.IntVectorProperty(
+        name='LOD triangle counts',
+        size=len(LOD_RATIOS),
+        default=(0,) * len(LOD_RATIOS),
+    )
+    DecimationEngine: bpy.props.EnumProperty(
+        name='Decimation engine',
+        items=DECIMATION_ENGINE_ITEMS,
+        default='MODIFIER',
+    )
+    AtlasResolution: bpy.props.EnumProperty(
+        name='Atlas resolution',
+        items=ATLAS_RESOLUTION_ITEMS,
+        default='1024',
+    )
+    NormalMapResolution: bpy.props.EnumProperty(
+        name='Normal map resolution',
+        items=ATLAS_RESOLUTION_ITEMS,
+        default='1024',
+    )
 
 
 class OBJECT_OT_SparkOperator_MeshCleanUp(bpy.types.Operator,
@@ -71,38 +364,61 @@ class OBJECT_OT_SparkOperator_MeshCleanUp(bpy.types.Operator,
     REMOVE_DOUBLES_THRESHOLD = 0.0001
     NONPLANAR_ANGLE_LIMIT = 0.0872665
 
-    def _cleanup_textures(self, context):
-        textures_list = []
-        for material_slot in bpy.context.active_object.material_slots:
-            if material_slot.material and material_slot.material.node_tree:
-                nodes = material_slot.material.node_tree.nodes
-                images = [node for node in nodes if node.type == 'TEX_IMAGE']
-                textures_list.extend(images)
-
-        for texture in textures_list:
-            if texture.image and texture.image.size[0] > self.TEXTURE_MAX_SIZE:
-                name = texture.image.name
-                bpy.data.images[name].scale(self.TEXTURE_MAX_SIZE,
-                                            self.TEXTURE_MAX_SIZE)
-                bpy.data.images[name].save()
-                bpy.data.images[name].reload()
+    def _cleanup_textures(self, context, objects):
+        downscale_images(collect_images(objects), self.TEXTURE_MAX_SIZE)
+
+    def execute(self, context):
+        objects = get_target_objects(context)
+        select_target_objects(context, objects)
+        if context.mode != 'OBJECT':
+            bpy.ops.object.mode_set(mode='OBJECT')
+
+        hashes = {}
+        image_digests = {}
+        with recording_step(objects, 'cleanup', {
+                'remove_doubles': self.REMOVE_DOUBLES_THRESHOLD,
+                'nonplanar_angle': self.NONPLANAR_ANGLE_LIMIT},
+                hashes, image_digests):
+            for mesh in set(obj.data for obj in objects):
+                cleanup_mesh(mesh, self.REMOVE_DOUBLES_THRESHOLD,
+                             self.NONPLANAR_ANGLE_LIMIT)
+
+        with recording_step(objects, 'texture_downscale',
+                            {'max_size': self.TEXTURE_MAX_SIZE},
+                            hashes, image_digests):
+            self._cleanup_textures(context, objects)
+            image_digests.clear()
+        for obj in objects:
+            invalidate_object(obj.name)
+
+        with recording_step(objects, 'transform_apply', {},
+                            hashes, image_digests):
+            apply_matrix_to_objects(objects, Matrix.Identity(4))
+
+        return {'FINISHED'}
+
+
+class OBJECT_OT_SparkOperator_OptimizeVertexCache(bpy.types.Operator,
+                                                  SparkOperatorsMixin):
+    bl_idname = 'object.spark_optimize_vertex_cache'
+    bl_label = 'Optimize vertex cache'
+    bl_description = ('Reorder triangles and vertices for the GPU vertex '
+                      'cache, overdraw and vertex fetch')
+    bl_options = {'REGISTER', 'UNDO'}
 
     def execute(self, context):
-        bpy.ops.object.mode_set(mode='EDIT')
-        bpy.ops.mesh.delete_loose()
-        bpy.ops.mesh.dissolve_degenerate()
-        bpy.ops.mesh.remove_doubles(threshold=self.REMOVE_DOUBLES_THRESHOLD)
-        bpy.ops.mesh.face_make_planar()
-        bpy.ops.mesh.vert_connect_nonplanar(
-            angle_limit=self.NONPLANAR_ANGLE_LIMIT)
-        bpy.ops.mesh.vert_connect_concave()
-
-        self._cleanup_textures(context)
-
-        bpy.ops.object.mode_set(mode='OBJECT')
-        bpy.ops.object.transform_apply(location=True,
-                                       rotation=True,
-                                       scale=True)
+        if context.mode != 'OBJECT':
+            bpy.ops.object.mode_set(mode='OBJECT')
+        before = after = triangles = 0
+        for mesh in set(obj.data for obj in get_target_objects(context)):
+            count = count_mesh_triangles(mesh)
+            acmr_before, acmr_after = reorder_mesh(mesh)
+            before += acmr_before * count
+            after += acmr_after * count
+            triangles += count
+        if triangles:
+            self.report({'INFO'}, 'ACMR: {:.3f} → {:.3f}'.format(
+                before / triangles, after / triangles))
 
         return {'FINISHED'}
 
@@ -114,8 +430,391 @@ class OBJECT_OT_SparkOperator_Decimation(bpy.types.Operator,
     bl_description = 'Reduce triangles'
     bl_options = {'REGISTER', 'UNDO'}
 
+    lod_chain: bpy.props.BoolProperty(
+        name='LOD chain',
+        description='Generate levels of detail instead of applying',
+        default=False,
+        options={'SKIP_SAVE'},
+    )
+
+    def _generate_lods(self, context):
+        objects = get_target_objects(context)
+        budget = get_primary_object(context, objects)\
+            .sparkar_optimization.TargetTriangleCount
+        for obj in objects:
+            levels = generate_lod_chain(context, obj, budget)
+            create_lod_objects(context, obj, levels,
+                               collection=lod_collection(context, obj))
+            obj.sparkar_optimization.LodTriangleCounts = [
+                count for _, count in levels]
+        return {'FINISHED'}
+
+    def _mesh_users(self, objects):
+        """ Group objects by mesh, yielding (mesh, users, ratio) for the
+        meshes that can be decimated once for all their users: no shape
+        keys, every user targeted and one ratio among them."""
+        groups = {}
+        for obj in objects:
+            groups.setdefault(obj.data, []).append(obj)
+        for mesh, users in groups.items():
+            if mesh.shape_keys is not None:
+                for obj in users:
+                    self.report({'WARNING'},
+                                '{} 有形态键，已跳过'.format(obj.name))
+                continue
+            ratios = {obj.modifiers[SPARK_DECIMATE_MODIFIER_NAME].ratio
+                      for obj in users}
+            if mesh.users > len(users) or len(ratios) > 1:
+                self.report({'WARNING'},
+                            '网格 {} 被未选中的物体共用或减面比例不同，已跳过'
+                            .format(mesh.name))
+                continue
+            yield mesh, users, ratios.pop()
+
+    def _apply_with_engine(self, context, objects, engine):
+        """ Reduce the meshes to the ratio of their decimate modifiers
+        with one of DECIMATION_ENGINES, then drop the modifiers."""
+        image_digests = {}
+        for mesh, users, ratio in self._mesh_users(objects):
+            with recording_step(users, 'decimate', {'ratio': ratio,
+                                                    'engine': engine},
+                                image_digests=image_digests):
+                for obj in users:
+                    obj.modifiers.remove(
+                        obj.modifiers[SPARK_DECIMATE_MODIFIER_NAME])
+                    obj.sparkar_optimization.InvertedReducePercentage = 0
+                decimate_mesh(mesh, int(count_mesh_triangles(mesh) * ratio),
+                              engine)
+            for obj in users:
+                invalidate_object(obj.name)
+        return {'FINISHED'}
+
+    def execute(self, context):
+        if context.mode != 'OBJECT':
+            bpy.ops.object.mode_set(mode='OBJECT')
+        if self.lod_chain:
+            return self._generate_lods(context)
+
+        objects = [obj for obj in get_target_objects(context)
+                   if obj.modifiers.find(SPARK_DECIMATE_MODIFIER_NAME) != -1]
+        if not objects:
+            return {'CANCELLED'}
+
+        engine = get_primary_object(context).sparkar_optimization\
+            .DecimationEngine
+        if engine != 'MODIFIER':
+            return self._apply_with_engine(context, objects, engine)
+
+        # A shared mesh is decimated once through its first user and the
+        # other users only drop their modifier, instead of each getting a
+        # decimated copy of the mesh.
+        image_digests = {}
+        for mesh, users, ratio in self._mesh_users(objects):
+            with recording_step(users, 'decimate', {'ratio': ratio,
+                                                    'engine': 'MODIFIER'},
+                                image_digests=image_digests):
+                apply_spark_decimate_modifier(context, users[0])
+                for obj in users:
+                    modifier = obj.modifiers.get(
+                        SPARK_DECIMATE_MODIFIER_NAME)
+                    if modifier is not None:
+                        obj.modifiers.remove(modifier)
+                    obj.sparkar_optimization.InvertedReducePercentage = 0
+            for obj in users:
+                invalidate_object(obj.name)
+
+        return {'FINISHED'}
+
+
+class OBJECT_OT_SparkOperator_DecimateInBackground(bpy.types.Operator,
+                                                  SparkOperatorsMixin):
+    bl_idname = 'object.spark_decimate_background'
+    bl_label = 'Reduce triangles in background'
+    bl_description = ('Reduce triangles on a worker thread, '
+                      'press Esc to cancel')
+    bl_options = {'REGISTER', 'UNDO'}
+
+    TIMER_INTERVAL = 0.1  # unit: seconds
+
+    _job = None
+    _timer = None
+
+    def _target_triangles(self, obj, tri_count, share):
+        settings = obj.sparkar_optimization
+        if settings.InvertedReducePercentage > 0:
+            return int(tri_count
+                       * (100 - settings.InvertedReducePercentage) / 100)
+        return int(settings.TargetTriangleCount * share)
+
+    def _create_job(self, context):
+        """ Copy the mesh data of the targets, which is all the worker
+        thread gets to see."""
+        objects = get_target_objects(context)
+        meshes = {}
+        for obj in objects:
+            if obj.data.shape_keys is not None:
+                self.report({'WARNING'},
+                            '{} 有形态键，已跳过'.format(obj.name))
+                continue
+            meshes.setdefault(obj.data.name, obj)
+        arrays = {name: read_mesh_arrays(obj.data)
+                  for name, obj in meshes.items()}
+        total = sum(len(data['triangles']) for data in arrays.values())
+        tasks = {}
+        for name, obj in meshes.items():
+            tri_count = len(arrays[name]['triangles'])
+            target = self._target_triangles(obj, tri_count,
+                                            tri_count / max(total, 1))
+            if target < tri_count:
+                tasks[name] = (arrays[name], target)
+        # The scene stays editable while the job runs, so the targets are
+        # looked up again by name and compared by content when it ends.
+        image_digests = {}
+        self._input_hashes = {
+            obj.name: (obj.data.name, content_hash(obj, image_digests))
+            for obj in objects if obj.data.name in tasks}
+        self._targets = {name: target for name, (_, target) in tasks.items()}
+        # The modifier cannot run off the main thread, so it is stood in
+        # for by vertex clustering.
+        engine = get_primary_object(context, objects).sparkar_optimization\
+            .DecimationEngine
+        self._engine = engine if engine in DECIMATION_ENGINES else 'CLUSTER'
+        return DecimationJob(tasks, DECIMATION_ENGINES[self._engine])
+
+    def _finish(self, context):
+        job = self._job
+        if job.error is not None:
+            self.report({'ERROR'}, str(job.error))
+            return {'CANCELLED'}
+        objects = []
+        skipped = set()
+        image_digests = {}
+        for name, (mesh_name, input_hash) in self._input_hashes.items():
+            obj = bpy.data.objects.get(name)
+            if obj is None or obj.type != 'MESH':
+                self.report({'WARNING'}, '{} 已被删除，已跳过'.format(name))
+                continue
+            if (obj.data.name != mesh_name or obj.data.is_editmode
+                    or content_hash(obj, image_digests) != input_hash):
+                self.report({'WARNING'}, '{} 已被修改，已跳过'.format(name))
+                skipped.add(obj.data.name)
+                continue
+            objects.append(obj)
+
+        # Swap all results in during a single call, so the scene never
+        # shows a partly decimated state. A mesh shared with an object
+        # that changed meanwhile is left alone for all its users.
+        written = set()
+        for obj in objects:
+            name = obj.data.name
+            if name in written or name in skipped or name not in job.results:
+                continue
+            write_mesh_arrays(obj.data, job.results[name])
+            written.add(name)
+        for obj in objects:
+            if obj.data.name not in written:
+                continue
+            modifier = obj.modifiers.get(SPARK_DECIMATE_MODIFIER_NAME)
+            if modifier is not None:
+                obj.modifiers.remove(modifier)
+            obj.sparkar_optimization['InvertedReducePercentage'] = 0
+            invalidate_object(obj.name)
+            record_step(obj, 'decimate', {
+                'triangles': self._targets[obj.data.name],
+                'engine': self._engine,
+            }, self._input_hashes[obj.name][1],
+                content_hash(obj, image_digests))
+        return {'FINISHED'}
+
+    def _stop(self, context):
+        wm = context.window_manager
+        if self._timer is not None:
+            wm.event_timer_remove(self._timer)
+            self._timer = None
+        wm.progress_end()
+
+    def execute(self, context):
+        if context.mode != 'OBJECT':
+            bpy.ops.object.mode_set(mode='OBJECT')
+        self._job = self._create_job(context)
+        self._job.run()
+        return self._finish(context)
+
+    def invoke(self, context, event):
+        if context.mode != 'OBJECT':
+            bpy.ops.object.mode_set(mode='OBJECT')
+        self._job = self._create_job(context)
+        if not self._job.tasks:
+            return {'CANCELLED'}
+        wm = context.window_manager
+        wm.progress_begin(0, 100)
+        self._timer = wm.event_timer_add(self.TIMER_INTERVAL,
+                                         window=context.window)
+        self._job.start()
+        wm.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if event.type == 'ESC' and event.value == 'PRESS':
+            self._job.cancel()
+            self._stop(context)
+            self.report({'INFO'}, '已取消')
+            return {'CANCELLED'}
+        if event.type == 'TIMER':
+            context.window_manager.progress_update(
+                int(self._job.progress * 100))
+            if self._job.done.is_set():
+                self._stop(context)
+                return self._finish(context)
+        return {'PASS_THROUGH'}
+
+
+class OBJECT_OT_SparkOperator_DecimateToBudget(bpy.types.Operator,
+                                              SparkOperatorsMixin):
+    bl_idname = 'object.spark_decimate_to_budget'
+    bl_label = 'Decimate to triangle budget'
+    bl_description = 'Find the reduction that fits the triangle budget'
+    bl_options = {'REGISTER', 'UNDO'}
+
+    def execute(self, context):
+        objects = get_target_objects(context)
+        settings = get_primary_object(context, objects).sparkar_optimization
+        _, tri_count, evaluations = decimate_to_triangle_budget(
+            context, objects, settings.TargetTriangleCount)
+        self.report({'INFO'}, '三角形数: {} ({}次计算)'.format(
+            tri_count, evaluations))
+
+        return {'FINISHED'}
+
+
+class OBJECT_OT_SparkOperator_TextureAtlas(bpy.types.Operator,
+                                          SparkOperatorsMixin):
+    bl_idname = 'object.spark_texture_atlas'
+    bl_label = 'Bake texture atlas'
+    bl_description = 'Merge all materials into one atlas material'
+    bl_options = {'REGISTER', 'UNDO'}
+
+    def execute(self, context):
+        objects = get_target_objects(context)
+        if context.mode != 'OBJECT':
+            bpy.ops.object.mode_set(mode='OBJECT')
+        primary = get_primary_object(context, objects)
+        resolution = int(primary.sparkar_optimization.AtlasResolution)
+        try:
+            material = bake_texture_atlas(
+                objects, resolution, name=primary.name + '_Atlas')
+        except ValueError as error:
+            self.report({'ERROR'}, str(error))
+            return {'CANCELLED'}
+        if material is None:
+            return {'CANCELLED'}
+        for obj in objects:
+            invalidate_object(obj.name)
+        self.report({'INFO'}, '已合并为材质 {}'.format(material.name))
+
+        return {'FINISHED'}
+
+
+def _is_shared_material(material, obj):
+    return any(other is not obj and other.data is not obj.data
+               and any(slot.material == material
+                       for slot in other.material_slots)
+               for other in bpy.data.objects)
+
+
+class OBJECT_OT_SparkOperator_BakeNormalMap(bpy.types.Operator,
+                                           SparkOperatorsMixin):
+    bl_idname = 'object.spark_bake_normal_map'
+    bl_label = 'Bake normal map'
+    bl_description = ('Bake the detail of the mesh before decimation into '
+                      'a normal map of the decimated mesh')
+    bl_options = {'REGISTER', 'UNDO'}
+
+    source_object: bpy.props.StringProperty(
+        name='Source',
+        description='High poly object, instead of the mesh before the '
+                    'Spark decimate modifier',
+        default='',
+    )
+    max_distance: bpy.props.FloatProperty(
+        name='Max distance',
+        description='Ray distance, relative to the bounding box diagonal',
+        default=DEFAULT_MAX_DISTANCE, min=0.0001, max=1.0,
+    )
+    processes: bpy.props.IntProperty(
+        name='Processes',
+        description='Worker processes in background mode on Linux, '
+                    '0 for one per CPU',
+        default=0, min=0,
+    )
+
+    def _high_poly_mesh(self, context, obj):
+        """ (mesh, matrix_world) of the bake source, as a new mesh."""
+        source = bpy.data.objects.get(self.source_object)
+        if source is not None:
+            depsgraph = context.evaluated_depsgraph_get()
+            return (bpy.data.meshes.new_from_object(
+                source.evaluated_get(depsgraph)), source.matrix_world)
+        modifier = obj.modifiers.get(SPARK_DECIMATE_MODIFIER_NAME)
+        if modifier is None:
+            return None, None
+        show_viewport = modifier.show_viewport
+        modifier.show_viewport = False
+        try:
+            depsgraph = context.evaluated_depsgraph_get()
+            mesh = bpy.data.meshes.new_from_object(
+                obj.evaluated_get(depsgraph))
+        finally:
+            modifier.show_viewport = show_viewport
+        return mesh, obj.matrix_world
+
+    def _bake(self, context, obj, size):
+        high_mesh, high_matrix = self._high_poly_mesh(context, obj)
+        if high_mesh is None:
+            self.report({'WARNING'}, '{} 没有减面, 已跳过'.format(obj.name))
+            return False
+        depsgraph = context.evaluated_depsgraph_get()
+        low_mesh = bpy.data.meshes.new_from_object(
+            obj.evaluated_get(depsgraph))
+        try:
+            if low_mesh.uv_layers.active is None:
+                self.report({'WARNING'}, '{} 没有UV, 已跳过'.format(obj.name))
+                return False
+            high = read_high_poly(high_mesh, high_matrix)
+            low = read_low_poly(low_mesh, obj.matrix_world)
+        finally:
+            bpy.data.meshes.remove(high_mesh)
+            bpy.data.meshes.remove(low_mesh)
+
+        pixels = bake_normal_map(high, low, size, self.max_distance,
+                                 self.processes)
+        image = create_normal_image(obj.name + '_normal', pixels)
+        if not obj.material_slots:
+            material = bpy.data.materials.new(obj.name)
+            material.use_nodes = True
+            obj.data.materials.append(material)
+        uv_map = obj.data.uv_layers.active.name
+        copies = {}
+        for slot in obj.material_slots:
+            material = slot.material
+            if material is not None and _is_shared_material(material, obj):
+                # Every object gets its own normal map, so a material it
+                # shares with other objects is split off first.
+                if material not in copies:
+                    copies[material] = material.copy()
+                slot.material = copies[material]
+            link_normal_map(slot.material, image, uv_map)
+        return True
+
     def execute(self, context):
-        bpy.ops.object.modifier_apply(modifier=SPARK_DECIMATE_MODIFIER_NAME)
-        context.active_object.sparkar_optimization.InvertedReducePercentage = 0
+        if context.mode != 'OBJECT':
+            bpy.ops.object.mode_set(mode='OBJECT')
+        objects = get_target_objects(context)
+        size = int(get_primary_object(context, objects)
+                   .sparkar_optimization.NormalMapResolution)
+        baked = sum(self._bake(context, obj, size) for obj in objects)
+        if not baked:
+            return {'CANCELLED'}
+        self.report({'INFO'}, '已烘焙 {} 张法线贴图'.format(baked))
 
         return {'FINISHED'}
@@ -14,8 +14,49 @@
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import bpy
+import numpy as np
+from mathutils import Matrix, Vector
 
-from .spark_operators_mixin import SparkOperatorsMixin
+from .spark_asset_state import recording_step
+from .spark_bounds import get_world_bounds
+from .spark_operators_mixin import (
+    get_target_objects,
+    select_target_objects,
+    SparkOperatorsMixin,
+)
+from .spark_operators_scale import (
+    apply_matrix_to_objects,
+    read_world_coordinates,
+)
+
+
+def get_center_of_volume(obj):
+    """ World-space centroid of the volume enclosed by the mesh of obj, as
+    used by ORIGIN_CENTER_OF_VOLUME. Falls back to the mean of the vertices
+    for open or flat meshes."""
+    mesh = obj.data
+    co = read_world_coordinates(obj)
+    if len(co) == 0:
+        return Vector((0, 0, 0))
+    mesh.calc_loop_triangles()
+    triangles = np.empty(len(mesh.loop_triangles) * 3, dtype=np.int32)
+    mesh.loop_triangles.foreach_get('vertices', triangles)
+    # Center the points first to keep the products well conditioned.
+    mean = co.mean(axis=0)
+    a, b, c = (co - mean)[triangles.reshape(-1, 3)].transpose(1, 0, 2)
+    volumes = np.einsum('ij,ij->i', a, np.cross(b, c))
+    volume = volumes.sum()
+    if abs(volume) < 1e-12:
+        return Vector(mean)
+    centroids = (a + b + c) / 4
+    return Vector(mean + (volumes[:, None] * centroids).sum(axis=0)
+                  / volume)
+
+
+def _move_to_origin(objects, location):
+    """ Bake the transforms of the objects so that `location` ends up at
+    the world origin, with the object origins there too."""
+    apply_matrix_to_objects(objects, Matrix.Translation(-Vector(location)))
 
 
 class OBJECT_OT_SparkOperator_PivotCenter(bpy.types.Operator,
@@ -26,13 +67,17 @@ class OBJECT_OT_SparkOperator_PivotCenter(bpy.types.Operator,
     bl_options = {'REGISTER', 'UNDO'}
 
     def execute(self, context):
-        bpy.ops.object.mode_set(mode='OBJECT')
-        bpy.ops.object.origin_set(type='ORIGIN_CENTER_OF_VOLUME',
-                                  center='MEDIAN')
-        bpy.ops.object.location_clear()
-        bpy.ops.object.transform_apply(location=True,
-                                       rotation=True,
-                                       scale=True)
+        objects = get_target_objects(context)
+        if context.mode != 'OBJECT':
+            bpy.ops.object.mode_set(mode='OBJECT')
+        if len(objects) == 1:
+            center = get_center_of_volume(objects[0])
+        else:
+            bounds_min, bounds_max = get_world_bounds(context, objects)
+            center = (bounds_min + bounds_max) / 2
+        with recording_step(objects, 'pivot', {'mode': 'CENTER'}):
+            _move_to_origin(objects, center)
+        select_target_objects(context, objects)
         return {'FINISHED'}
 
 
@@ -44,20 +89,13 @@ class OBJECT_OT_SparkOperator_PivotBottom(bpy.types.Operator,
     bl_options = {'REGISTER', 'UNDO'}
 
     def execute(self, context):
-        bpy.ops.object.mode_set(mode='OBJECT')
-        bpy.ops.object.transform_apply(location=True,
-                                       rotation=True,
-                                       scale=True)
-
-        mesh_base = context.active_object.bound_box
-
-        bottom_pivot = [0, 0, 0]
-        bottom_pivot[0] = (mesh_base[0][0] + mesh_base[7][0]) / 2
-        bottom_pivot[1] = (mesh_base[0][1] + mesh_base[7][1]) / 2
-        bottom_pivot[2] = (mesh_base[0][2] + mesh_base[7][2]) / 2
-
-        context.scene.cursor.location = bottom_pivot
-        bpy.ops.object.origin_set(type='ORIGIN_CURSOR')
-        bpy.ops.object.location_clear()
-        context.scene.cursor.location = (0, 0, 0)
+        objects = get_target_objects(context)
+        if context.mode != 'OBJECT':
+            bpy.ops.object.mode_set(mode='OBJECT')
+        bounds_min, bounds_max = get_world_bounds(context, objects)
+        bottom_pivot = (bounds_min + bounds_max) / 2
+        bottom_pivot.z = bounds_min.z
+        with recording_step(objects, 'pivot', {'mode': 'BOTTOM'}):
+            _move_to_origin(objects, bottom_pivot)
+        select_target_objects(context, objects)
         return {'FINISHED'}
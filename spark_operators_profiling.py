@@ -0,0 +1,84 @@
+# Copyright (C) Facebook, Inc. and its affiliates
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import bpy
+
+from . import spark_profiling
+
+PROFILE_FILE_NAMES = {
+    'PSTATS': 'spark_profile.prof',
+    'TRACE': 'spark_trace.json',
+}
+
+
+def update_profiling_enabled(self, context):
+    if self.enabled:
+        spark_profiling.enable()
+    else:
+        spark_profiling.disable()
+
+
+class SparkARToolkitProfilingSettings(bpy.types.PropertyGroup):
+    enabled: bpy.props.BoolProperty(
+        name='Profiling',
+        description='Record the time spent in operators and panel drawing',
+        update=update_profiling_enabled,
+        default=False,
+    )
+
+
+class OBJECT_OT_SparkOperator_DumpProfile(bpy.types.Operator):
+    bl_idname = 'object.spark_dump_profile'
+    bl_label = 'Save profile'
+    bl_description = 'Save the recorded profile for offline analysis'
+
+    format: bpy.props.EnumProperty(
+        name='Format',
+        items=[
+            ('PSTATS', 'pstats', 'cProfile statistics'),
+            ('TRACE', 'Chrome trace', 'Chrome trace event JSON'),
+        ],
+        default='PSTATS',
+    )
+    filepath: bpy.props.StringProperty(subtype='FILE_PATH')
+
+    @classmethod
+    def poll(cls, context):
+        return len(spark_profiling.records) > 0
+
+    def invoke(self, context, event):
+        if not self.filepath:
+            self.filepath = PROFILE_FILE_NAMES[self.format]
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+    def execute(self, context):
+        filepath = bpy.path.abspath(self.filepath)
+        if self.format == 'PSTATS':
+            spark_profiling.dump_pstats(filepath)
+        else:
+            spark_profiling.dump_chrome_trace(filepath)
+        self.report({'INFO'}, '已保存: ' + filepath)
+        return {'FINISHED'}
+
+
+class OBJECT_OT_SparkOperator_ClearProfile(bpy.types.Operator):
+    bl_idname = 'object.spark_clear_profile'
+    bl_label = 'Clear profile'
+    bl_description = 'Forget the recorded calls'
+
+    def execute(self, context):
+        spark_profiling.clear()
+        return {'FINISHED'}
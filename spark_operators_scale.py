@@ -13,14 +13,32 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import time
+
+import bmesh
 import bpy
+import numpy as np
+from mathutils import Matrix
 
+from .spark_asset_state import recording_step
+from .spark_bounds import get_world_bounds
+from .spark_mesh_stats import invalidate_object
 from .spark_operators_mixin import (
+    get_target_objects,
     is_context_valid,
+    select_target_objects,
     SparkOperatorsMixin,
 )
 
 
+# Delay after the last height change before the previewed scale is baked
+# into the meshes.
+RESIZE_BAKE_DELAY = 0.5  # unit: seconds
+
+_pending_resize = None
+_last_resize_preview = 0.0
+
+
 def get_unit_scale(unit):
     """ Conversion from meters."""
     if unit == 'cm':
@@ -31,12 +49,99 @@ def get_unit_scale(unit):
         return 3.28084
 
 
+def read_world_coordinates(obj, matrix=None):
+    """ Vertex coordinates of the mesh of obj in world space, or in the
+    space given by matrix, as an (n, 3) array."""
+    mesh = obj.data
+    co = np.empty(len(mesh.vertices) * 3, dtype=np.float64)
+    mesh.vertices.foreach_get('co', co)
+    co = co.reshape(-1, 3)
+    matrix = np.array(matrix if matrix is not None else obj.matrix_world)
+    return co @ matrix[:3, :3].T + matrix[:3, 3]
+
+
+def _parent_depth(obj):
+    depth = 0
+    while obj.parent is not None:
+        obj = obj.parent
+        depth += 1
+    return depth
+
+
+def _reverse_faces(mesh):
+    bm = bmesh.new()
+    try:
+        bm.from_mesh(mesh)
+        bmesh.ops.reverse_faces(bm, faces=bm.faces[:])
+        bm.to_mesh(mesh)
+    finally:
+        bm.free()
+
+
+def apply_matrix_to_objects(objects, matrix):
+    """ Transform the objects by matrix in world space and bake the result
+    into their meshes, leaving every object with an identity transform.
+
+    This replaces a transform_apply round trip: each mesh is rewritten
+    once by Mesh.transform(), and children outside `objects` keep their
+    place in the world. A mesh shared by objects with different
+    transforms is made single user first.
+    """
+    objects = sorted(objects, key=_parent_depth)
+    world_matrices = {obj: obj.matrix_world.copy() for obj in objects}
+    children = [child for obj in objects for child in obj.children
+                if child not in world_matrices]
+    child_matrices = [(child, child.matrix_world.copy())
+                      for child in sorted(children, key=_parent_depth)]
+
+    baked = {}
+    for obj in objects:
+        mesh_matrix = matrix @ world_matrices[obj]
+        mesh = obj.data
+        if mesh in baked and baked[mesh] != mesh_matrix:
+            obj.data = mesh = mesh.copy()
+        if mesh not in baked:
+            mesh.transform(mesh_matrix, shape_keys=True)
+            if mesh_matrix.determinant() < 0:
+                # A mirroring transform turns the faces inside out.
+                _reverse_faces(mesh)
+            mesh.update()
+            baked[mesh] = mesh_matrix
+    for obj in objects:
+        obj.matrix_world = Matrix.Identity(4)
+        invalidate_object(obj.name)
+    for child, child_matrix in child_matrices:
+        child.matrix_world = child_matrix
+
+
+def resize_objects(context, objects, height, unit):
+    """ Scale the objects about the world origin so their combined mesh is
+    `height` tall in `unit`, baking the scale into the meshes."""
+    bounds_min, bounds_max = get_world_bounds(context, objects)
+    current_height = bounds_max.z - bounds_min.z
+    if current_height <= 0:
+        return False
+    scale = height / (get_unit_scale(unit) * current_height)
+    if scale <= 0:
+        return False
+    with recording_step(objects, 'resize', {'height': height,
+                                            'unit': unit}):
+        apply_matrix_to_objects(objects, Matrix.Scale(scale, 4))
+    return True
+
+
+def get_objects_dimensions(context, objects):
+    bounds_min, bounds_max = get_world_bounds(context, objects)
+    return bounds_max - bounds_min
+
+
 def get_current_height_in_selected_unit(context):
     if not is_context_valid(context):
         return (0, 0, 0)
     else:
         unit = context.screen.sparkar_scale.resizeUnit
-        return context.active_object.dimensions * get_unit_scale(unit)
+        dims = get_objects_dimensions(context, get_target_objects(context))
+        return dims * get_unit_scale(unit)
 
 
 def should_height_setting_be_updated(context, eps=0.0001):
@@ -53,16 +158,80 @@ def update_sparkar_scale_settings(context):
          resize_settings.height) = dims
 
 
+def preview_resize(context, objects, height, unit):
+    """ Scale the objects to `height` by their transforms only. The meshes
+    keep their vertices until bake_pending_resize() runs."""
+    current_height = get_objects_dimensions(context, objects)[2]
+    if current_height <= 0 or height <= 0:
+        return False
+    scale_matrix = Matrix.Scale(
+        height / (get_unit_scale(unit) * current_height), 4)
+    for obj in objects:
+        obj.matrix_world = scale_matrix @ obj.matrix_world
+    return True
+
+
+def bake_pending_resize(push_undo=True):
+    """ Bake a previewed resize into the meshes, with one undo step unless
+    push_undo is False, e.g. inside an operator that pushes its own."""
+    if _pending_resize is None:
+        return False
+    names, height, unit = _pending_resize
+    cancel_pending_resize()
+    objects = [bpy.data.objects[name] for name in names
+               if name in bpy.data.objects]
+    if not objects or not resize_objects(bpy.context, objects, height,
+                                         unit):
+        return False
+
+    windows = bpy.context.window_manager.windows
+    if not push_undo or not windows:
+        # Background mode has no undo history.
+        return True
+    if hasattr(bpy.context, 'temp_override'):
+        with bpy.context.temp_override(window=windows[0],
+                                       screen=windows[0].screen):
+            bpy.ops.ed.undo_push(message='Resize')
+    else:
+        bpy.ops.ed.undo_push(message='Resize')
+    return True
+
+
+def cancel_pending_resize():
+    """ Forget a previewed resize, e.g. when its objects are gone."""
+    global _pending_resize
+    _pending_resize = None
+    if bpy.app.timers.is_registered(_deferred_resize_bake):
+        bpy.app.timers.unregister(_deferred_resize_bake)
+
+
+def _deferred_resize_bake():
+    remaining = _last_resize_preview + RESIZE_BAKE_DELAY - time.perf_counter()
+    if remaining > 0:
+        return remaining
+    bake_pending_resize()
+    return None
+
+
 def resize_active_model(self, context):
-    if not should_height_setting_be_updated(bpy.context):
+    global _pending_resize, _last_resize_preview
+    if (context.mode != 'OBJECT' or not is_context_valid(context)
+            or not should_height_setting_be_updated(context)):
+        return
+    objects = get_target_objects(context)
+    names = tuple(obj.name for obj in objects)
+    if _pending_resize is not None and _pending_resize[0] != names:
+        bake_pending_resize()
+    if not preview_resize(context, objects, self.height, self.resizeUnit):
         return
-    for area in context.screen.areas:
-        if area.type == 'VIEW_3D':
-            for region in area.regions:
-                if region.type == 'WINDOW':
-                    override = {'area': area, 'region': region,
-                                'edit_object': context.edit_object}
-                    bpy.ops.object.spark_resize(override)
+
+    # Dragging the field calls this for every value; only the transforms
+    # change until the value has been still for RESIZE_BAKE_DELAY.
+    _pending_resize = (names, self.height, self.resizeUnit)
+    _last_resize_preview = time.perf_counter()
+    if not bpy.app.timers.is_registered(_deferred_resize_bake):
+        bpy.app.timers.register(_deferred_resize_bake,
+                                first_interval=RESIZE_BAKE_DELAY)
 
 
 class SparkARToolkitScaleSettings(bpy.types.PropertyGroup):
@@ -92,20 +261,14 @@ class OBJECT_OT_SparkOperator_Resize(bpy.types.Operator, SparkOperatorsMixin):
     bl_options = {'REGISTER', 'UNDO'}
 
     def execute(self, context):
-        current_height = context.active_object.dimensions[2]
+        objects = get_target_objects(context)
         settings = context.screen.sparkar_scale
-        expected_height = settings.height
-        expected_unit = settings.resizeUnit
-        unit_scale = get_unit_scale(expected_unit)
-
-        bpy.ops.object.transform_apply(location=True,
-                                       rotation=True,
-                                       scale=True)
-        scale = expected_height / (unit_scale * current_height)
-        if scale > 0:
-            bpy.ops.transform.resize(value=(scale, scale, scale))
-            bpy.ops.object.transform_apply(location=True,
-                                           rotation=True,
-                                           scale=True)
-            bpy.ops.object.location_clear()
+        if context.mode != 'OBJECT':
+            bpy.ops.object.mode_set(mode='OBJECT')
+        # The pending resize becomes part of this operator's undo step.
+        bake_pending_resize(push_undo=False)
+        if not resize_objects(context, objects, settings.height,
+                              settings.resizeUnit):
+            return {'CANCELLED'}
+        select_target_objects(context, objects)
         return {'FINISHED'}
@@ -0,0 +1,213 @@
+# Copyright (C) Facebook, Inc. and its affiliates
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import os
+import time
+
+import bpy
+
+from .spark_asset_state import is_step_current, read_state, recording_step
+from .spark_budget import analyze_objects
+from .spark_mesh_stats import count_mesh_triangles
+from .spark_operators_optimization import decimate_to_triangle_budget
+from .spark_operators_scale import resize_objects
+
+
+class PipelineError(Exception):
+    pass
+
+
+def _import_obj(filepath):
+    if hasattr(bpy.ops.wm, 'obj_import'):
+        bpy.ops.wm.obj_import(filepath=filepath)
+    else:
+        bpy.ops.import_scene.obj(filepath=filepath)
+
+
+def load_asset(filepath, reset=True):
+    """ Open a .blend file, or import filepath into an empty scene. Pass
+    reset=False when the caller has already reset the scene."""
+    ext = os.path.splitext(filepath)[1].lower()
+    if ext == '.blend':
+        bpy.ops.wm.open_mainfile(filepath=filepath)
+        return
+    if reset:
+        bpy.ops.wm.read_homefile(use_empty=True)
+    if ext == '.fbx':
+        bpy.ops.import_scene.fbx(filepath=filepath)
+    elif ext == '.obj':
+        _import_obj(filepath)
+    elif ext in ('.glb', '.gltf'):
+        bpy.ops.import_scene.gltf(filepath=filepath)
+    else:
+        raise PipelineError('Unsupported file type: ' + ext)
+
+
+def select_only(context, objects):
+    for obj in context.view_layer.objects:
+        obj.select_set(False)
+    for obj in objects:
+        obj.select_set(True)
+    context.view_layer.objects.active = objects[0] if objects else None
+
+
+def prepare_asset_object(context):
+    """ Join all meshes of the scene into a single unparented mesh."""
+    meshes = [obj for obj in context.view_layer.objects
+              if obj.type == 'MESH']
+    if not meshes:
+        raise PipelineError('No mesh found')
+    if context.object is not None and context.object.mode != 'OBJECT':
+        bpy.ops.object.mode_set(mode='OBJECT')
+
+    select_only(context, meshes)
+    bpy.ops.object.parent_clear(type='CLEAR_KEEP_TRANSFORM')
+    if len(meshes) > 1:
+        bpy.ops.object.join()
+    return context.active_object
+
+
+def evaluated_tri_count(context, obj):
+    depsgraph = context.evaluated_depsgraph_get()
+    return count_mesh_triangles(obj.evaluated_get(depsgraph).data)
+
+
+def _run_cleanup(context, obj, options):
+    select_only(context, [obj])
+    bpy.ops.object.spark_mesh_cleanup()
+
+
+def _run_decimate(context, obj, options):
+    budget = options.get('tri_budget')
+    if not budget:
+        return
+    select_only(context, [obj])
+    decimate_to_triangle_budget(context, [obj], budget)
+    bpy.ops.object.spark_decimation()
+
+
+def _run_resize(context, obj, options):
+    if not options.get('height'):
+        return
+    resize_objects(context, [obj], options['height'],
+                   options.get('unit', 'cm'))
+
+
+def _run_pivot(context, obj, options):
+    select_only(context, [obj])
+    mode = options.get('mode', 'BOTTOM')
+    if mode == 'BOTTOM':
+        bpy.ops.object.spark_pivot_bottom()
+    elif mode == 'CENTER':
+        bpy.ops.object.spark_pivot_center()
+    else:
+        raise PipelineError('Unknown pivot mode: ' + str(mode))
+
+
+def _run_export(context, obj, options, output_path):
+    select_only(context, [obj])
+    bpy.ops.object.export_for_spark_ar(filepath=output_path)
+
+
+def _run_analyze(context, obj, options, output_path):
+    """ Budget report of the asset, written next to the output as
+    <name>.budget.json unless the step names another path."""
+    report = analyze_objects(context, [obj])
+    report_path = options.get('output') or (
+        os.path.splitext(output_path)[0] + '.budget.json')
+    with open(report_path, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+    if options.get('fail_on_error'):
+        over = [metric for metric, status in report['status'].items()
+                if status == 'ERROR']
+        if over:
+            raise PipelineError('Over budget: ' + ', '.join(over))
+    return report
+
+
+def _run_save(context, obj, options, output_path):
+    """ Save the processed asset as <name>.blend next to the output so
+    that running the pipeline on it again resumes where this run stopped."""
+    blend_path = options.get('output') or (
+        os.path.splitext(output_path)[0] + '.blend')
+    bpy.ops.wm.save_as_mainfile(filepath=blend_path, copy=True)
+    return blend_path
+
+
+PIPELINE_STEPS = {
+    'cleanup': _run_cleanup,
+    'decimate': _run_decimate,
+    'resize': _run_resize,
+    'pivot': _run_pivot,
+}
+
+
+def _append_step(result, on_step, entry):
+    result['steps'].append(entry)
+    if on_step is not None:
+        on_step(entry)
+
+
+def run_pipeline(context, obj, pipeline, output_path, on_step=None):
+    """ Run the steps of pipeline on obj. on_step, when given, is called
+    with the timing entry of every step as soon as the step is done."""
+    result = {
+        'tris_before': evaluated_tri_count(context, obj),
+        'steps': [],
+    }
+    for options in pipeline.get('steps', []):
+        name = options.get('step')
+        start = time.perf_counter()
+        if name == 'export':
+            _run_export(context, obj, options, output_path)
+            result['output'] = output_path
+        elif name == 'analyze':
+            result['budget'] = _run_analyze(context, obj, options,
+                                            output_path)
+        elif name == 'save':
+            result['saved'] = _run_save(context, obj, options, output_path)
+        elif name in PIPELINE_STEPS:
+            # Steps already recorded on the object with the same options
+            # and no change since are not run again.
+            state_step = 'pipeline.' + name
+            if not pipeline.get('force') and \
+                    is_step_current(obj, state_step, options):
+                _append_step(result, on_step, {
+                    'step': name,
+                    'skipped': True,
+                    'time': 0.0,
+                })
+                continue
+            with recording_step([obj], state_step, options):
+                PIPELINE_STEPS[name](context, obj, options)
+        else:
+            raise PipelineError('Unknown pipeline step: ' + str(name))
+        _append_step(result, on_step, {
+            'step': name,
+            'time': time.perf_counter() - start,
+        })
+
+    result['tris_after'] = evaluated_tri_count(context, obj)
+    result['dimensions'] = list(obj.dimensions)
+    result['state'] = read_state(obj)
+    return result
+
+
+def process_file(input_path, output_path, pipeline, on_step=None,
+                 reset=True):
+    load_asset(input_path, reset)
+    obj = prepare_asset_object(bpy.context)
+    return run_pipeline(bpy.context, obj, pipeline, output_path, on_step)
@@ -0,0 +1,200 @@
+# Copyright (C) Facebook, Inc. and its affiliates
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import collections
+import cProfile
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+from bpy.app.handlers import persistent
+
+PROFILE_BUFFER_SIZE = 512
+
+ProfileRecord = collections.namedtuple('ProfileRecord', (
+    'name',
+    'category',
+    'start',  # unit: seconds, time.perf_counter()
+    'duration',  # unit: seconds
+    'depsgraph_updates',
+    'allocated',  # unit: bytes, net Python allocations
+    'peak_allocated',  # unit: bytes, only for outermost calls
+    'depth',
+))
+
+records = collections.deque(maxlen=PROFILE_BUFFER_SIZE)
+call_counts = collections.Counter()
+
+_enabled = False
+_depth = 0
+_depsgraph_updates = 0
+_profiler = None
+
+
+def is_enabled():
+    return _enabled
+
+
+def enable():
+    global _enabled, _profiler
+    if _enabled:
+        return
+    _enabled = True
+    _profiler = cProfile.Profile()
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    global _enabled
+    if not _enabled:
+        return
+    _enabled = False
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def clear():
+    global _profiler
+    records.clear()
+    call_counts.clear()
+    if _profiler is not None:
+        _profiler = cProfile.Profile()
+
+
+@persistent
+def profiling_depsgraph_handler(scene, depsgraph=None):
+    global _depsgraph_updates
+    _depsgraph_updates += 1
+
+
+class _Span(object):
+    __slots__ = ('name', 'category', 'start', 'depsgraph_updates',
+                 'allocated', 'outermost', 'profiling')
+
+    def __init__(self, name, category):
+        self.name = name
+        self.category = category
+
+    def __enter__(self):
+        global _depth
+        self.outermost = _depth == 0
+        self.profiling = False
+        _depth += 1
+        if self.outermost:
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            try:
+                _profiler.enable()
+                self.profiling = True
+            except ValueError:
+                # Another profiler is active, e.g. one started by the user.
+                pass
+        self.allocated = tracemalloc.get_traced_memory()[0]
+        self.depsgraph_updates = _depsgraph_updates
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        global _depth
+        duration = time.perf_counter() - self.start
+        current, peak = tracemalloc.get_traced_memory()
+        _depth -= 1
+        if self.profiling:
+            _profiler.disable()
+        call_counts[self.name] += 1
+        records.append(ProfileRecord(
+            self.name, self.category, self.start, duration,
+            _depsgraph_updates - self.depsgraph_updates,
+            current - self.allocated,
+            peak - self.allocated if self.outermost else None,
+            _depth))
+        return False
+
+
+def _is_recording():
+    return _enabled and threading.current_thread() is threading.main_thread()
+
+
+def profiled(category, name=None):
+    """ Record every call of the decorated function while profiling is
+    enabled. Calls from other threads are not recorded."""
+    def decorator(function):
+        label = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _is_recording():
+                return function(*args, **kwargs)
+            with _Span(label, category):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def profiled_method(category, name=None):
+    """ profiled() for methods taking (self, context, ...). Blender checks
+    the argument count of registered callbacks such as execute and draw,
+    so the wrapper keeps those two named arguments."""
+    def decorator(function):
+        label = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(self, context, *args, **kwargs):
+            if not _is_recording():
+                return function(self, context, *args, **kwargs)
+            with _Span(label, category):
+                return function(self, context, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def slowest_records(count=10):
+    return sorted(records, key=lambda record: record.duration,
+                  reverse=True)[:count]
+
+
+def dump_pstats(filepath):
+    if _profiler is None:
+        raise RuntimeError('Profiling has not been enabled')
+    _profiler.dump_stats(filepath)
+
+
+def dump_chrome_trace(filepath):
+    """ Write the buffered records in the Chrome trace event format, for
+    chrome://tracing or https://ui.perfetto.dev."""
+    pid = os.getpid()
+    events = []
+    for record in records:
+        events.append({
+            'name': record.name,
+            'cat': record.category,
+            'ph': 'X',
+            'ts': record.start * 1e6,
+            'dur': record.duration * 1e6,
+            'pid': pid,
+            'tid': 0,
+            'args': {
+                'depsgraph_updates': record.depsgraph_updates,
+                'allocated': record.allocated,
+                'peak_allocated': record.peak_allocated,
+            },
+        })
+    with open(filepath, 'w') as trace_file:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'},
+                  trace_file)
@@ -0,0 +1,202 @@
+# Copyright (C) Facebook, Inc. and its affiliates
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import bpy
+import numpy as np
+
+from .spark_disk_cache import evict_lru
+
+TEXTURE_CACHE_DIR = os.path.join(tempfile.gettempdir(),
+                                 'kivicube_ar_toolkit', 'textures')
+TEXTURE_CACHE_MAX_SIZE = 512 * 1024 * 1024  # unit: bytes
+
+FILE_EXTENSIONS = {
+    'PNG': '.png',
+    'JPEG': '.jpg',
+    'TARGA': '.tga',
+    'BMP': '.bmp',
+    'TIFF': '.tif',
+    'OPEN_EXR': '.exr',
+    'HDR': '.hdr',
+    'WEBP': '.webp',
+}
+
+
+def collect_images(objects):
+    """ Images used by image texture nodes of the objects' materials, each
+    listed once however many materials share it."""
+    images = []
+    for obj in objects:
+        for material_slot in obj.material_slots:
+            material = material_slot.material
+            if not material or not material.node_tree:
+                continue
+            for node in material.node_tree.nodes:
+                if (node.type == 'TEX_IMAGE' and node.image
+                        and node.image not in images):
+                    images.append(node.image)
+    return images
+
+
+def fit_size(width, height, max_size):
+    """ Largest size within max_size x max_size keeping the aspect ratio."""
+    longest = max(width, height)
+    if longest <= max_size:
+        return width, height
+    scale = max_size / longest
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def _area_resample_rows(data, new_size):
+    """ Box-filter a (rows, columns, channels) array along its columns."""
+    old_size = data.shape[1]
+    if new_size == old_size:
+        return data
+    if old_size % new_size == 0:
+        factor = old_size // new_size
+        return data.reshape(data.shape[0], new_size, factor, -1).mean(
+            axis=2, dtype=data.dtype)
+    # Integrate along the rows and sample the integral at the output pixel
+    # edges, which gives the exact box-filtered average for any ratio.
+    integral = np.cumsum(data, axis=1, dtype=data.dtype)
+    edges = np.linspace(0, old_size, new_size + 1)
+    index = np.minimum(np.floor(edges).astype(np.int64), old_size - 1)
+    fraction = (edges - index).astype(data.dtype).reshape(1, -1, 1)
+    values = (np.take(integral, index, axis=1)
+              - np.take(data, index, axis=1) * (1 - fraction))
+    widths = np.diff(edges).astype(data.dtype).reshape(1, -1, 1)
+    return (values[:, 1:] - values[:, :-1]) / widths
+
+
+def resample_pixels(pixels, width, height, channels, new_width, new_height):
+    """ Box-filter a flat pixel buffer to a new size."""
+    image = pixels.reshape(height, width, channels)
+    image = _area_resample_rows(image, new_width)
+    # Resample the other axis on a transposed copy, so both passes walk
+    # contiguous memory.
+    image = np.ascontiguousarray(image.transpose(1, 0, 2))
+    image = _area_resample_rows(image, new_height)
+    return np.ascontiguousarray(image.transpose(1, 0, 2)).ravel()
+
+
+def read_pixels(image):
+    width, height = image.size
+    pixels = np.empty(width * height * image.channels, dtype=np.float32)
+    image.pixels.foreach_get(pixels)
+    return pixels
+
+
+def source_bytes(image):
+    if image.packed_file:
+        return image.packed_file.data
+    path = bpy.path.abspath(image.filepath_raw)
+    if image.filepath_raw and os.path.isfile(path):
+        with open(path, 'rb') as image_file:
+            return image_file.read()
+    return None
+
+
+def _cache_path(digest, size, file_format):
+    key = '{}_{}x{}'.format(digest, *size)
+    return os.path.join(TEXTURE_CACHE_DIR,
+                        key + FILE_EXTENSIONS.get(file_format, '.png'))
+
+
+def _write_image_file(image, pixels, size, path):
+    scaled = bpy.data.images.new(image.name + '_scaled', size[0], size[1],
+                                 alpha=image.channels == 4,
+                                 float_buffer=image.is_float)
+    try:
+        scaled.colorspace_settings.name = image.colorspace_settings.name
+        scaled.pixels.foreach_set(pixels)
+        scaled.filepath_raw = path
+        scaled.file_format = image.file_format
+        scaled.save()
+    finally:
+        bpy.data.images.remove(scaled)
+
+
+def _touch(path):
+    """ Mark a cached file as just used, so eviction keeps it. False when
+    it is not cached, e.g. evicted by another process meanwhile."""
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def _replace_image_data(image, path):
+    with open(path, 'rb') as cached_file:
+        data = cached_file.read()
+    if image.packed_file:
+        image.pack(data=data, data_len=len(data))
+    else:
+        with open(bpy.path.abspath(image.filepath_raw), 'wb') as image_file:
+            image_file.write(data)
+    image.reload()
+
+
+def evict_textures(max_size=TEXTURE_CACHE_MAX_SIZE):
+    """ Drop the least recently used textures until the cache fits."""
+    evict_lru(TEXTURE_CACHE_DIR, max_size)
+
+
+def downscale_images(images, max_size, max_workers=None,
+                     max_cache_size=TEXTURE_CACHE_MAX_SIZE):
+    """ Downscale every image larger than max_size, keeping its aspect
+    ratio and writing the result back to the image file or packed data.
+
+    Pixels are read on the main thread and box-filtered in a thread pool.
+    Encoded results are cached on disk under a hash of the source content,
+    so unchanged inputs are replaced straight from the cache, which is
+    kept under max_cache_size by dropping the least recently used
+    results. Images with neither a file nor packed data are scaled in
+    place.
+    """
+    os.makedirs(TEXTURE_CACHE_DIR, exist_ok=True)
+    pending = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for image in images:
+            if image.source not in {'FILE', 'GENERATED'}:
+                continue
+            width, height = image.size
+            size = fit_size(width, height, max_size)
+            if size == (width, height):
+                continue
+            source = source_bytes(image)
+            if source is None:
+                image.scale(*size)
+                continue
+
+            digest = hashlib.sha1(source).hexdigest()
+            path = _cache_path(digest, size, image.file_format)
+            if _touch(path):
+                _replace_image_data(image, path)
+                continue
+            future = executor.submit(resample_pixels, read_pixels(image),
+                                     width, height, image.channels, *size)
+            pending.append((image, size, path, future))
+
+        for image, size, path, future in pending:
+            _write_image_file(image, future.result(), size, path)
+            _replace_image_data(image, path)
+    evict_textures(max_cache_size)
+    return len(pending)
@@ -0,0 +1,480 @@
+# Copyright (C) Facebook, Inc. and its affiliates
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Copyright (C) 2021 Wendell.Yang
+
+""" Long-lived headless workers and a local scheduler that feeds them.
+
+    python spark_worker.py schedule [--workers N] [--port 8760] \\
+        [--timeout SECONDS] [--blender PATH]
+
+    python spark_worker.py submit INPUT OUTPUT_DIR [--port 8760] \\
+        [--pipeline pipeline.json] [--summary results.json]
+
+    blender -b --factory-startup -P spark_worker.py -- serve [--port 0]
+
+A worker registers the add-on once and then runs one job after the other,
+each in a scene reset to an empty home file, so the Blender startup is
+paid once per worker instead of once per asset. Jobs and their results
+travel as JSON lines over a local TCP socket. A job
+
+    {"id": "1", "input": "a.fbx", "output": "a.glb", "pipeline": {...}}
+
+is answered by a "started" event, a "step" event as soon as each pipeline
+step is done and a "finished" event with the result and metrics of the
+job. The scheduler starts --workers workers, hands every job it receives
+to the next idle one and relays the events to the client that sent it.
+A worker that crashes or runs out of time is restarted.
+"""
+
+import argparse
+import collections
+import importlib
+import json
+import os
+import queue
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import traceback
+
+ADDON_DIR = os.path.dirname(os.path.abspath(__file__))
+HOST = '127.0.0.1'
+DEFAULT_PORT = 8760
+# Printed by a serving worker once it accepts connections.
+READY_PREFIX = 'SPARK_WORKER_PORT'
+LOG_LINES = 40
+
+
+def _script_args(argv):
+    if '--' in argv:
+        return argv[argv.index('--') + 1:]
+    return argv[1:]
+
+
+def send_message(stream, message):
+    stream.write((json.dumps(message) + '\n').encode('utf-8'))
+    stream.flush()
+
+
+def read_message(stream):
+    """ The next JSON line of stream, or None once it is closed."""
+    line = stream.readline()
+    if not line:
+        return None
+    return json.loads(line.decode('utf-8'))
+
+
+# WORKER
+
+def run_job(pipeline, job, emit):
+    """ Run one job in a fresh scene, calling emit with its step events,
+    and return its result."""
+    import bpy
+    from spark_batch import DEFAULT_PIPELINE
+    from spark_benchmark import peak_memory, reset_peak_memory
+
+    result = {'input': job.get('input'), 'status': 'failed'}
+    start = time.perf_counter()
+    baseline = reset_peak_memory()
+    try:
+        # The only reset of the job; process_file is told to skip its own.
+        bpy.ops.wm.read_homefile(use_empty=True)
+        result['reset_time'] = time.perf_counter() - start
+        output_path = job.get('output') or (
+            os.path.splitext(job['input'])[0] + '.glb')
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)),
+                    exist_ok=True)
+        result.update(pipeline.process_file(
+            job['input'], output_path, job.get('pipeline') or DEFAULT_PIPELINE,
+            on_step=lambda step: emit({'event': 'step', 'step': step}),
+            reset=False))
+        result['status'] = 'succeeded'
+    except Exception as error:
+        result['error'] = str(error)
+        result['traceback'] = traceback.format_exc()
+    result['elapsed'] = time.perf_counter() - start
+    peak = peak_memory()
+    if peak is not None and baseline is not None:
+        result['peak_memory'] = max(0, peak - baseline)
+    return result
+
+
+def _serve_connection(pipeline, stream, stats):
+    """ Run the jobs of one connection. Returns False on a shutdown
+    command."""
+    while True:
+        try:
+            job = read_message(stream)
+        except ValueError as error:
+            send_message(stream, {'event': 'error', 'error': str(error)})
+            continue
+        if job is None:
+            return True
+        if not isinstance(job, dict):
+            send_message(stream, {'event': 'error',
+                                  'error': 'A job must be a JSON object'})
+            continue
+        if job.get('command') == 'shutdown':
+            return False
+
+        def emit(message):
+            message['id'] = job.get('id')
+            send_message(stream, message)
+
+        emit({'event': 'started', 'pid': os.getpid()})
+        result = run_job(pipeline, job, emit)
+        stats['jobs'] += 1
+        result['jobs_done'] = stats['jobs']
+        result['uptime'] = time.perf_counter() - stats['start']
+        emit({'event': 'finished', 'result': result})
+
+
+def run_serve(args):
+    from spark_batch import ADDON_MODULE_NAME, load_addon
+
+    load_addon()
+    pipeline = importlib.import_module(ADDON_MODULE_NAME + '.spark_pipeline')
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((HOST, args.port))
+    server.listen(1)
+    print('{} {}'.format(READY_PREFIX, server.getsockname()[1]), flush=True)
+
+    stats = {'jobs': 0, 'start': time.perf_counter()}
+    with server:
+        while True:
+            connection, _ = server.accept()
+            try:
+                with connection, connection.makefile('rwb') as stream:
+                    if not _serve_connection(pipeline, stream, stats):
+                        return 0
+            except OSError:
+                # The client went away; wait for the next one.
+                pass
+
+
+# SCHEDULER
+
+class WorkerProcess(object):
+    """ A serving Blender process and the connection to it."""
+
+    def __init__(self, blender, index):
+        self.blender = blender
+        self.index = index
+        self.process = None
+        self.connection = None
+        self.stream = None
+        self.log = collections.deque(maxlen=LOG_LINES)
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        command = [
+            self.blender, '-b', '--factory-startup', '-noaudio',
+            '--python', os.path.abspath(__file__), '--',
+            'serve', '--port', '0',
+        ]
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT)
+        port = None
+        for line in self.process.stdout:
+            text = line.decode('utf-8', 'replace').rstrip()
+            self.log.append(text)
+            if text.startswith(READY_PREFIX):
+                port = int(text.split()[1])
+                break
+        if port is None:
+            raise RuntimeError('Worker {} exited with code {}'.format(
+                self.index, self.process.wait()))
+        # Keep reading the log so the worker never blocks on a full pipe.
+        threading.Thread(target=self._read_log, daemon=True).start()
+        self.connection = socket.create_connection((HOST, port))
+        self.stream = self.connection.makefile('rwb')
+
+    def _read_log(self):
+        for line in self.process.stdout:
+            self.log.append(line.decode('utf-8', 'replace').rstrip())
+
+    def stop(self):
+        for closable in (self.stream, self.connection):
+            if closable is not None:
+                try:
+                    closable.close()
+                except OSError:
+                    pass
+        self.stream = self.connection = None
+        if self.alive:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+    def run(self, job, relay, timeout):
+        """ Send job to the worker and relay its events until it is
+        finished; a job running longer than timeout raises."""
+        deadline = time.monotonic() + timeout
+        send_message(self.stream, job)
+        while True:
+            self.connection.settimeout(max(deadline - time.monotonic(),
+                                           0.001))
+            message = read_message(self.stream)
+            if message is None:
+                raise ConnectionError('Worker {} exited'.format(self.index))
+            message['worker'] = self.index
+            relay(message)
+            if message.get('event') == 'finished':
+                return message['result']
+
+
+class Scheduler(object):
+    """ Queue of jobs shared by the workers: whichever worker is idle
+    takes the next one, which keeps every core busy however uneven the
+    assets are."""
+
+    def __init__(self, blender, worker_count, timeout):
+        self.timeout = timeout
+        self.jobs = queue.Queue()
+        self.workers = [WorkerProcess(blender, index)
+                        for index in range(worker_count)]
+        self.threads = []
+
+    def start(self):
+        for worker in self.workers:
+            thread = threading.Thread(target=self._feed_worker,
+                                      args=(worker,), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        for _ in self.workers:
+            self.jobs.put(None)
+        for worker in self.workers:
+            worker.stop()
+
+    def submit(self, job, relay):
+        self.jobs.put((job, relay))
+
+    def _feed_worker(self, worker):
+        try:
+            worker.start()
+        except (OSError, RuntimeError) as error:
+            print('worker {}: {}'.format(worker.index, error), flush=True)
+        while True:
+            item = self.jobs.get()
+            if item is None:
+                return
+            job, relay = item
+            try:
+                if not worker.alive:
+                    worker.stop()
+                    worker.start()
+                worker.run(job, relay, self.timeout)
+            except (OSError, RuntimeError, ValueError) as error:
+                timed_out = isinstance(error, socket.timeout)
+                relay({
+                    'id': job.get('id'),
+                    'event': 'finished',
+                    'worker': worker.index,
+                    'result': {
+                        'input': job.get('input'),
+                        'status': 'timeout' if timed_out else 'failed',
+                        'error': ('Timed out after {}s'.format(self.timeout)
+                                  if timed_out else str(error)),
+                        'log': '\n'.join(worker.log),
+                    },
+                })
+                worker.stop()
+
+    def handle_client(self, connection):
+        """ Queue the jobs sent over connection and send their events
+        back, keeping the connection open until all of them finished."""
+        lock = threading.Lock()
+        pending = []
+        with connection, connection.makefile('rwb') as stream:
+            def send(message):
+                with lock:
+                    try:
+                        send_message(stream, message)
+                    except OSError:
+                        # The client is gone; its jobs still run.
+                        pass
+
+            def relay_to(finished):
+                def relay(message):
+                    send(message)
+                    if message.get('event') == 'finished':
+                        finished.set()
+                return relay
+
+            while True:
+                try:
+                    job = read_message(stream)
+                except ValueError as error:
+                    send({'event': 'error', 'error': str(error)})
+                    continue
+                except OSError:
+                    break
+                if job is None:
+                    break
+                finished = threading.Event()
+                pending.append(finished)
+                self.submit(job, relay_to(finished))
+            for finished in pending:
+                finished.wait()
+
+
+def run_schedule(args):
+    from spark_batch import find_blender
+
+    blender = find_blender(args.blender)
+    if not blender:
+        print('Blender executable not found, pass --blender')
+        return 2
+    scheduler = Scheduler(blender, args.workers or os.cpu_count() or 1,
+                          args.timeout)
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((HOST, args.port))
+    server.listen()
+    scheduler.start()
+    # Stop the workers on a plain kill as well as on Ctrl+C.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print('Scheduling {} workers on {}:{}'.format(
+        len(scheduler.workers), HOST, server.getsockname()[1]), flush=True)
+    try:
+        with server:
+            while True:
+                connection, _ = server.accept()
+                threading.Thread(target=scheduler.handle_client,
+                                 args=(connection,), daemon=True).start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        scheduler.stop()
+    return 0
+
+
+# CLIENT
+
+def run_submit(args):
+    from spark_batch import (
+        DEFAULT_PIPELINE,
+        collect_inputs,
+        output_paths_for,
+    )
+
+    if os.path.isdir(args.input):
+        input_dir = args.input
+        inputs = collect_inputs(args.input)
+    else:
+        input_dir = os.path.dirname(args.input)
+        inputs = [args.input]
+    pipeline = DEFAULT_PIPELINE
+    if args.pipeline:
+        with open(args.pipeline) as pipeline_file:
+            pipeline = json.load(pipeline_file)
+
+    outputs = output_paths_for(inputs, input_dir, args.output)
+    start = time.perf_counter()
+    results = []
+    with socket.create_connection((HOST, args.port)) as connection, \
+            connection.makefile('rwb') as stream:
+        for index, input_path in enumerate(inputs):
+            send_message(stream, {
+                'id': str(index),
+                'input': os.path.abspath(input_path),
+                'output': os.path.abspath(outputs[index]),
+                'pipeline': pipeline,
+            })
+        while len(results) < len(inputs):
+            message = read_message(stream)
+            if message is None:
+                break
+            if message.get('event') == 'step':
+                print('  {} {} {:.3f}s'.format(
+                    inputs[int(message['id'])], message['step']['step'],
+                    message['step']['time']), flush=True)
+            elif message.get('event') == 'finished':
+                result = message['result']
+                result['worker'] = message.get('worker')
+                results.append(result)
+                print('[{}] {}'.format(result['status'], result['input']),
+                      flush=True)
+            elif message.get('event') == 'error':
+                print('error: ' + message['error'])
+
+    summary = {
+        'input': args.input,
+        'output_dir': args.output,
+        'elapsed': time.perf_counter() - start,
+        'succeeded': sum(r['status'] == 'succeeded' for r in results),
+        'failed': len(inputs) - sum(r['status'] == 'succeeded'
+                                    for r in results),
+        'results': results,
+    }
+    summary_path = args.summary or os.path.join(args.output, 'results.json')
+    os.makedirs(os.path.dirname(os.path.abspath(summary_path)),
+                exist_ok=True)
+    with open(summary_path, 'w') as summary_file:
+        json.dump(summary, summary_file, indent=2)
+    print('{succeeded} succeeded, {failed} failed'.format(**summary))
+    return 0 if summary['failed'] == 0 else 1
+
+
+def parse_args(argv):
+    from spark_batch import DEFAULT_TIMEOUT
+
+    parser = argparse.ArgumentParser(prog='spark_worker')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve = subparsers.add_parser('serve')
+    serve.add_argument('--port', type=int, default=0)
+
+    schedule = subparsers.add_parser('schedule')
+    schedule.add_argument('--workers', type=int)
+    schedule.add_argument('--port', type=int, default=DEFAULT_PORT)
+    schedule.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT)
+    schedule.add_argument('--blender')
+
+    submit = subparsers.add_parser('submit')
+    submit.add_argument('input')
+    submit.add_argument('output')
+    submit.add_argument('--port', type=int, default=DEFAULT_PORT)
+    submit.add_argument('--pipeline')
+    submit.add_argument('--summary')
+
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    if ADDON_DIR not in sys.path:
+        sys.path.insert(0, ADDON_DIR)
+    args = parse_args(_script_args(argv))
+    if args.command == 'serve':
+        return run_serve(args)
+    if args.command == 'schedule':
+        return run_schedule(args)
+    return run_submit(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
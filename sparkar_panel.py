@@ -16,19 +16,45 @@
 # Copyright (C) 2021 Wendell.Yang
 
 import bpy
-import bmesh
 
 from .spark_operators_export import OBJECT_OT_SparkOperator_ExportForSparkAR
 from .spark_operators_optimization import (
+    LOD_RATIOS,
+    TRIS_COUNT_ERROR,
+    TRIS_COUNT_WARNING,
+
     OBJECT_OT_SparkOperator_MeshCleanUp,
+    OBJECT_OT_SparkOperator_OptimizeVertexCache,
     OBJECT_OT_SparkOperator_Decimation,
+    OBJECT_OT_SparkOperator_DecimateInBackground,
+    OBJECT_OT_SparkOperator_DecimateToBudget,
+    OBJECT_OT_SparkOperator_TextureAtlas,
+    OBJECT_OT_SparkOperator_BakeNormalMap,
+)
+from .spark_operators_mixin import (
+    get_primary_object,
+    get_target_objects,
+    is_context_valid,
 )
-from .spark_operators_mixin import is_context_valid
 from .spark_operators_pivot import (
     OBJECT_OT_SparkOperator_PivotCenter,
     OBJECT_OT_SparkOperator_PivotBottom,
 )
-from .spark_operators_scale import get_unit_scale
+from .spark_operators_scale import (
+    get_objects_dimensions,
+    get_unit_scale,
+)
+from .spark_budget import analyze_objects
+from .spark_mesh_stats import tri_count_cache
+from .spark_operators_profiling import (
+    OBJECT_OT_SparkOperator_ClearProfile,
+    OBJECT_OT_SparkOperator_DumpProfile,
+)
+from .spark_profiling import (
+    call_counts,
+    profiled_method,
+    slowest_records,
+)
 from .sparkar_panel_base import SparkARPanelBase
 
 
@@ -40,28 +66,27 @@ class PANEL0_PT_SparkAR_Panel(bpy.types.Panel, SparkARPanelBase):
     bl_region_type = 'UI'
     bl_context = 'objectmode'
 
-    TRIS_COUNT_ERROR = 50000
-    TRIS_COUNT_WARNING = 30000
+    TRIS_COUNT_ERROR = TRIS_COUNT_ERROR
+    TRIS_COUNT_WARNING = TRIS_COUNT_WARNING
     HEIGHT_MIN = 0.01  # unit: meters
     HEIGHT_MAX = 5  # unit: meters
+    PROFILE_ROWS = 5
     GUIDELINES_LINK = "https://sparkar.facebook.com/ar-studio/learn/documentation/technical-guidelines"
 
     tri_count = 0
 
     # ASSET SELECTION SECTION
 
+    @profiled_method('panel')
     def _draw_asset_selection_box(self, context, layout):
-        if len(context.selected_objects) > 1:
-            text = [
-                '不支持同时选择多个网格',
-                '请选择单个网格'
-            ]
-            layout.alert = True
-            layout.scale_y = 0.5
-        elif not is_context_valid(context):
+        layout.prop(context.screen.sparkar_target, 'targetMode', expand=True)
+        objects = get_target_objects(context)
+        if not objects:
             text = ['选择网格开始优化']
+        elif len(objects) > 1:
+            text = ['已选择 {} 个网格'.format(len(objects))]
         else:
-            text = ['名称: ' + context.active_object.name]
+            text = ['名称: ' + objects[0].name]
         for line in text:
             layout.label(text=line)
 
@@ -87,14 +112,13 @@ class PANEL0_PT_SparkAR_Panel(bpy.types.Panel, SparkARPanelBase):
             ]
         return icon, message_lines
 
+    @profiled_method('panel')
     def _draw_tri_count_summary(self, context, layout):
         if not is_context_valid(context):
             self.tri_count = 0
         else:
-            bm = bmesh.new()
-            bm.from_object(context.active_object,
-                           context.evaluated_depsgraph_get())
-            self.tri_count = len(bm.calc_loop_triangles())
+            self.tri_count = sum(tri_count_cache.get(context, obj)
+                                 for obj in get_target_objects(context))
 
         label = '三角形数: ' + self._pretty_print_count(self.tri_count)
         icon_alert = self.tri_count >= self.TRIS_COUNT_ERROR
@@ -112,7 +136,8 @@ class PANEL0_PT_SparkAR_Panel(bpy.types.Panel, SparkARPanelBase):
 
         highlight_apply = False
         if bpy.ops.object.spark_decimation.poll():
-            optimization_settings = context.active_object.sparkar_optimization
+            optimization_settings = get_primary_object(context)\
+                .sparkar_optimization
             ratio_button.prop(optimization_settings,
                               'InvertedReducePercentage', text='')
 
@@ -127,30 +152,147 @@ class PANEL0_PT_SparkAR_Panel(bpy.types.Panel, SparkARPanelBase):
             row.enabled = False
         apply_button.operator(OBJECT_OT_SparkOperator_Decimation.bl_idname,
                               text='确定', depress=highlight_apply)
+        row.operator(OBJECT_OT_SparkOperator_DecimateInBackground.bl_idname,
+                     text='后台')
 
+    def _draw_triangle_budget_section(self, context, layout):
+        row = layout.row()
+        if not is_context_valid(context):
+            row.enabled = False
+            row.label(text='0')
+        else:
+            optimization_settings = get_primary_object(context)\
+                .sparkar_optimization
+            row.prop(optimization_settings, 'TargetTriangleCount', text='')
+            row.prop(optimization_settings, 'EnforceTriangleBudget',
+                     text='导出时')
+        row.operator(OBJECT_OT_SparkOperator_DecimateToBudget.bl_idname,
+                     text='自动')
+
+    def _draw_lod_section(self, context, layout):
+        row = layout.row()
+        if not is_context_valid(context):
+            row.enabled = False
+            row.label(text='-')
+        else:
+            counts = [0] * len(LOD_RATIOS)
+            for obj in get_target_objects(context):
+                for index, count in enumerate(
+                        obj.sparkar_optimization.LodTriangleCounts):
+                    counts[index] += count
+            row.label(text=' / '.join(self._pretty_print_count(count)
+                                      for count in counts))
+        lod_op = row.operator(OBJECT_OT_SparkOperator_Decimation.bl_idname,
+                              text='生成LOD')
+        lod_op.lod_chain = True
+
+    def _draw_atlas_section(self, context, layout):
+        row = layout.row()
+        if not is_context_valid(context):
+            row.enabled = False
+            row.label(text='-')
+        else:
+            row.prop(get_primary_object(context).sparkar_optimization,
+                     'AtlasResolution', text='')
+        row.operator(OBJECT_OT_SparkOperator_TextureAtlas.bl_idname,
+                     text='合并')
+
+    def _draw_normal_bake_section(self, context, layout):
+        row = layout.row()
+        if not is_context_valid(context):
+            row.enabled = False
+            row.label(text='-')
+        else:
+            row.prop(get_primary_object(context).sparkar_optimization,
+                     'NormalMapResolution', text='')
+        row.operator(OBJECT_OT_SparkOperator_BakeNormalMap.bl_idname,
+                     text='烘焙')
+
+    @profiled_method('panel')
+    def _draw_budget_summary(self, context, layout):
+        if not is_context_valid(context):
+            return
+        report = analyze_objects(context, get_target_objects(context))
+        totals = report['totals']
+        for metric, label, text in (
+                ('gpu_vertices', '顶点数',
+                 self._pretty_print_count(totals['gpu_vertices'])),
+                ('draw_calls', '绘制调用', str(totals['draw_calls'])),
+                ('texture_memory', '贴图内存',
+                 self._pretty_print_bytes(totals['texture_memory'])),
+                ('gpu_memory', '显存',
+                 self._pretty_print_bytes(totals['gpu_memory'])),
+                ('download_size', '预计大小',
+                 self._pretty_print_bytes(totals['download_size']))):
+            status = report['status'][metric]
+            row = layout.row()
+            row.scale_y = 0.8
+            row.alert = status == 'ERROR'
+            row.label(text=label + ': ' + text)
+            row.label(text='', icon=(self.OK_ICON if status == 'OK'
+                                     else self.WARNING_ICON))
+
+    @profiled_method('panel')
     def _draw_mesh_opt_box(self, context, layout):
         summary = layout.box()
         self._draw_tri_count_summary(context, summary)
+        self._draw_budget_summary(context, summary)
 
         layout.label(text='减少三角形数')
         decimation_row = layout.row()
         decimation_row.separator(factor=0.0)
         self._draw_reduce_polygons_section(context, decimation_row)
         decimation_row.separator(factor=0.0)
+        if is_context_valid(context):
+            engine_row = layout.row()
+            engine_row.separator(factor=0.0)
+            engine_row.prop(get_primary_object(context).sparkar_optimization,
+                            'DecimationEngine', text='算法')
+            engine_row.separator(factor=0.0)
+
+        layout.label(text='目标三角形数')
+        budget_row = layout.row()
+        budget_row.separator(factor=0.0)
+        self._draw_triangle_budget_section(context, budget_row)
+        budget_row.separator(factor=0.0)
+
+        layout.label(text='LOD三角形数')
+        lod_row = layout.row()
+        lod_row.separator(factor=0.0)
+        self._draw_lod_section(context, lod_row)
+        lod_row.separator(factor=0.0)
+
+        layout.label(text='合并材质贴图')
+        atlas_row = layout.row()
+        atlas_row.separator(factor=0.0)
+        self._draw_atlas_section(context, atlas_row)
+        atlas_row.separator(factor=0.0)
+
+        layout.label(text='法线贴图')
+        normal_row = layout.row()
+        normal_row.separator(factor=0.0)
+        self._draw_normal_bake_section(context, normal_row)
+        normal_row.separator(factor=0.0)
 
         layout.label(text='清理网格')
         cleanup_row = layout.row()
         cleanup_row.separator(factor=0.0)
         cleanup_row.operator(OBJECT_OT_SparkOperator_MeshCleanUp.bl_idname,
                              text='确定')
+        cleanup_row.operator(
+            OBJECT_OT_SparkOperator_OptimizeVertexCache.bl_idname,
+            text='顶点缓存')
         cleanup_row.separator(factor=0.0)
         layout.separator(factor=0.0)
 
     # SCALE AND POSITIONING SECTION
+    @profiled_method('panel')
     def _draw_size_summary_box(self, context, layout):
         unit = context.screen.sparkar_scale.resizeUnit
         if is_context_valid(context):
-            dims = context.active_object.dimensions * get_unit_scale(unit)
+            dimensions = get_objects_dimensions(
+                context, get_target_objects(context))
+            dims = dimensions * get_unit_scale(unit)
         else:
             dims = (0, 0, 0)
 
@@ -163,7 +305,7 @@ class PANEL0_PT_SparkAR_Panel(bpy.types.Panel, SparkARPanelBase):
             text = ['网格高度应该遵循技术规范']
             icon = 'NONE'
         else:
-            heightM = context.active_object.dimensions[2]
+            heightM = dimensions[2]
             if heightM > self.HEIGHT_MAX:
                 text = [
                     "降低高度以便在Kivicube中更好地控制"
@@ -211,6 +353,7 @@ class PANEL0_PT_SparkAR_Panel(bpy.types.Panel, SparkARPanelBase):
         height_row.prop(resize_settings, 'resizeUnit', text='')
         height_row.separator(factor=0.0)
 
+    @profiled_method('panel')
     def _draw_positioning_scaling_box(self, context, layout):
         summary_box = layout.box()
         self._draw_size_summary_box(context, summary_box)
@@ -231,10 +374,15 @@ class PANEL0_PT_SparkAR_Panel(bpy.types.Panel, SparkARPanelBase):
     # EXPORT
 
     def _is_export_disabled(self, context):
-        if len(context.selected_objects) == 0:
+        if not is_context_valid(context):
             return True
+        # Export decimates to the budget itself when it is enforced.
+        if get_primary_object(context).sparkar_optimization\
+                .EnforceTriangleBudget:
+            return False
         return self.tri_count >= self.TRIS_COUNT_ERROR
 
+    @profiled_method('panel')
     def draw_export(self, context, layout):
         export_description = [
             '使用Spark AR工具包优化导出网格'
@@ -245,18 +393,70 @@ class PANEL0_PT_SparkAR_Panel(bpy.types.Panel, SparkARPanelBase):
             row.scale_y = 0.5
             row.enabled = False
             row.label(text=line)
+        export_settings = context.screen.sparkar_export
+        layout.prop(export_settings, 'useFastExporter', text='快速导出静态网格')
+        layout.prop(export_settings, 'exportLods', text='导出LOD')
+        cache_row = layout.row()
+        cache_row.active = (export_settings.useFastExporter
+                            or export_settings.compression == 'QUANTIZE')
+        cache_row.prop(export_settings, 'optimizeVertexCache',
+                       text='顶点缓存优化')
+        layout.prop(export_settings, 'compression', text='压缩')
+        if export_settings.compression == 'DRACO':
+            draco_column = layout.column(align=True)
+            draco_column.prop(export_settings, 'dracoLevel', text='级别')
+            draco_column.prop(export_settings, 'dracoPositionBits',
+                              text='位置位数')
+            draco_column.prop(export_settings, 'dracoNormalBits',
+                              text='法线位数')
+            draco_column.prop(export_settings, 'dracoTexcoordBits',
+                              text='UV位数')
+            draco_column.prop(export_settings, 'dracoCompareSize',
+                              text='对比未压缩大小')
         button = layout.row()
         button.scale_y = 1.5
-        button.operator(OBJECT_OT_SparkOperator_ExportForSparkAR.bl_idname,
-                        text='导出网格', depress=True)
+        export_op = button.operator(
+            OBJECT_OT_SparkOperator_ExportForSparkAR.bl_idname,
+            text='导出网格', depress=True)
+        export_op.use_fast_exporter = export_settings.useFastExporter
+        export_op.export_lods = export_settings.exportLods
+        export_op.optimize_vertex_cache = export_settings.optimizeVertexCache
+        export_op.compression = export_settings.compression
+        export_op.draco_level = export_settings.dracoLevel
+        export_op.draco_position_bits = export_settings.dracoPositionBits
+        export_op.draco_normal_bits = export_settings.dracoNormalBits
+        export_op.draco_texcoord_bits = export_settings.dracoTexcoordBits
+        export_op.compare_uncompressed = export_settings.dracoCompareSize
         if self._is_export_disabled(context):
             button.enabled = False
 
+    # PROFILING
+
+    def draw_profiling(self, context, layout):
+        profiling_settings = context.screen.sparkar_profiling
+        layout.prop(profiling_settings, 'enabled', text='记录耗时')
+        for record in slowest_records(self.PROFILE_ROWS):
+            row = layout.row()
+            row.scale_y = 0.6
+            row.label(text=record.name)
+            row.label(text='{:.1f} ms'.format(record.duration * 1000))
+            row.label(text='{} 次'.format(call_counts[record.name]))
+        row = layout.row(align=True)
+        pstats_op = row.operator(
+            OBJECT_OT_SparkOperator_DumpProfile.bl_idname, text='pstats')
+        pstats_op.format = 'PSTATS'
+        trace_op = row.operator(
+            OBJECT_OT_SparkOperator_DumpProfile.bl_idname, text='Trace')
+        trace_op.format = 'TRACE'
+        row.operator(OBJECT_OT_SparkOperator_ClearProfile.bl_idname,
+                     text='', icon='TRASH')
+
     # PANEL
 
     def draw_header(self, context):
         self.layout.label(text='', icon='TOOL_SETTINGS')
 
+    @profiled_method('panel')
     def draw(self, context):
         self.layout.label(text='网格', icon='FILE_3D')
         asset_selection_box = self.layout.box()
@@ -274,3 +474,7 @@ class PANEL0_PT_SparkAR_Panel(bpy.types.Panel, SparkARPanelBase):
         self.layout.label(text='导出', icon='EXPORT')
         export_box = self.layout.box()
         self.draw_export(context, export_box)
+
+        self.layout.label(text='性能分析', icon='TIME')
+        profiling_box = self.layout.box()
+        self.draw_profiling(context, profiling_box)
@@ -23,6 +23,13 @@ class SparkARPanelBase(object):
             return str(count)
         return str(round(count/1000, 1)) + 'K'
 
+    def _pretty_print_bytes(self, size):
+        for unit in ('B', 'KB', 'MB'):
+            if size < 1024:
+                return str(round(size, 1)) + unit
+            size /= 1024
+        return str(round(size, 1)) + 'GB'
+
     def _draw_label_with_status_icon_and_learn_more_section(
          self, context, layout, label, icon, alert, description_lines,
          link):